@@ -22,9 +22,10 @@ from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import SGD
 from tensorflow.keras.utils import plot_model
 
-from sklearn.cluster import KMeans
 from sklearn import metrics
 
+from .kmeans_init import init_centers
+
 
 def cluster_acc(y_true, y_pred):
     """
@@ -126,7 +127,13 @@ class ClusteringLayer(Layer):
         Return:
             q: student's t-distribution, or soft labels for each sample. shape=(n_samples, n_clusters)
         """
-        q = 1.0 / (1.0 + (K.sum(K.square(K.expand_dims(inputs, axis=1) - self.clusters), axis=2) / self.alpha))
+        # ||x - u||^2 = ||x||^2 - 2 x.u^T + ||u||^2: one matrix multiply instead of an (n, k, d) difference tensor;
+        # rows are already chunked by the batch size of fit/predict
+        distances = (K.sum(K.square(inputs), axis=1, keepdims=True)
+                     - 2.0 * K.dot(inputs, K.transpose(self.clusters))
+                     + K.sum(K.square(self.clusters), axis=1))
+        # Cancellation can leave tiny negative values for points on top of a center
+        q = 1.0 / (1.0 + (K.maximum(distances, 0.0) / self.alpha))
         q **= (self.alpha + 1.0) / 2.0
         q = K.transpose(K.transpose(q) / K.sum(q, axis=1))
         return q
@@ -141,6 +148,70 @@ class ClusteringLayer(Layer):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+def allocate_target_buffer(out, shape):
+    """
+    Buffer for the target distribution: a new array for None, a memory-mapped file for a path,
+    or `out` itself after checking its shape.
+    """
+    if out is None:
+        return np.empty(shape, dtype=np.float32)
+    if isinstance(out, str):
+        return np.memmap(out, dtype=np.float32, mode='w+', shape=shape)
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError('Target buffer has shape %s, expected %s' % (tuple(out.shape), tuple(shape)))
+    return out
+
+
+def target_distribution_inplace(q, batch_size=65536):
+    """
+    Streaming two-pass target distribution: turns soft labels q into p in place.
+    Pass one accumulates the cluster frequency q.sum(0) over row blocks, pass two rewrites each block
+    as p, so only O(batch_size * n_clusters) extra memory is needed and q may be memory-mapped.
+
+    # Arguments
+        q: soft labels, numpy.array with shape `(n_samples, n_clusters)`, overwritten with p
+        batch_size: rows per block
+    # Return
+        q, now holding p
+    """
+    frequency = np.zeros(q.shape[1], dtype=np.float64)
+    for start in range(0, len(q), batch_size):
+        frequency += q[start:start + batch_size].sum(0)
+    for start in range(0, len(q), batch_size):
+        weight = q[start:start + batch_size] ** 2 / frequency
+        q[start:start + batch_size] = weight / weight.sum(1, keepdims=True)
+    return q
+
+
+def predict_soft_labels(model, x, out=None, batch_size=65536):
+    """
+    Predict the soft labels of a single-output model block by block into `out`
+    (see allocate_target_buffer), so only one block of model output is held at a time.
+    """
+    out = allocate_target_buffer(out, (x.shape[0], model.output_shape[-1]))
+    for start in range(0, x.shape[0], batch_size):
+        block = model.predict(x[start:start + batch_size], verbose=0)
+        out[start:start + len(block)] = block
+    return out
+
+
+def nearest_cluster(features, clusters):
+    """
+    Hard cluster assignment without computing the soft labels.
+    q_ij decreases with dist(x_i, u_j) and the normalization does not change the order,
+    so argmax_j q_ij is the nearest cluster center.
+
+    # Arguments
+        features: numpy.array with shape `(n_samples, n_features)`
+        clusters: cluster centers, numpy.array with shape `(n_clusters, n_features)`
+    # Return
+        cluster labels, numpy.array with shape `(n_samples,)`
+    """
+    # ||x||^2 is the same for every center and can be left out of the argmin
+    distances = np.sum(np.square(clusters), axis=1) - 2.0 * np.dot(features, clusters.T)
+    return distances.argmin(1)
+
+
 class DEC(object):
     def __init__(self,
                  dims,
@@ -187,26 +258,39 @@ class DEC(object):
         return q.argmax(1)
 
     @staticmethod
-    def target_distribution(q):
-        weight = q ** 2 / q.sum(0)
+    def target_distribution(q, frequency=None):
+        # frequency is q.sum(0) over all rows; pass it to compute p for a block of rows
+        weight = q ** 2 / (q.sum(0) if frequency is None else frequency)
         return (weight.T / weight.sum(1)).T
 
     def clustering(self, x, y=None,
                    tol=1e-3,
                    update_interval=140,
                    maxiter=2e4,
-                   save_dir='./results/dec'):
+                   save_dir='./results/dec',
+                   target_buffer=None,
+                   kmeans_init='full',
+                   kmeans_sample_size=100000,
+                   kmeans_n_jobs=None,
+                   kmeans_strata=None):
 
         print('Update interval', update_interval)
         save_interval = x.shape[0] / self.batch_size * 5  # 5 epochs
         print('Save interval', save_interval)
 
         # initialize cluster centers using k-means
-        print('Initializing cluster centers with k-means.')
-        kmeans = KMeans(n_clusters=self.n_clusters, n_init=20)
-        y_pred = kmeans.fit_predict(self.encoder.predict(x))
+        # kmeans_init: 'full', 'sample' or 'minibatch', see kmeans_init.init_centers
+        # kmeans_strata: optional per-sample group ids to stratify the k-means sample on. Not y: the
+        # ground truth only scores the clustering and must not leak into the initialization
+        print('Initializing cluster centers with k-means (%s).' % kmeans_init)
+        chunk = 65536
+        cluster_centers, y_pred = init_centers(
+            self.n_clusters,
+            lambda: (self.encoder.predict(x[i:i + chunk]) for i in range(0, x.shape[0], chunk)),
+            lambda rows: self.encoder.predict(x[rows]),
+            x.shape[0], method=kmeans_init, strata=kmeans_strata, sample_size=kmeans_sample_size, n_jobs=kmeans_n_jobs)
         y_pred_last = y_pred
-        self.model.get_layer(name='clustering').set_weights([kmeans.cluster_centers_])
+        self.model.get_layer(name='clustering').set_weights([cluster_centers])
 
         # logging file
         import csv, os
@@ -219,13 +303,14 @@ class DEC(object):
 
         loss = 0
         index = 0
+        p = target_buffer  # None, a preallocated (n, n_clusters) array or a path for a memory-mapped file
         for ite in range(int(maxiter)):
             if ite % update_interval == 0:
-                q = self.model.predict(x, verbose=0)
-                p = self.target_distribution(q)  # update the auxiliary target distribution p
+                q = predict_soft_labels(self.model, x, out=p)
+                y_pred = q.argmax(1)
+                p = target_distribution_inplace(q)  # update the auxiliary target distribution p in place
 
                 # evaluate the clustering performance
-                y_pred = q.argmax(1)
                 delta_label = np.sum(y_pred != y_pred_last).astype(np.float32) / y_pred.shape[0]
                 y_pred_last = y_pred
                 if y is not None:
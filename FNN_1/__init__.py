@@ -1,4 +1,11 @@
 from .model import FNN
-from .dataset import CachedBERTDataset
+from .dataset import CachedBERTDataset, StreamingBERTDataset
+from .centroid_index import CentroidIndex
+from .checkpoints import CheckpointWriter, latest_checkpoint, load_checkpoint
+from .embedding_cache import DiskEmbeddingCache, EmbeddingStore
+from .predictions import PredictionCache
+from .registry import EncoderRegistry, encoder_registry, get_encoder, warmup_encoder
 
-__all__ = ['FNN', 'CachedBERTDataset']
\ No newline at end of file
+__all__ = ['FNN', 'CachedBERTDataset', 'StreamingBERTDataset', 'DiskEmbeddingCache', 'EmbeddingStore', 'PredictionCache',
+           'CentroidIndex', 'CheckpointWriter', 'latest_checkpoint', 'load_checkpoint', 'EncoderRegistry',
+           'encoder_registry', 'get_encoder', 'warmup_encoder']
\ No newline at end of file
@@ -1,12 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
 import torch
-from torch.utils.data import Dataset
-from transformers import AutoTokenizer, AutoModel
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from tqdm import tqdm
+from transformers import AutoConfig
+
+from .embedding_cache import DiskEmbeddingCache, EmbeddingStore, take_rows, text_hash
+from .encoding import EncodingPipeline, encode_texts
+from .registry import get_encoder
+
+class _BERTEncoderMixin(object):
+    """Lazy BERT loading and batch encoding shared by the cached and streaming datasets"""
+
+    def _load_bert(self):
+        # Shared with every other dataset and predict call in this process
+        device = "cuda" if self.cuda and torch.cuda.is_available() and not self.quantize else "cpu"
+        self._tokenizer, self._model = get_encoder(self.bert_model, device, quantize=self.quantize)
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._load_bert()
+        return self._tokenizer
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._load_bert()
+        return self._model
+
+    def _to_device(self, tensor):
+        if self.cuda and torch.cuda.is_available():
+            return tensor.cuda()
+        return tensor
 
-class CachedBERTDataset(Dataset):
-    def __init__(self, texts, labels=None, bert_model="bert-base-uncased", max_length=128, cuda=True, testing_mode=False):
+    def _get_bert_embeddings(self, texts, batch_size=64, token_budget=8192):
+        """Generate BERT embeddings for a batch of texts (dynamically padded, on CPU)"""
+        return encode_texts(texts, self.tokenizer, self.model, max_length=self.max_length, pooling=self.pooling,
+                            batch_size=batch_size, token_budget=token_budget)
+
+
+class CachedBERTDataset(_BERTEncoderMixin, Dataset):
+    def __init__(self, texts, labels=None, bert_model="bert-base-uncased", max_length=128, cuda=True, testing_mode=False,
+                 cache_dir=None, pooling="cls", quantize=False, storage_dtype="float32", shared_cache=False):
         """
         Dataset that caches BERT embeddings for text data
-        
+
         Args:
             texts: List of text strings to encode
             labels: Optional list of labels corresponding to the texts
@@ -14,58 +55,298 @@ class CachedBERTDataset(Dataset):
             max_length: Maximum sequence length for BERT tokenizer
             cuda: Whether to use GPU acceleration
             testing_mode: If True, only use a small subset of data
+            cache_dir: Optional directory for a persistent on-disk embedding cache shared across runs
+            pooling: How to pool the last hidden state, 'cls' (first token) or 'mean' (masked mean)
+            quantize: Run BERT on CPU with dynamically int8-quantized Linear layers
+            storage_dtype: In-memory embedding dtype, 'float32', 'float16', 'bfloat16' or 'int8'
+                (per-row scaled); rows are upcast to float32 when read
+            shared_cache: Keep the embedding cache in shared memory, so DataLoader workers
+                (num_workers > 0) fill and read one cache instead of a private copy each
         """
+        if pooling not in ("cls", "mean"):
+            raise ValueError("pooling must be 'cls' or 'mean'")
         self.texts = texts
         self.labels = labels  # Can be None
         self.cuda = cuda
         self.testing_mode = testing_mode
-        self._cache = {}
-        print(f"Loading BERT model: {bert_model}")
-        self.tokenizer = AutoTokenizer.from_pretrained(bert_model)
-        self.model = AutoModel.from_pretrained(bert_model)
-        if cuda and torch.cuda.is_available():
-            self.model = self.model.cuda()
+        self.bert_model = bert_model
         self.max_length = max_length
-        self.model.eval()
-    
-    def _get_bert_embedding(self, text):
-        """Generate BERT embedding for a single text"""
-        inputs = self.tokenizer(
-            text,
-            return_tensors="pt",
-            max_length=self.max_length,
-            padding="max_length",
-            truncation=True
-        )
-        if self.cuda and torch.cuda.is_available():
-            inputs = {k: v.cuda() for k, v in inputs.items()}
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            embeddings = outputs.last_hidden_state[:, 0, :]  
-        return embeddings.squeeze(0)
-    
+        self.pooling = pooling
+        self.quantize = quantize
+        self.storage_dtype = storage_dtype
+        # BERT is loaded on first use, so a fully cached corpus never loads it
+        self._tokenizer = None
+        self._model = None
+        self.disk_cache = DiskEmbeddingCache(cache_dir, bert_model, max_length, pooling, quantize) if cache_dir else None
+
+        # Deduplicate by normalized text hash: each distinct text is encoded and stored once,
+        # and index -> row is kept in one compact integer array
+        self._row_hashes = []
+        self._row_texts = []
+        row_of_hash = {}
+        self._rows = np.empty(len(self), dtype=np.int32)
+        for i in range(len(self)):
+            key = text_hash(texts[i])
+            row = row_of_hash.get(key)
+            if row is None:
+                row = row_of_hash[key] = len(self._row_hashes)
+                self._row_hashes.append(key)
+                self._row_texts.append(texts[i])
+            self._rows[i] = row
+        if len(self._row_hashes) < len(self):
+            print(f"Deduplicated {len(self)} texts to {len(self._row_hashes)} distinct texts")
+
+        # One contiguous matrix for all distinct texts and one label array for all indices
+        hidden_size = self._hidden_size() if shared_cache else None
+        self._store = EmbeddingStore(len(self._row_hashes), storage_dtype, hidden_size=hidden_size,
+                                     shared=shared_cache)
+        self._label_array = None
+        if labels is not None:
+            label_array = np.asarray(labels[:len(self)])
+            self._label_array = torch.as_tensor(
+                label_array, dtype=torch.long if np.issubdtype(label_array.dtype, np.integer) else torch.float)
+
+    def _hidden_size(self):
+        """Embedding size, read from the disk cache or the model config without loading BERT"""
+        if self.disk_cache is not None and self.disk_cache.hidden_size is not None:
+            return self.disk_cache.hidden_size
+        return AutoConfig.from_pretrained(self.bert_model).hidden_size
+
+    def _fill_row(self, row):
+        """Fill a single missing row from the disk cache or with one BERT pass"""
+        stored_row = self.disk_cache.lookup([self._row_hashes[row]])[0] if self.disk_cache is not None else -1
+        if stored_row >= 0:
+            self._store.put([row], self.disk_cache.get([stored_row]))
+        else:
+            # Single misses stay in memory; precompute() persists in batches
+            self._store.put([row], self._get_bert_embeddings([self._row_texts[row]]))
+
+    def precompute(self, batch_size=64, num_threads=None, token_budget=8192, tokenizer_workers=0):
+        """
+        Encode all uncached texts in batches and fill the cache in one pass
+
+        Texts are bucketed by token length and each batch is padded only to its longest
+        member. With a `cache_dir`, rows already on disk are loaded without running BERT
+        and the newly encoded rows are appended to the disk cache.
+
+        Args:
+            batch_size: Maximum number of texts per BERT forward pass
+            num_threads: Optional number of torch intra-op threads used while encoding on CPU
+            token_budget: Maximum number of padded tokens per BERT forward pass
+            tokenizer_workers: If > 0, tokenize in this many threads overlapped with the forward pass
+                and report docs/sec per stage
+
+        Returns:
+            self: For method chaining
+        """
+        missing = self._store.missing_rows()
+
+        if self.disk_cache is not None and missing:
+            stored = self.disk_cache.lookup([self._row_hashes[row] for row in missing])
+            hits = stored >= 0
+            if hits.any():
+                self._store.put(np.asarray(missing)[hits], self.disk_cache.get(stored[hits]))
+            missing = [row for row, stored_row in zip(missing, stored) if stored_row < 0]
+            print(f"Loaded {int(hits.sum())} embeddings from {self.disk_cache.path}")
+
+        if not missing:
+            return self
+
+        # Bucket within chunks so progress is reported and the disk cache is committed regularly
+        chunk_size = batch_size * 64
+        previous_threads = torch.get_num_threads()
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        pipeline = None
+        if tokenizer_workers > 0:
+            pipeline = EncodingPipeline(self.tokenizer, self.model, max_length=self.max_length, pooling=self.pooling,
+                                        batch_size=batch_size, token_budget=token_budget,
+                                        num_workers=tokenizer_workers)
+        try:
+            for start in tqdm(range(0, len(missing), chunk_size), desc="Precomputing BERT embeddings"):
+                chunk_rows = missing[start:start + chunk_size]
+                chunk_texts = [self._row_texts[row] for row in chunk_rows]
+                if pipeline is not None:
+                    embeddings = pipeline.encode(chunk_texts)
+                else:
+                    embeddings = self._get_bert_embeddings(chunk_texts, batch_size=batch_size,
+                                                           token_budget=token_budget)
+                if self.disk_cache is not None:
+                    self.disk_cache.add([self._row_hashes[row] for row in chunk_rows], embeddings.numpy())
+                self._store.put(chunk_rows, embeddings)
+        finally:
+            if num_threads is not None:
+                torch.set_num_threads(previous_threads)
+
+        if pipeline is not None:
+            stats = pipeline.stats
+            print(f"Tokenize: {stats['tokenize_docs_per_sec']:.1f} docs/sec per thread, "
+                  f"encode: {stats['encode_docs_per_sec']:.1f} docs/sec, "
+                  f"overall: {stats['wall_docs_per_sec']:.1f} docs/sec")
+        return self
+
     def __getitem__(self, index: int):
         """Get embedding and (optional) label for index"""
         if self.testing_mode and index >= 128:
             index = index % 128
-    
-        if index not in self._cache:
-            text = self.texts[index]
-            embedding = self._get_bert_embedding(text)
-    
-            if self.labels is not None:  
-                label = self.labels[index]
-                label_tensor = torch.tensor(label, dtype=torch.long if isinstance(label, int) else torch.float)
-    
-                if self.cuda and torch.cuda.is_available():
-                    label_tensor = label_tensor.cuda(non_blocking=True)
-                
-                self._cache[index] = (embedding, label_tensor)
-            else:  
-                self._cache[index] = embedding  
-    
-        return self._cache[index]
-    
+
+        row = int(self._rows[index])
+        if not self._store.is_filled(row):
+            self._fill_row(row)
+
+        embedding = self._to_device(self._store.get(row))
+        if self._label_array is not None:
+            return embedding, self._to_device(self._label_array[index])
+        return embedding
+
+    def as_tensor(self, upcast=True):
+        """
+        Return all embeddings (and labels) as single CPU tensors, filling the cache first if needed
+
+        When no texts were deduplicated the embeddings are a zero-copy view of the cache;
+        otherwise distinct rows are gathered into one new `(len(self), hidden_size)` tensor.
+
+        Args:
+            upcast: Return float32 embeddings. With False, reduced-precision storage is returned
+                as is (a float16/bfloat16 tensor or QuantizedEmbeddings) for per-batch upcasting
+
+        Returns:
+            Embeddings, or (embeddings, labels) if the dataset has labels
+        """
+        if not self._store.all_filled():
+            self.precompute()
+        if len(self._row_hashes) == len(self):
+            embeddings = self._store.data
+        else:
+            embeddings = take_rows(self._store.data, torch.from_numpy(self._rows).long())
+        if upcast:
+            embeddings = embeddings.float()
+        if self._label_array is not None:
+            return embeddings, self._label_array
+        return embeddings
+
+    def as_numpy(self):
+        """Numpy counterpart of as_tensor(), sharing memory with the returned tensors (float32 storage only)"""
+        data = self.as_tensor()
+        if isinstance(data, tuple):
+            return tuple(t.numpy() for t in data)
+        return data.numpy()
+
     def __len__(self):
         """Return dataset length, limited in testing mode"""
-        return min(128, len(self.texts)) if self.testing_mode else len(self.texts)
\ No newline at end of file
+        return min(128, len(self.texts)) if self.testing_mode else len(self.texts)
+
+
+def read_text_chunks(path, columns, chunk_size=8192):
+    """
+    Lazily read a JSONL, CSV or Parquet file as a sequence of pandas DataFrames
+
+    Args:
+        path: File path; the format is taken from the extension
+        columns: Columns to read
+        chunk_size: Number of rows per DataFrame
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet files requires pyarrow: pip install pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif ext in (".csv", ".tsv"):
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size, sep="\t" if ext == ".tsv" else ",")
+    elif ext in (".jsonl", ".json"):
+        for frame in pd.read_json(path, lines=True, chunksize=chunk_size):
+            yield frame[columns]
+    else:
+        raise ValueError(f"Unsupported file format '{ext}', expected .jsonl, .csv or .parquet")
+
+
+class StreamingBERTDataset(_BERTEncoderMixin, IterableDataset):
+    def __init__(self, paths, text_column="text", label_column=None, bert_model="bert-base-uncased", max_length=128,
+                 batch_size=256, chunk_size=8192, shuffle=False, cuda=True, cache_dir=None, pooling="cls",
+                 token_budget=8192, quantize=False):
+        """
+        Dataset that streams texts from files and yields batches of BERT embeddings
+
+        Only one chunk of rows is held in memory at a time, so corpora larger than RAM can be
+        processed. With DataLoader workers, chunks are split round-robin between workers; every
+        worker reads and appends to the shared disk cache, whose appends are locked across processes.
+
+        Args:
+            paths: Path or list of paths to JSONL, CSV or Parquet files
+            text_column: Column holding the text
+            label_column: Optional column holding integer labels
+            bert_model: Pre-trained BERT model name to use
+            max_length: Maximum sequence length for BERT tokenizer
+            batch_size: Number of embeddings per yielded batch
+            chunk_size: Number of rows read and encoded at a time
+            shuffle: Shuffle rows within each chunk
+            cuda: Whether to use GPU acceleration for BERT
+            cache_dir: Optional directory for a persistent on-disk embedding cache shared across runs
+            pooling: How to pool the last hidden state, 'cls' (first token) or 'mean' (masked mean)
+            token_budget: Maximum number of padded tokens per BERT forward pass
+            quantize: Run BERT on CPU with dynamically int8-quantized Linear layers
+        """
+        if pooling not in ("cls", "mean"):
+            raise ValueError("pooling must be 'cls' or 'mean'")
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.text_column = text_column
+        self.label_column = label_column
+        self.bert_model = bert_model
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.shuffle = shuffle
+        self.cuda = cuda
+        self.pooling = pooling
+        self.token_budget = token_budget
+        self.quantize = quantize
+        self._tokenizer = None
+        self._model = None
+        self.disk_cache = DiskEmbeddingCache(cache_dir, bert_model, max_length, pooling, quantize) if cache_dir else None
+
+    def iter_chunks(self):
+        """Yield (texts, labels) per chunk; labels is None without a label column"""
+        columns = [self.text_column] + ([self.label_column] if self.label_column else [])
+        for path in self.paths:
+            for frame in read_text_chunks(path, columns, self.chunk_size):
+                texts = frame[self.text_column].astype(str).tolist()
+                labels = frame[self.label_column].to_numpy(dtype=np.int64) if self.label_column else None
+                yield texts, labels
+
+    def _embed_chunk(self, texts):
+        """Embed one chunk, reading cached rows from disk and encoding each distinct missing text once"""
+        if self.disk_cache is None:
+            return encode_texts(texts, self.tokenizer, self.model, max_length=self.max_length, pooling=self.pooling,
+                                token_budget=self.token_budget, deduplicate=True)
+
+        keys = [text_hash(text) for text in texts]
+        rows = self.disk_cache.lookup(keys)
+        missing = np.flatnonzero(rows < 0)
+        if len(missing) > 0:
+            embeddings = encode_texts([texts[i] for i in missing], self.tokenizer, self.model,
+                                      max_length=self.max_length, pooling=self.pooling,
+                                      token_budget=self.token_budget, deduplicate=True)
+            # Locked append: other workers may be writing to the same cache directory. Texts another
+            # worker stored in the meantime keep that worker's row, which lookup() now returns.
+            self.disk_cache.add([keys[i] for i in missing], embeddings.numpy())
+            rows = self.disk_cache.lookup(keys)
+        return torch.from_numpy(np.ascontiguousarray(self.disk_cache.get(rows)))
+
+    def __iter__(self):
+        """Yield embedding batches (with label batches if a label column is set) on CPU"""
+        worker = get_worker_info()
+        for chunk_id, (texts, labels) in enumerate(self.iter_chunks()):
+            if worker is not None and chunk_id % worker.num_workers != worker.id:
+                continue
+            embeddings = self._embed_chunk(texts)
+            order = torch.randperm(len(texts)) if self.shuffle else torch.arange(len(texts))
+            labels = torch.from_numpy(labels) if labels is not None else None
+            for start in range(0, len(texts), self.batch_size):
+                batch_indices = order[start:start + self.batch_size]
+                if labels is not None:
+                    yield embeddings[batch_indices], labels[batch_indices]
+                else:
+                    yield embeddings[batch_indices]
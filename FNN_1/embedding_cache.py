@@ -0,0 +1,405 @@
+import hashlib
+import json
+import os
+import unicodedata
+
+import numpy as np
+import torch
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def normalize_text(text):
+    """Normalize unicode form and whitespace so trivially different copies of a text share a key"""
+    return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+
+def text_hash(text):
+    """Return a 16 byte digest of the normalized text"""
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).digest()
+
+
+class _FileLock(object):
+    """Exclusive inter-process lock held on a lock file for the duration of a with block"""
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
+
+
+class DiskEmbeddingCache(object):
+    """
+    Persistent embedding cache backed by a memory-mapped float32 array.
+
+    One sub-directory is kept per encoder config (bert_model, max_length, pooling, int8). Inside it
+    `embeddings.f32` holds one row per text and `keys.bin` holds the 16 byte text hash of each
+    row in the same order. Both files are append-only; `meta.json` records how many rows are
+    committed, so a write interrupted half-way is discarded on the next open.
+
+    Several processes may share a cache directory: appends hold a file lock, and inside it the
+    rows committed by other processes are read in first and new row ids continue from the row
+    count on disk. Rows added by other processes become visible to lookup() after the next add().
+
+    Args:
+        cache_dir: Root directory shared by all encoder configs
+        bert_model: Pre-trained BERT model name the embeddings come from
+        max_length: Maximum sequence length used by the tokenizer
+        pooling: Pooling used to turn hidden states into one vector ('cls' or 'mean')
+        quantized: Whether the embeddings come from a dynamically int8-quantized encoder
+    """
+    KEY_SIZE = 16
+
+    def __init__(self, cache_dir, bert_model, max_length, pooling="cls", quantized=False):
+        self.config = {"bert_model": bert_model, "max_length": int(max_length), "pooling": pooling}
+        if quantized:
+            # Only added when set, so existing fp32 caches keep their directory
+            self.config["quantized"] = True
+        config_key = hashlib.blake2b(json.dumps(self.config, sort_keys=True).encode("utf-8"),
+                                     digest_size=8).hexdigest()
+        self.path = os.path.join(cache_dir, config_key)
+        os.makedirs(self.path, exist_ok=True)
+
+        self._meta_path = os.path.join(self.path, "meta.json")
+        self._keys_path = os.path.join(self.path, "keys.bin")
+        self._data_path = os.path.join(self.path, "embeddings.f32")
+        self._lock_path = os.path.join(self.path, "lock")
+
+        self.hidden_size = None
+        self.n_rows = 0
+        self._index = {}
+        self._data = None
+        self._load()
+
+    def _load(self):
+        """Read the committed rows and map the embedding file"""
+        with _FileLock(self._lock_path):
+            self._sync()
+
+    def _sync(self):
+        """
+        Catch up with the files on disk; must be called with the lock held.
+        Anything written after the last commit (an interrupted write) is dropped, then the keys
+        of rows this process has not seen yet are added to the index. The row count is taken
+        from the size of the keys file, so it includes rows committed by other processes.
+        """
+        if not os.path.exists(self._meta_path):
+            # Nothing was ever committed, discard partial writes
+            for path in (self._keys_path, self._data_path):
+                if os.path.exists(path):
+                    os.truncate(path, 0)
+            return
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        self.hidden_size = meta["hidden_size"]
+
+        # Drop anything written after the last commit
+        os.truncate(self._keys_path, meta["n_rows"] * self.KEY_SIZE)
+        os.truncate(self._data_path, meta["n_rows"] * self.hidden_size * 4)
+
+        n_rows = os.path.getsize(self._keys_path) // self.KEY_SIZE
+        if n_rows > self.n_rows:
+            with open(self._keys_path, "rb") as f:
+                f.seek(self.n_rows * self.KEY_SIZE)
+                keys = f.read((n_rows - self.n_rows) * self.KEY_SIZE)
+            for i in range(n_rows - self.n_rows):
+                self._index.setdefault(keys[i * self.KEY_SIZE:(i + 1) * self.KEY_SIZE], self.n_rows + i)
+            self.n_rows = n_rows
+        self._map()
+
+    def _map(self):
+        """(Re)map the embedding file; copy-on-write so callers get writable zero-copy views"""
+        if self.n_rows == 0:
+            self._data = None
+            return
+        self._data = np.memmap(self._data_path, dtype=np.float32, mode="c",
+                               shape=(self.n_rows, self.hidden_size))
+
+    def _commit(self):
+        meta = dict(self.config, hidden_size=self.hidden_size, n_rows=self.n_rows)
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def lookup(self, keys):
+        """
+        Find the rows stored for a sequence of text hashes
+
+        Returns:
+            numpy int64 array of row ids, -1 where the text is not cached
+        """
+        return np.array([self._index.get(key, -1) for key in keys], dtype=np.int64)
+
+    def get(self, rows):
+        """Return the embeddings for row ids (a single row is a zero-copy view of the mapped file)"""
+        return self._data[rows]
+
+    def add(self, keys, embeddings):
+        """
+        Append embeddings for text hashes that are not stored yet and commit them
+
+        Args:
+            keys: Sequence of text hashes, one per embedding row
+            embeddings: Array-like of shape (len(keys), hidden_size)
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with _FileLock(self._lock_path):
+            # Other processes may have appended since this one last looked
+            self._sync()
+            if self.hidden_size is None:
+                self.hidden_size = embeddings.shape[1]
+            elif embeddings.shape[1] != self.hidden_size:
+                raise ValueError(f"Embedding size {embeddings.shape[1]} does not match cache size {self.hidden_size}")
+
+            new_keys = []
+            new_rows = []
+            pending = set()
+            for i, key in enumerate(keys):
+                if key not in self._index and key not in pending:
+                    pending.add(key)
+                    new_keys.append(key)
+                    new_rows.append(i)
+            if not new_keys:
+                return
+
+            with open(self._data_path, "ab") as f:
+                f.write(embeddings[new_rows].tobytes())
+            with open(self._keys_path, "ab") as f:
+                f.write(b"".join(new_keys))
+            for offset, key in enumerate(new_keys):
+                self._index[key] = self.n_rows + offset
+            self.n_rows += len(new_keys)
+            self._commit()
+            self._map()
+
+
+STORAGE_DTYPES = ("float32", "float16", "bfloat16", "int8")
+
+
+class QuantizedEmbeddings(object):
+    """
+    Embeddings stored as int8 codes with one float32 scale per row.
+
+    Indexing decodes only the selected rows to float32, so a batch is upcast when it is
+    used while the full matrix stays at one byte per value. `take()` selects rows
+    without decoding them.
+    """
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, x):
+        """Symmetric per-row int8 quantization of a float tensor"""
+        x = x.float()
+        scales = x.abs().amax(dim=1).clamp(min=1e-12) / 127.0
+        codes = torch.round(x / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+        return cls(codes, scales)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def device(self):
+        return self.codes.device
+
+    def size(self, dim=None):
+        return self.codes.size() if dim is None else self.codes.size(dim)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def to(self, device):
+        return QuantizedEmbeddings(self.codes.to(device), self.scales.to(device))
+
+    def take(self, rows):
+        return QuantizedEmbeddings(self.codes[rows], self.scales[rows])
+
+    def __getitem__(self, rows):
+        return self.codes[rows].float() * self.scales[rows].unsqueeze(-1)
+
+    def float(self):
+        return self[:]
+
+
+def pack_embeddings(x, dtype="float32"):
+    """
+    Convert float embeddings to a storage dtype
+
+    Args:
+        x: Float tensor of shape (n, hidden_size)
+        dtype: One of 'float32', 'float16', 'bfloat16' or 'int8' (per-row scaled)
+
+    Returns:
+        Tensor of the storage dtype, or QuantizedEmbeddings for 'int8'
+    """
+    if dtype == "int8":
+        return QuantizedEmbeddings.quantize(x)
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"storage dtype must be one of {STORAGE_DTYPES}")
+    return x.to(getattr(torch, dtype))
+
+
+def take_rows(data, rows):
+    """Select rows of packed embeddings without upcasting them"""
+    return data.take(rows) if isinstance(data, QuantizedEmbeddings) else data[rows]
+
+
+def storage_nbytes(data):
+    if isinstance(data, QuantizedEmbeddings):
+        return data.codes.numel() * data.codes.element_size() + data.scales.numel() * data.scales.element_size()
+    return data.numel() * data.element_size()
+
+
+def storage_report(x, predict_fn, reconstruct_fn, dtypes=STORAGE_DTYPES, sample_size=10000):
+    """
+    Measure what each embedding storage dtype does to reconstruction and predictions
+
+    Every dtype is applied to the same sample, decoded back to float32 and fed to the model;
+    cluster and sentiment predictions are compared with the float32 ones.
+
+    Args:
+        x: float32 embeddings tensor of shape (n, hidden_size)
+        predict_fn: Callable mapping a float32 tensor to (cluster ids, sentiment ids)
+        reconstruct_fn: Callable mapping a float32 tensor to its autoencoder reconstruction
+        dtypes: Storage dtypes to compare
+        sample_size: Number of random rows used
+
+    Returns:
+        pandas DataFrame with one row per dtype
+    """
+    import pandas as pd
+
+    x = torch.as_tensor(x).float().cpu()
+    if len(x) > sample_size:
+        x = x[torch.randperm(len(x))[:sample_size]]
+    clusters_ref, sentiment_ref = predict_fn(x)
+
+    rows = []
+    for dtype in dtypes:
+        packed = pack_embeddings(x, dtype)
+        decoded = packed.float()
+        reconstruction = torch.as_tensor(np.asarray(reconstruct_fn(decoded))).float()
+        clusters, sentiment = predict_fn(decoded)
+        rows.append({
+            'dtype': dtype,
+            'bytes_per_row': storage_nbytes(packed) / len(x),
+            'embedding_rel_error': float(((decoded - x).norm(dim=1) / x.norm(dim=1).clamp(min=1e-12)).mean()),
+            'reconstruction_mse': float(torch.mean((reconstruction - decoded) ** 2)),
+            'cluster_agreement': float(np.mean(np.asarray(clusters) == np.asarray(clusters_ref))),
+            'sentiment_agreement': float(np.mean(np.asarray(sentiment) == np.asarray(sentiment_ref))),
+        })
+
+    df_report = pd.DataFrame(rows)
+    print("\n============ EMBEDDING STORAGE MODES ============")
+    print(df_report)
+    return df_report
+
+
+class EmbeddingStore(object):
+    """
+    Preallocated contiguous embedding matrix with a filled-row bitmap.
+
+    Rows are written in place into one `(n_rows, hidden_size)` matrix of the storage dtype
+    that is allocated once the hidden size is known, so reading the whole store is a view
+    rather than a stack of per-row tensors. Rows are upcast to float32 only when read
+    through `get()`.
+
+    With `shared=True` the matrix and the bitmap are allocated up front in shared memory,
+    so DataLoader worker processes (forked or spawned) all write to and read from the same
+    store. A row is written before its filled flag is set, so readers never need a lock;
+    two workers missing the same row at the same moment both write identical values.
+
+    Args:
+        n_rows: Number of rows to reserve
+        dtype: Storage dtype, one of 'float32', 'float16', 'bfloat16' or 'int8' (per-row scaled)
+        hidden_size: Embedding size; required with shared=True, otherwise taken from the first write
+        shared: Allocate the store in shared memory for use across processes
+    """
+    def __init__(self, n_rows, dtype="float32", hidden_size=None, shared=False):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"storage dtype must be one of {STORAGE_DTYPES}")
+        if shared and hidden_size is None:
+            raise ValueError("hidden_size is required for a shared embedding store")
+        self.n_rows = n_rows
+        self.dtype = dtype
+        self.shared = shared
+        self.data = None
+        self.filled = torch.zeros(n_rows, dtype=torch.bool)
+        if hidden_size is not None:
+            self._allocate(hidden_size)
+        if shared:
+            self.filled.share_memory_()
+
+    @property
+    def hidden_size(self):
+        return None if self.data is None else self.data.shape[1]
+
+    def _allocate(self, hidden_size):
+        if self.dtype == "int8":
+            self.data = QuantizedEmbeddings(torch.empty((self.n_rows, hidden_size), dtype=torch.int8),
+                                            torch.empty(self.n_rows, dtype=torch.float32))
+        else:
+            self.data = torch.empty((self.n_rows, hidden_size), dtype=getattr(torch, self.dtype))
+        if self.shared:
+            for tensor in ((self.data.codes, self.data.scales) if self.dtype == "int8" else (self.data,)):
+                tensor.share_memory_()
+
+    def put(self, rows, embeddings):
+        """Write embeddings (shape `(len(rows), hidden_size)`) into the given rows"""
+        embeddings = torch.as_tensor(embeddings).cpu()
+        if self.data is None:
+            self._allocate(embeddings.shape[-1])
+        rows = torch.as_tensor(rows, dtype=torch.long)
+        packed = pack_embeddings(embeddings, self.dtype)
+        if isinstance(packed, QuantizedEmbeddings):
+            self.data.codes[rows] = packed.codes
+            self.data.scales[rows] = packed.scales
+        else:
+            self.data[rows] = packed
+        # Row data first, then the flag: readers in other processes only see complete rows
+        self.filled[rows] = True
+
+    def get(self, rows):
+        """Return the embeddings of the given rows as float32 (a single float32 row is a view)"""
+        return self.data[rows].float()
+
+    def missing_rows(self):
+        """Row ids that have not been written yet, as a list"""
+        return torch.nonzero(~self.filled).flatten().tolist()
+
+    def is_filled(self, row):
+        return bool(self.filled[row])
+
+    def all_filled(self):
+        return bool(self.filled.all())
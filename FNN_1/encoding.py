@@ -0,0 +1,331 @@
+import copy
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from .embedding_cache import text_hash
+from .registry import get_encoder
+
+
+def length_buckets(lengths, batch_size=64, token_budget=8192):
+    """
+    Group sequence indices into batches of similar length
+
+    Indices are sorted by length and a batch is closed as soon as adding the next
+    sequence would push `rows * longest_length` over the token budget or the row
+    count over `batch_size`, so short texts share large batches and long texts small ones.
+
+    Args:
+        lengths: Token length of each sequence
+        batch_size: Maximum number of sequences per batch
+        token_budget: Maximum number of (padded) tokens per batch
+
+    Returns:
+        List of index lists, each sorted by increasing length
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = []
+    current = []
+    for i in order:
+        # Sorted ascending, so the new sequence is the longest in the bucket
+        if current and (len(current) >= batch_size or (len(current) + 1) * lengths[i] > token_budget):
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def pad_batch(sequences, pad_token_id=0):
+    """Pad token id lists to the longest member and build the attention mask"""
+    longest = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), longest), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), longest), dtype=torch.long)
+    for row, seq in enumerate(sequences):
+        input_ids[row, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+        attention_mask[row, :len(seq)] = 1
+    return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+def pool_hidden_state(last_hidden_state, attention_mask, pooling="cls"):
+    """Turn the last hidden state into one vector per sequence"""
+    if pooling == "mean":
+        mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+        return (last_hidden_state * mask).sum(1) / mask.sum(1).clamp(min=1)
+    # Clone so callers keeping the rows do not keep the full hidden state alive
+    return last_hidden_state[:, 0, :].clone()
+
+
+def deduplicate_texts(texts):
+    """
+    Collapse repeated texts by normalized text hash
+
+    Returns:
+        tuple: (list of distinct texts in first-seen order,
+            numpy int32 array mapping every input position to its distinct text)
+    """
+    unique = []
+    row_of_hash = {}
+    inverse = np.empty(len(texts), dtype=np.int32)
+    for i, text in enumerate(texts):
+        key = text_hash(text)
+        row = row_of_hash.get(key)
+        if row is None:
+            row = row_of_hash[key] = len(unique)
+            unique.append(text)
+        inverse[i] = row
+    return unique, inverse
+
+
+def encode_texts(texts, tokenizer, model, max_length=128, pooling="cls", batch_size=64, token_budget=8192,
+                 deduplicate=False):
+    """
+    Encode texts with BERT using length-bucketed batches and dynamic padding
+
+    Every bucket is padded only to its own longest member instead of `max_length`,
+    so short texts do not pay attention FLOPs for pad tokens.
+
+    Args:
+        texts: List of text strings
+        tokenizer: Hugging Face tokenizer matching the model
+        model: Hugging Face encoder model
+        max_length: Texts are truncated to this many tokens
+        pooling: 'cls' (first token) or 'mean' (masked mean)
+        batch_size: Maximum number of texts per forward pass
+        token_budget: Maximum number of padded tokens per forward pass
+        deduplicate: Encode each distinct (normalized) text only once
+
+    Returns:
+        float32 tensor of shape (len(texts), hidden_size) on CPU, in the order of `texts`
+    """
+    texts = list(texts)
+    if deduplicate:
+        unique, inverse = deduplicate_texts(texts)
+        if len(unique) < len(texts):
+            embeddings = encode_texts(unique, tokenizer, model, max_length, pooling, batch_size, token_budget)
+            return embeddings[torch.from_numpy(inverse).long()]
+    if not texts:
+        return torch.empty((0, model.config.hidden_size), dtype=torch.float32)
+
+    model_device = next(model.parameters()).device
+    embeddings = None
+    with torch.no_grad():
+        for bucket, inputs in tokenize_buckets(texts, tokenizer, max_length, batch_size, token_budget):
+            pooled = forward_pooled(model, inputs, pooling, model_device)
+            if embeddings is None:
+                embeddings = torch.empty((len(texts), pooled.shape[1]), dtype=torch.float32)
+            # Scatter back to the original order
+            embeddings[bucket] = pooled
+    return embeddings
+
+
+def tokenize_buckets(texts, tokenizer, max_length=128, batch_size=64, token_budget=8192):
+    """
+    Tokenize texts without padding and return dynamically padded, length-bucketed batches
+
+    Returns:
+        List of (index tensor into `texts`, model inputs dict) pairs
+    """
+    encoded = tokenizer(texts, truncation=True, max_length=max_length, padding=False)['input_ids']
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    return [(torch.tensor(bucket), pad_batch([encoded[i] for i in bucket], pad_token_id))
+            for bucket in length_buckets([len(ids) for ids in encoded], batch_size, token_budget)]
+
+
+def forward_pooled(model, inputs, pooling="cls", model_device=None):
+    """Run the encoder on one padded batch and return pooled float32 vectors on CPU"""
+    if model_device is not None:
+        inputs = {k: v.to(model_device) for k, v in inputs.items()}
+    outputs = model(**inputs)
+    return pool_hidden_state(outputs.last_hidden_state, inputs['attention_mask'], pooling).float().cpu()
+
+
+class EncodingPipeline(object):
+    """
+    Producer/consumer embedding pipeline.
+
+    Worker threads tokenize chunks of texts with the (fast, GIL-releasing) tokenizer,
+    bucket and pad them, and feed a bounded queue; the calling thread consumes padded
+    batches and runs the model forward pass. Tokenization of later chunks therefore
+    overlaps with encoding of earlier ones. Throughput per stage is accumulated in `stats`.
+
+    Args:
+        tokenizer: Hugging Face fast tokenizer matching the model
+        model: Hugging Face encoder model
+        max_length: Texts are truncated to this many tokens
+        pooling: 'cls' (first token) or 'mean' (masked mean)
+        batch_size: Maximum number of texts per forward pass
+        token_budget: Maximum number of padded tokens per forward pass
+        num_workers: Number of tokenizer threads
+        queue_size: Maximum number of padded batches waiting for the model
+        chunk_size: Number of texts tokenized (and length-bucketed) per work item
+    """
+    def __init__(self, tokenizer, model, max_length=128, pooling="cls", batch_size=64, token_budget=8192,
+                 num_workers=2, queue_size=8, chunk_size=1024):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_length = max_length
+        self.pooling = pooling
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.num_workers = max(1, num_workers)
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self._tokenizers = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._docs = 0
+        self._tokenize_seconds = 0.0
+        self._encode_seconds = 0.0
+        self._wait_seconds = 0.0
+        self._wall_seconds = 0.0
+
+    @property
+    def stats(self):
+        """
+        Throughput since the last reset_stats()
+
+        Returns:
+            dict with docs/sec of a tokenizer thread, docs/sec of the forward pass
+            (busy time only), end-to-end docs/sec, and seconds the model waited on the queue
+        """
+        return {
+            'docs': self._docs,
+            'tokenize_docs_per_sec': self._docs / self._tokenize_seconds if self._tokenize_seconds else 0.0,
+            'encode_docs_per_sec': self._docs / self._encode_seconds if self._encode_seconds else 0.0,
+            'wall_docs_per_sec': self._docs / self._wall_seconds if self._wall_seconds else 0.0,
+            'encode_wait_seconds': self._wait_seconds,
+        }
+
+    def _worker_tokenizers(self):
+        # Fast tokenizers must not be called from several threads at once, so each worker gets a copy
+        if len(self._tokenizers) != self.num_workers:
+            self._tokenizers = [copy.deepcopy(self.tokenizer) for _ in range(self.num_workers)]
+        return self._tokenizers
+
+    def _produce(self, tokenizer, texts, chunk_starts, batches, lock, stop):
+        try:
+            while not stop.is_set():
+                with lock:
+                    start = next(chunk_starts, None)
+                if start is None:
+                    break
+                started = time.perf_counter()
+                chunk = tokenize_buckets(texts[start:start + self.chunk_size], tokenizer, self.max_length,
+                                         self.batch_size, self.token_budget)
+                with lock:
+                    self._tokenize_seconds += time.perf_counter() - started
+                for bucket, inputs in chunk:
+                    batches.put((bucket + start, inputs))
+        except Exception as e:
+            batches.put(e)
+        finally:
+            batches.put(None)
+
+    def encode(self, texts):
+        """
+        Encode texts and return float32 embeddings of shape (len(texts), hidden_size) on CPU, in input order
+        """
+        texts = list(texts)
+        if not texts:
+            return torch.empty((0, self.model.config.hidden_size), dtype=torch.float32)
+
+        started = time.perf_counter()
+        batches = queue.Queue(maxsize=self.queue_size)
+        chunk_starts = iter(range(0, len(texts), self.chunk_size))
+        lock = threading.Lock()
+        stop = threading.Event()
+        model_device = next(self.model.parameters()).device
+        embeddings = None
+        finished = 0
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            for tokenizer in self._worker_tokenizers():
+                pool.submit(self._produce, tokenizer, texts, chunk_starts, batches, lock, stop)
+
+            try:
+                with torch.no_grad():
+                    while finished < self.num_workers:
+                        waited = time.perf_counter()
+                        item = batches.get()
+                        self._wait_seconds += time.perf_counter() - waited
+                        if item is None:
+                            finished += 1
+                            continue
+                        if isinstance(item, Exception):
+                            raise item
+
+                        bucket, inputs = item
+                        encode_started = time.perf_counter()
+                        pooled = forward_pooled(self.model, inputs, self.pooling, model_device)
+                        self._encode_seconds += time.perf_counter() - encode_started
+                        if embeddings is None:
+                            embeddings = torch.empty((len(texts), pooled.shape[1]), dtype=torch.float32)
+                        embeddings[bucket] = pooled
+            finally:
+                # Unblock the producers before the pool shuts down
+                stop.set()
+                while finished < self.num_workers:
+                    finished += batches.get() is None
+
+        self._docs += len(texts)
+        self._wall_seconds += time.perf_counter() - started
+        return embeddings
+
+
+def quantization_report(texts, bert_model, max_length=128, pooling="cls", predict_fn=None):
+    """
+    Measure how far int8 dynamic quantization moves BERT embeddings and downstream predictions
+
+    Both the fp32 and the quantized encoder run on CPU over the same sample of texts.
+
+    Args:
+        texts: Sample of text strings
+        bert_model: Pre-trained BERT model name
+        max_length: Texts are truncated to this many tokens
+        pooling: 'cls' (first token) or 'mean' (masked mean)
+        predict_fn: Optional callable mapping an embedding array to (cluster ids, sentiment ids)
+
+    Returns:
+        dict with cosine similarity / relative L2 error statistics of the embeddings,
+        docs/sec for both encoders and, if predict_fn is given, cluster and sentiment agreement
+    """
+    texts = list(texts)
+    embeddings = {}
+    docs_per_sec = {}
+    for quantize in (False, True):
+        tokenizer, model = get_encoder(bert_model, "cpu", quantize=quantize)
+        started = time.perf_counter()
+        embeddings[quantize] = encode_texts(texts, tokenizer, model, max_length=max_length, pooling=pooling)
+        docs_per_sec[quantize] = len(texts) / max(time.perf_counter() - started, 1e-9)
+
+    fp32, int8 = embeddings[False], embeddings[True]
+    cosine = torch.nn.functional.cosine_similarity(fp32, int8, dim=1)
+    relative_error = (fp32 - int8).norm(dim=1) / fp32.norm(dim=1).clamp(min=1e-12)
+    report = {
+        'n_samples': len(texts),
+        'cosine_mean': float(cosine.mean()),
+        'cosine_min': float(cosine.min()),
+        'relative_l2_mean': float(relative_error.mean()),
+        'relative_l2_max': float(relative_error.max()),
+        'fp32_docs_per_sec': docs_per_sec[False],
+        'int8_docs_per_sec': docs_per_sec[True],
+        'speedup': docs_per_sec[True] / docs_per_sec[False],
+    }
+
+    if predict_fn is not None:
+        clusters_fp32, sentiment_fp32 = predict_fn(fp32.numpy())
+        clusters_int8, sentiment_int8 = predict_fn(int8.numpy())
+        report['cluster_agreement'] = float(np.mean(np.asarray(clusters_fp32) == np.asarray(clusters_int8)))
+        report['sentiment_agreement'] = float(np.mean(np.asarray(sentiment_fp32) == np.asarray(sentiment_int8)))
+
+    print("\n=========== INT8 QUANTIZATION DRIFT ===========")
+    for name, value in report.items():
+        print(f"{name}: {value:.4f}" if isinstance(value, float) else f"{name}: {value}")
+    return report
@@ -3,21 +3,53 @@ import numpy as np
 from keras.models import Model
 from keras.optimizers import SGD
 from keras.layers import Dense, BatchNormalization, Dropout, Activation
+from keras.losses import CategoricalCrossentropy, KLDivergence
+from keras.utils import Sequence
 import keras.backend as K
+import tensorflow as tf
 
-from sklearn.cluster import KMeans
 from sklearn import metrics
 from sklearn.utils.class_weight import compute_class_weight
 
-from transformers import AutoTokenizer, AutoModel
 from collections import Counter
+from itertools import islice
 import pandas as pd 
 
-from .DEC import cluster_acc, ClusteringLayer, autoencoder
+from .DEC import (cluster_acc, ClusteringLayer, autoencoder, allocate_target_buffer, nearest_cluster,
+                  target_distribution_inplace)
+from .centroid_index import CentroidIndex
+from .checkpoints import CheckpointWriter, load_checkpoint, resolve_checkpoint
+from .embedding_cache import STORAGE_DTYPES, storage_report, text_hash
+from .encoding import encode_texts, quantization_report
+from .kmeans_init import KMEANS_INIT_METHODS, init_centers, init_report
+from .label_changes import LabelChanges
+from .predictions import (PredictionCache, concat_columns, encoder_name, format_predictions, prediction_columns,
+                          weights_fingerprint)
+from .registry import get_encoder, get_tokenizer
 import torch
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")   
 
+class _UpcastSequence(Sequence):
+    """Feeds (x, x) autoencoder batches from reduced-precision storage, upcast one batch at a time"""
+    def __init__(self, x, batch_size, shuffle=True):
+        super(_UpcastSequence, self).__init__()
+        self.x = x
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = torch.randperm(len(x)) if shuffle else torch.arange(len(x))
+
+    def __len__(self):
+        return (len(self.x) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, i):
+        batch = self.x[self.order[i * self.batch_size:(i + 1) * self.batch_size]].float().numpy()
+        return batch, batch
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.order = torch.randperm(len(self.x))
+
 class FNN(object):
     def __init__(self,
                  dims,
@@ -37,6 +69,14 @@ class FNN(object):
         self.autoencoder = autoencoder(self.dims)
         self.class_labels = {0: 'negative', 1: 'positive'}
         self.stop_words = set()
+        self._feature_model = None
+        self._sub_models = {}
+        self.prediction_cache = None
+        self.assignment_index = None
+        self._fingerprint = None
+        self.loss_weights = None
+        self._train_function = None
+        self._predict_function = None
 
     def initialize_model(self, ae_weights=None, gamma=0.1, eta=1.0, optimizer=SGD(learning_rate=0.001, momentum=0.9)):
         if ae_weights is not None:
@@ -73,6 +113,12 @@ class FNN(object):
         # Create the combined model
         self.model = Model(inputs=self.autoencoder.input,
                           outputs=[clustering_layer, sentiment_output])
+        self._feature_model = None
+        self._sub_models = {}
+        self._train_function = None
+        self._predict_function = None
+        self.loss_weights = (gamma, eta)
+        self._weights_changed()
         
         # Compile with multiple losses
         self.model.compile(loss={'clustering': 'kld', 'sentiment': 'categorical_crossentropy'},
@@ -81,46 +127,272 @@ class FNN(object):
 
     def load_weights(self, weights_path):
         self.model.load_weights(weights_path)
+        self._weights_changed()
 
     def extract_feature(self, x):
         encoder = Model(self.model.input, self.model.get_layer('encoder_%d' % (self.n_stacks - 1)).output)
         return encoder.predict(x)
 
+    def predict_heads(self, x, heads='both'):
+        """
+        Predict hard labels from the requested heads only
+
+        Args:
+            x: Input features as numpy array
+            heads: 'cluster', 'sentiment' or 'both' (both heads in one pass over the shared encoder)
+
+        Returns:
+            Cluster ids, sentiment ids, or a (cluster ids, sentiment ids) tuple for 'both'
+        """
+        assignment_index = self._assignment_index()
+        if heads == 'both' and assignment_index is not None:
+            # Bottleneck and sentiment in one pass; clusters come from the approximate index
+            features, s = self._sub_model('encoder_%d' % (self.n_stacks - 1), 'sentiment').predict(x, verbose=0)
+            return assignment_index.query(features), s.argmax(1)
+        if heads == 'both':
+            q, s = self.model.predict(x, verbose=0)
+            return q.argmax(1), s.argmax(1)
+        if heads == 'cluster':
+            # Encoder only; argmax of q is the nearest center, so the t-kernel and normalization are skipped
+            features = self.encoder.predict(x, verbose=0)
+            if assignment_index is not None:
+                return assignment_index.query(features)
+            return nearest_cluster(features, self.model.get_layer(name='clustering').get_weights()[0])
+        if heads == 'sentiment':
+            # The clustering branch is not part of this sub-model
+            return self._sub_model('sentiment').predict(x, verbose=0).argmax(1)
+        raise ValueError("heads must be 'cluster', 'sentiment' or 'both'")
+
+    def _sub_model(self, *layer_names):
+        """Keras model computing only the outputs of the named layers, built once per weights"""
+        if layer_names not in self._sub_models:
+            outputs = [self.model.get_layer(name).output for name in layer_names]
+            self._sub_models[layer_names] = Model(self.model.input, outputs if len(outputs) > 1 else outputs[0])
+        return self._sub_models[layer_names]
+
+    def build_assignment_index(self, n_lists=None, n_probe=4, x=None):
+        """
+        Build an approximate nearest-center index over the cluster centers for hard assignments
+
+        Once built, predict_clusters, get_cluster_assignments and predict_heads answer cluster
+        assignments from the index. It is dropped whenever the weights change.
+
+        Args:
+            n_lists: Number of coarse lists, defaults to sqrt(n_clusters)
+            n_probe: Number of coarse lists searched per query
+            x: Optional sample inputs used to report recall against exact assignment
+
+        Returns:
+            CentroidIndex
+        """
+        centers = self.model.get_layer(name='clustering').get_weights()[0]
+        self.assignment_index = CentroidIndex(centers, n_lists=n_lists, n_probe=n_probe)
+        print(f"Built assignment index: {len(centers)} clusters in {self.assignment_index.n_lists} lists, "
+              f"n_probe={self.assignment_index.n_probe}")
+        if x is not None:
+            recall = self.assignment_index.recall(self.encoder.predict(x, verbose=0))
+            print(f"Assignment index recall vs exact assignment: {recall:.4f}")
+        return self.assignment_index
+
+    def drop_assignment_index(self):
+        self.assignment_index = None
+
+    def _assignment_index(self):
+        """The assignment index, dropped first if the cluster centers changed since it was built"""
+        if self.assignment_index is not None and not np.array_equal(
+                self.assignment_index.centers, self.model.get_layer(name='clustering').get_weights()[0]):
+            self.assignment_index = None
+        return self.assignment_index
+
     def predict_clusters(self, x):
-        q, _ = self.model.predict(x, verbose=0)
-        return q.argmax(1)
+        return self.predict_heads(x, 'cluster')
         
     def predict_sentiment(self, x):
-        _, s = self.model.predict(x, verbose=0)
-        return s.argmax(1)
+        return self.predict_heads(x, 'sentiment')
+
+    def _text_encoder(self, bert_model=None, quantize=False):
+        """Resolve (tokenizer, encoder) for text inputs through the process-wide registry"""
+        if callable(bert_model):
+            # A loaded encoder was passed in, only the tokenizer comes from the registry
+            return get_tokenizer("indolem/indobert-base-uncased"), bert_model
+        # Loaded once per process and shared across calls
+        return get_encoder(bert_model if isinstance(bert_model, str) else "indolem/indobert-base-uncased",
+                           "cpu" if quantize else device, quantize=quantize)
+
+    def _predict_outputs(self, embeddings_numpy, return_features=False):
+        """Run the model on a block of embeddings, returns (cluster_probs, sentiment_probs, features or None)"""
+        if return_features:
+            if self._feature_model is None:
+                # One pass for both heads and the bottleneck
+                bottleneck = self.model.get_layer('encoder_%d' % (self.n_stacks - 1)).output
+                self._feature_model = Model(self.model.input, self.model.outputs + [bottleneck])
+            return tuple(self._feature_model.predict(embeddings_numpy, verbose=0))
+        cluster_output, sentiment_output = self.model.predict(embeddings_numpy, verbose=0)
+        return cluster_output, sentiment_output, None
+
+    def _predict_columns(self, embeddings_numpy, return_probs=False, top_k=0, return_features=False):
+        """Run the model on a block of embeddings and return column arrays (see prediction_columns)"""
+        cluster_output, sentiment_output, features = self._predict_outputs(embeddings_numpy, return_features)
+        return prediction_columns(cluster_output, sentiment_output, self.class_labels, return_probs=return_probs,
+                                  top_k=top_k, features=features)
+
+    def enable_prediction_cache(self, max_entries=100000, max_bytes=None):
+        """
+        Cache text predictions in a size-bounded LRU keyed by normalized text and model fingerprint
+
+        The cache is cleared whenever the weights change (load_weights, initialize_model, training).
+
+        Args:
+            max_entries: Maximum number of cached texts, None for no limit
+            max_bytes: Maximum memory used by cached outputs, None for no limit
+
+        Returns:
+            PredictionCache: exposes hits, misses, evictions and stats()
+        """
+        self.prediction_cache = PredictionCache(max_entries, max_bytes)
+        return self.prediction_cache
+
+    def disable_prediction_cache(self):
+        self.prediction_cache = None
+
+    def _weights_changed(self):
+        """Invalidate the model fingerprint, everything cached under it and the assignment index"""
+        self._fingerprint = None
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear()
+        self.assignment_index = None
+
+    def _model_fingerprint(self):
+        """
+        Digest of the current weights. Keras variables carry no version, so the weights are hashed
+        on every call; this also catches model.set_weights()/load_weights() made by the caller
+        """
+        fingerprint = weights_fingerprint(self.model.get_weights())
+        if fingerprint != self._fingerprint:
+            if self._fingerprint is not None and self.prediction_cache is not None:
+                # Entries of the previous weights can no longer be hit
+                self.prediction_cache.clear()
+            self._fingerprint = fingerprint
+        return fingerprint
+
+    def _cached_columns(self, texts, tokenizer, encoder, quantize, max_length, return_probs, top_k, return_features):
+        """Predict one chunk, running BERT and the model only on texts missing from the prediction cache"""
+        prefix = (self._model_fingerprint(),) + encoder_name(encoder, quantize, max_length)
+        keys = [prefix + (text_hash(text),) for text in texts]
+        entries = self.prediction_cache.lookup(keys, features=return_features)
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if missing:
+            embeddings_numpy = encode_texts([texts[i] for i in missing], tokenizer, encoder, max_length=max_length,
+                                            deduplicate=True).numpy()
+            outputs = self._predict_outputs(embeddings_numpy, return_features)
+            self.prediction_cache.add([keys[i] for i in missing], *outputs)
+            for j, i in enumerate(missing):
+                entries[i] = tuple(output[j] if output is not None else None for output in outputs)
+        return prediction_columns(np.stack([entry[0] for entry in entries]), np.stack([entry[1] for entry in entries]),
+                                  self.class_labels, return_probs=return_probs, top_k=top_k,
+                                  features=np.stack([entry[2] for entry in entries]) if return_features else None)
+
+    def _iter_prediction_columns(self, texts, bert_model=None, quantize=False, chunk_size=1024, max_length=512,
+                                 return_probs=False, top_k=0, return_features=False):
+        """Encode and predict `chunk_size` texts at a time, yielding one column dict per chunk"""
+        tokenizer, encoder = self._text_encoder(bert_model, quantize)
+        texts = iter(texts)
+        while True:
+            chunk = list(islice(texts, chunk_size))
+            if not chunk:
+                break
+            if self.prediction_cache is not None:
+                yield self._cached_columns(chunk, tokenizer, encoder, quantize, max_length,
+                                           return_probs, top_k, return_features)
+                continue
+            # Repeated texts are encoded once; length-bucketed, dynamically padded, returned in input order
+            embeddings_numpy = encode_texts(chunk, tokenizer, encoder, max_length=max_length, deduplicate=True).numpy()
+            yield self._predict_columns(embeddings_numpy, return_probs, top_k, return_features)
+
+    def predict_iter(self, texts, bert_model=None, quantize=False, chunk_size=1024, max_length=512, output='records',
+                     return_probs=False, top_k=0, return_features=False):
+        """
+        Predict clusters and sentiment for a stream of texts, yielding results as each chunk completes
+
+        Only `chunk_size` texts are tokenized, encoded and held at a time, so peak memory
+        depends on the chunk size and not on the number of texts.
+
+        Args:
+            texts: Any iterable of text strings (list, generator, file lines, ...)
+            bert_model: BERT model name or loaded encoder
+            quantize: Encode texts on CPU with a dynamically int8-quantized encoder
+            chunk_size: Number of texts encoded and predicted at a time
+            max_length: Texts are truncated to this many tokens
+            output: 'records', 'numpy', 'pandas' or 'arrow' (see format_predictions)
+            return_probs: Add the probability of the predicted sentiment
+            top_k: If > 0, add the k most likely clusters and their soft assignment
+            return_features: Add the bottleneck features
 
-    def predict(self, inputs, bert_model=None):
+        Yields:
+            With output='records' one dict per text, otherwise one table per chunk, in input order
+        """
+        column_options = dict(return_probs=return_probs, top_k=top_k, return_features=return_features)
+        for columns in self._iter_prediction_columns(texts, bert_model, quantize, chunk_size, max_length,
+                                                     **column_options):
+            if output == 'records':
+                yield from format_predictions(columns, output)
+            else:
+                yield format_predictions(columns, output, self.class_labels)
+
+    def predict_batched(self, texts, bert_model=None, quantize=False, chunk_size=1024, max_length=512,
+                        output='records', return_probs=False, top_k=0, return_features=False):
+        """
+        Chunked predict over any iterable of texts, collected into one result
+
+        Args:
+            texts: Any iterable of text strings
+            bert_model: BERT model name or loaded encoder
+            quantize: Encode texts on CPU with a dynamically int8-quantized encoder
+            chunk_size: Number of texts encoded and predicted at a time
+            max_length: Texts are truncated to this many tokens
+            output: 'records', 'numpy', 'pandas' or 'arrow' (see format_predictions)
+            return_probs: Add the probability of the predicted sentiment
+            top_k: If > 0, add the k most likely clusters and their soft assignment
+            return_features: Add the bottleneck features
+
+        Returns:
+            List of {'sentiment', 'cluster'} dicts, or a dict of arrays / DataFrame / Arrow table
+        """
+        column_options = dict(return_probs=return_probs, top_k=top_k, return_features=return_features)
+        if output == 'records':
+            return list(self.predict_iter(texts, bert_model, quantize, chunk_size, max_length, **column_options))
+        parts = list(self._iter_prediction_columns(texts, bert_model, quantize, chunk_size, max_length,
+                                                   **column_options))
+        if not parts:
+            raise ValueError("No texts to predict")
+        return format_predictions(concat_columns(parts), output, self.class_labels)
+
+    def predict(self, inputs, bert_model=None, quantize=False, chunk_size=1024, output='records',
+                return_probs=False, top_k=0, return_features=False):
+        """
+        Predict clusters and sentiment for text inputs or embeddings
+
+        Args:
+            inputs: Text, list of texts, or embeddings tensor
+            bert_model: BERT model name or loaded encoder used for text inputs
+            quantize: Encode texts on CPU with a dynamically int8-quantized encoder
+            chunk_size: Texts are encoded this many at a time (see predict_iter)
+            output: 'records' (list of dicts), 'numpy' (dict of column arrays), 'pandas' (DataFrame)
+                or 'arrow' (pyarrow Table); columns are cluster, sentiment_id and sentiment
+            return_probs: Add a sentiment_prob column
+            top_k: If > 0, add cluster_topk / cluster_topk_prob columns with the k most likely clusters
+            return_features: Add the bottleneck features
+
+        Returns:
+            List of {'sentiment', 'cluster'} dicts, or a columnar table in the requested format
+        """
+        column_options = dict(return_probs=return_probs, top_k=top_k, return_features=return_features)
         if isinstance(inputs, str):
             inputs = [inputs]
 
         if isinstance(inputs, list) and isinstance(inputs[0], str):
-
-            tokenizer = AutoTokenizer.from_pretrained(bert_model if isinstance(bert_model, str) else "indolem/indobert-base-uncased")
-            tokens = tokenizer(
-                inputs,
-                padding=True,
-                truncation=True,
-                return_tensors="pt",
-                max_length=512
-            ).to(device)
-
-            with torch.no_grad():
-                if not callable(bert_model):
-                    bert_model = AutoModel.from_pretrained(bert_model if isinstance(bert_model, str) else "indolem/indobert-base-uncased")
-                    bert_model.to(device)
-                else:
-                    bert_model = AutoModel.from_pretrained("indolem/indobert-base-uncased")
-                
-                outputs = bert_model(**tokens)
-            
-            embeddings_tensor = outputs.last_hidden_state[:, 0, :]
-            embeddings_numpy = np.expand_dims(embeddings_tensor.cpu().detach().numpy(), axis=0)
-            embeddings_numpy = embeddings_numpy.squeeze(0)
+            return self.predict_batched(inputs, bert_model, quantize=quantize, chunk_size=chunk_size, output=output,
+                                        **column_options)
 
         elif isinstance(inputs, torch.Tensor):
             embeddings_tensor = inputs
@@ -129,28 +401,25 @@ class FNN(object):
         else:
             raise ValueError("Input must be a list of texts or embeddings tensor")
         
-        cluster_output, sentiment_output = self.model.predict(embeddings_numpy, verbose=0)
-        
-        # Get the predicted clusters and sentiments
-        cluster_preds = cluster_output.argmax(1)
-        sentiment_preds = sentiment_output.argmax(1)
-        # sentiment_probs = np.max(sentiment_output, axis=1)
-        
-        # Prepare results
-        results = []
-        for i in range(len(sentiment_preds)):
-            sentiment_label = self.class_labels[sentiment_preds[i]]
-            result = {
-                'sentiment': sentiment_label,
-                # 'sentiment_confidence': float(sentiment_probs[i]),
-                'cluster': int(cluster_preds[i])
-            }
-            
-            # if isinstance(inputs, list) and isinstance(inputs[0], str):
-            #     result['text'] = inputs[i]               
-            results.append(result)
-        
-        return results
+        return format_predictions(self._predict_columns(embeddings_numpy, **column_options), output,
+                                  self.class_labels)
+
+    def check_quantization(self, texts, bert_model="indolem/indobert-base-uncased", max_length=128):
+        """
+        Report how far an int8-quantized encoder drifts from fp32 on a sample of texts
+
+        Args:
+            texts: Sample of text strings
+            bert_model: BERT model name
+            max_length: Texts are truncated to this many tokens
+
+        Returns:
+            Dictionary with embedding drift, encoder throughput and cluster/sentiment agreement
+        """
+        def predict_fn(x):
+            return self.predict_heads(x)
+
+        return quantization_report(texts, bert_model, max_length=max_length, predict_fn=predict_fn)
 
     def get_cluster_assignments(self, x):
         """
@@ -164,8 +433,7 @@ class FNN(object):
         """
         x = np.expand_dims(x.cpu().detach().numpy(), axis=0) if isinstance(x, torch.Tensor) else np.expand_dims(x, axis=0)
         x = x.squeeze(0)
-        cluster_output, _ = self.model.predict(x, verbose=0)
-        return cluster_output.argmax(1)
+        return self.predict_heads(x, 'cluster')
 
     def set_stop_words(self, stop_words):
         """
@@ -251,32 +519,211 @@ class FNN(object):
         
         return df_clusters
     
-    def pretrain_autoencoder(self, dataset, batch_size=256, epochs=200, optimizer='adam'):
-        """
-        Pretrain the autoencoder using the provided PyTorch dataset
+    def _dataset_to_numpy(self, dataset, upcast=True):
         """
-        print('Pretraining autoencoder...')
-        self.autoencoder.compile(optimizer=optimizer, loss='mse')
+        Read all embeddings (and labels) of a PyTorch dataset as NumPy arrays
         
-        # Convert PyTorch dataset to numpy arrays
+        Args:
+            dataset: CachedBERTDataset or any dataset returning embeddings or (embedding, label) pairs
+            upcast: If False, reduced-precision embedding storage is returned as is (a torch tensor or
+                QuantizedEmbeddings) and upcast one batch at a time by the trainers
+            
+        Returns:
+            tuple: (embeddings array, labels array or None)
+        """
+        if not upcast and getattr(dataset, 'storage_dtype', 'float32') != 'float32':
+            data = dataset.as_tensor(upcast=False)
+            x, labels = data if isinstance(data, tuple) else (data, None)
+            return x, (labels.numpy() if labels is not None else None)
+
+        if hasattr(dataset, 'as_numpy'):
+            # Filled in batches and returned as views of the contiguous cache
+            data = dataset.as_numpy()
+            return data if isinstance(data, tuple) else (data, None)
+
         embeddings = []
-        
-        # Extract embeddings from the dataset
+        labels = []
         for i in range(len(dataset)):
             item = dataset[i]
             if isinstance(item, tuple):  # If dataset returns (embedding, label)
-                embedding, _ = item
+                embedding, label = item
                 embeddings.append(embedding.cpu().numpy())
+                labels.append(label.cpu().numpy())
             else:  # If dataset returns only embedding
                 embeddings.append(item.cpu().numpy())
+        return np.array(embeddings), (np.array(labels) if labels else None)
+    
+    @staticmethod
+    def _rows(x, start=None, stop=None):
+        """Slice rows of x as a float32 NumPy array, upcasting reduced-precision storage"""
+        batch = x[start:stop]
+        return batch.float().numpy() if isinstance(batch, torch.Tensor) else batch
+
+    def _predict_in_batches(self, model, x, chunk_size=65536):
+        """Run model.predict over x, upcasting reduced-precision storage one chunk at a time"""
+        if isinstance(x, np.ndarray):
+            return model.predict(x, verbose=0)
+        outputs = []
+        for start in range(0, len(x), chunk_size):
+            result = model.predict(self._rows(x, start, start + chunk_size), verbose=0)
+            outputs.append(result if isinstance(result, list) else [result])
+        outputs = [np.concatenate(parts, axis=0) for parts in zip(*outputs)]
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    def storage_report(self, x, dtypes=STORAGE_DTYPES, sample_size=10000):
+        """
+        Compare reconstruction loss and cluster/sentiment predictions across embedding storage dtypes
+        
+        Args:
+            x: float32 embeddings (array or tensor) or a CachedBERTDataset
+            dtypes: Storage dtypes to compare
+            sample_size: Number of random rows used
+            
+        Returns:
+            DataFrame with one row per storage dtype
+        """
+        if hasattr(x, 'as_tensor'):
+            x = x.as_tensor()
+            x = x[0] if isinstance(x, tuple) else x
+        
+        def predict_fn(batch):
+            return self.predict_heads(batch.numpy())
+        
+        def reconstruct_fn(batch):
+            return self.autoencoder.predict(batch.numpy(), verbose=0)
+        
+        return storage_report(torch.as_tensor(np.asarray(x)), predict_fn, reconstruct_fn,
+                              dtypes=dtypes, sample_size=sample_size)
+
+    def _kmeans_inputs(self, x, chunk_size=65536):
+        """Encoder feature batches over x and a gather of the features of selected rows, for kmeans_init"""
+        def batches():
+            for start in range(0, len(x), chunk_size):
+                yield self.encoder.predict(self._rows(x, start, start + chunk_size), verbose=0)
+
+        def features_at(rows):
+            selected = x[rows] if isinstance(x, np.ndarray) else x[torch.from_numpy(rows)]
+            return self._predict_in_batches(self.encoder, self._rows(selected), chunk_size)
+
+        return batches, features_at
+
+    def kmeans_init_report(self, dataset, methods=KMEANS_INIT_METHODS, **kwargs):
+        """
+        Compare cluster center initialization methods on the current encoder features
+
+        Args:
+            dataset: CachedBERTDataset instance
+            methods: Methods from KMEANS_INIT_METHODS
+            **kwargs: Passed to kmeans_init.init_centers (sample_size, n_init, n_jobs, ...)
+
+        Returns:
+            DataFrame with the time and inertia of each method and its gap to full k-means
+        """
+        x, _ = self._dataset_to_numpy(dataset, upcast=False)
+        batches, features_at = self._kmeans_inputs(x)
+        return init_report(self.n_clusters, batches, features_at, len(x), methods=methods, **kwargs)
+
+    def training_report(self, dataset, train_steps=200, steps_per_call=None, sample_size=None, random_state=0):
+        """
+        Benchmark the training step of clustering_with_sentiment: the train_on_batch loop against
+        the compiled loop (compiled=True), on the same batches, targets and class weights.
+        Both modes start from the current weights and optimizer state, which are restored afterwards.
+
+        Args:
+            dataset: CachedBERTDataset with sentiment labels
+            train_steps: Timed optimizer steps per mode, after one untimed warm-up call
+            steps_per_call: Steps per call of the compiled loop (update_interval in training),
+                defaults to train_steps
+            sample_size: Number of random rows to train on, None for all rows
+            random_state: Seed for the sample
+
+        Returns:
+            DataFrame with steps/sec of each mode and the speedup over train_on_batch
+        """
+        x, labels = self._dataset_to_numpy(dataset, upcast=False)
+        if labels is None:
+            raise ValueError("training_report needs a dataset with sentiment labels")
+        y = np.array(labels)
+        if len(y.shape) == 1:
+            from keras.utils import to_categorical
+            y = to_categorical(y, num_classes=2)
+        if sample_size is not None and sample_size < len(x):
+            rows = np.sort(np.random.RandomState(random_state).choice(len(x), sample_size, replace=False))
+            x = x[rows] if isinstance(x, np.ndarray) else x[torch.from_numpy(rows)]
+            y = y[rows]
+        x = self._rows(x)
+        sample_weights = self._sample_weights(y, self.compute_class_weights(y))
+        p, _, _ = self.compute_target(x)
+        steps_per_call = steps_per_call or train_steps
+        n_batches = (len(x) + self.batch_size - 1) // self.batch_size
+
+        # Build the optimizer's slots first, so the snapshot covers momentum and iterations as well
+        if hasattr(self.model.optimizer, 'build'):
+            self.model.optimizer.build(self.model.trainable_variables)
+        weights = self.model.get_weights()
+        optimizer_state = [np.array(variable) for variable in self._optimizer_variables()]
+
+        def restore():
+            self.model.set_weights(weights)
+            self._restore_optimizer(optimizer_state)
+
+        def eager_steps(n_steps, index):
+            for _ in range(n_steps):
+                start = index * self.batch_size
+                stop = min(start + self.batch_size, len(x))
+                self.model.train_on_batch(x=x[start:stop], y=[p[start:stop], y[start:stop]],
+                                          sample_weight=[None, sample_weights[start:stop]])
+                index = (index + 1) % n_batches
+            return index
+
+        rows = []
+        for mode in ('train_on_batch', 'compiled'):
+            restore()
+            if mode == 'compiled':
+                train_steps_function = self._compiled_train_function()
+                iterator = iter(self._train_dataset(x, y, sample_weights))
+                p_device = tf.Variable(p, trainable=False)
+                train_steps_function(iterator, p_device, tf.constant(1)).numpy()  # trace
+                start = time()
+                done = 0
+                while done < train_steps:
+                    n_steps = min(steps_per_call, train_steps - done)
+                    train_steps_function(iterator, p_device, tf.constant(n_steps)).numpy()
+                    done += n_steps
+            else:
+                index = eager_steps(1, 0)
+                start = time()
+                eager_steps(train_steps, index)
+            seconds = time() - start
+            rows.append({'mode': mode, 'steps': train_steps,
+                         'steps_per_sec': train_steps / seconds if seconds > 0 else float('nan')})
+        restore()
+        self._weights_changed()
+
+        df_report = pd.DataFrame(rows)
+        df_report['speedup'] = df_report['steps_per_sec'] / df_report['steps_per_sec'].iloc[0]
+        print("\n============ TRAINING STEP ============")
+        print(df_report)
+        return df_report
+
+    def pretrain_autoencoder(self, dataset, batch_size=256, epochs=200, optimizer='adam'):
+        """
+        Pretrain the autoencoder using the provided PyTorch dataset
+        """
+        print('Pretraining autoencoder...')
+        self.autoencoder.compile(optimizer=optimizer, loss='mse')
+        self._weights_changed()
         
-        # Convert to numpy array
-        x = np.array(embeddings)
+        x, _ = self._dataset_to_numpy(dataset, upcast=False)
         
-        print(f"Converted dataset to numpy array with shape: {x.shape}")
+        print(f"Converted dataset to numpy array with shape: {tuple(x.shape)}")
         
         # Train the autoencoder
-        self.autoencoder.fit(x, x, batch_size=batch_size, epochs=epochs)
+        if isinstance(x, np.ndarray):
+            self.autoencoder.fit(x, x, batch_size=batch_size, epochs=epochs)
+        else:
+            # Reduced-precision storage is upcast one batch at a time
+            self.autoencoder.fit(_UpcastSequence(x, batch_size), epochs=epochs)
         
         # Save the weights
         self.autoencoder.save_weights('pretrained_ae.weights.h5')
@@ -289,10 +736,146 @@ class FNN(object):
         return self.autoencoder.get_weights()
     
     @staticmethod
-    def target_distribution(q):
-        weight = q ** 2 / q.sum(0)
+    def target_distribution(q, frequency=None):
+        # frequency is q.sum(0) over all rows; pass it to compute p for a block of rows
+        weight = q ** 2 / (q.sum(0) if frequency is None else frequency)
         return (weight.T / weight.sum(1)).T
 
+    def compute_target(self, x, out=None, chunk_size=65536):
+        """
+        Streaming two-pass target distribution
+
+        Pass one predicts `chunk_size` rows at a time and writes q into `out`; pass two
+        accumulates the cluster frequency and rewrites `out` block by block as p. Besides `out`,
+        only O(chunk_size * n_clusters) memory is used.
+
+        Args:
+            x: Input features (array, or reduced-precision storage upcast per chunk)
+            out: None (new array), a preallocated (n, n_clusters) float32 array, or a file path
+                for a memory-mapped buffer
+            chunk_size: Rows per block
+
+        Returns:
+            tuple: (p, cluster ids, sentiment probabilities)
+        """
+        q, s_pred = self._soft_labels(x, out, chunk_size)
+        y_pred = q.argmax(1)
+        return target_distribution_inplace(q, chunk_size), y_pred, s_pred
+
+    def _soft_labels(self, x, out=None, chunk_size=65536, compiled=False):
+        """First pass of compute_target: write q into `out`, returns (q, sentiment probabilities)"""
+        out = allocate_target_buffer(out, (len(x), self.n_clusters))
+        s_pred = None
+        for start in range(0, len(x), chunk_size):
+            q, s = self._model_outputs(self._rows(x, start, start + chunk_size), compiled)
+            if s_pred is None:
+                s_pred = np.empty((len(x), s.shape[1]), dtype=np.float32)
+            out[start:start + len(q)] = q
+            s_pred[start:start + len(q)] = s
+        return out, s_pred
+
+    def _refresh_target_shard(self, x, p, start, stop, shard_frequency, shard, compiled=False):
+        """
+        Recompute q for rows start:stop, replace that shard's share of the running cluster
+        frequency and rewrite its rows of p. Returns (cluster ids, sentiment probabilities) of the shard.
+        """
+        q, s = self._model_outputs(self._rows(x, start, stop), compiled)
+        shard_frequency[shard] = q.sum(0)
+        p[start:stop] = self.target_distribution(q, shard_frequency.sum(0))
+        return q.argmax(1), s
+
+    def _model_outputs(self, x, compiled=False, batch_size=4096):
+        """
+        (q, sentiment probabilities) for a float32 block of rows, either through model.predict or
+        through one tf.function traced once for any number of rows
+        """
+        if not compiled:
+            return self.model.predict(x, verbose=0)
+        if self._predict_function is None:
+            model = self.model
+            self._predict_function = tf.function(
+                lambda batch: model(batch, training=False),
+                input_signature=[tf.TensorSpec((None, self.input_dim), tf.float32)])
+        outputs = [self._predict_function(tf.convert_to_tensor(x[start:start + batch_size], dtype=tf.float32))
+                   for start in range(0, len(x), batch_size)]
+        return [np.concatenate([output[i].numpy() for output in outputs]) for i in range(2)]
+
+    def _sample_weights(self, y, class_weights):
+        """Per-row sentiment loss weights, looked up once so that batches only slice them"""
+        table = np.ones(y.shape[1], dtype=np.float32)
+        for label, weight in (class_weights or {}).items():
+            table[label] = weight
+        return table[y.argmax(1)]
+
+    def _train_dataset(self, x, y, sample_weights, skip=0):
+        """
+        Repeating tf.data pipeline of (row ids, x, y, sample weights) batches, in the same order as the
+        train_on_batch loop, starting at batch `skip`; the row ids gather the matching rows of p on the device
+        """
+        n_rows = len(x)
+        if isinstance(x, np.ndarray):
+            features = tf.data.Dataset.from_tensor_slices(x.astype(np.float32, copy=False)).batch(self.batch_size)
+        else:
+            # Reduced-precision storage is upcast one batch at a time
+            features = tf.data.Dataset.from_generator(
+                lambda: (self._rows(x, start, start + self.batch_size) for start in range(0, n_rows, self.batch_size)),
+                output_signature=tf.TensorSpec((None, self.input_dim), tf.float32))
+        dataset = tf.data.Dataset.zip((
+            tf.data.Dataset.range(n_rows).batch(self.batch_size),
+            features,
+            tf.data.Dataset.from_tensor_slices(y.astype(np.float32)).batch(self.batch_size),
+            tf.data.Dataset.from_tensor_slices(sample_weights).batch(self.batch_size),
+        ))
+        return dataset.repeat().skip(skip).prefetch(tf.data.AUTOTUNE)
+
+    def _optimizer_variables(self):
+        variables = self.model.optimizer.variables
+        return variables() if callable(variables) else variables
+
+    def _restore_optimizer(self, values):
+        """Assign saved optimizer variables, building the optimizer's slots first if needed"""
+        optimizer = self.model.optimizer
+        if len(self._optimizer_variables()) != len(values) and hasattr(optimizer, 'build'):
+            optimizer.build(self.model.trainable_variables)
+        variables = self._optimizer_variables()
+        if len(variables) != len(values):
+            print(f"Warning: optimizer has {len(variables)} variables, checkpoint has {len(values)}; "
+                  "optimizer state not restored")
+            return
+        for variable, value in zip(variables, values):
+            variable.assign(value)
+
+    def _compiled_train_function(self):
+        """
+        tf.function running n_steps optimizer steps on batches from a _train_dataset iterator.
+        Computes the same losses initialize_model compiles the model with (KL divergence and
+        categorical cross-entropy, weighted by loss_weights); returns [L, Lc, Ls] of the last step.
+        """
+        if self._train_function is None:
+            model = self.model
+            optimizer = model.optimizer
+            gamma, eta = self.loss_weights
+            cluster_loss = KLDivergence()
+            sentiment_loss = CategoricalCrossentropy()
+
+            @tf.function
+            def train_steps(iterator, p, n_steps):
+                losses = tf.zeros(3)
+                for _ in tf.range(n_steps):
+                    rows, batch_x, batch_y, batch_weights = next(iterator)
+                    with tf.GradientTape() as tape:
+                        q, s = model(batch_x, training=True)
+                        loss_c = cluster_loss(tf.gather(p, rows), q)
+                        loss_s = sentiment_loss(batch_y, s, sample_weight=batch_weights)
+                        loss = gamma * loss_c + eta * loss_s
+                    gradients = tape.gradient(loss, model.trainable_variables)
+                    optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+                    losses = tf.stack([loss, loss_c, loss_s])
+                return losses
+
+            self._train_function = train_steps
+        return self._train_function
+
     def compute_class_weights(self, y):
         """
         Compute class weights for imbalanced sentiment classes
@@ -321,29 +904,39 @@ class FNN(object):
         return class_weight_dict
 
     def clustering_with_sentiment(self, dataset, tol=1e-3, update_interval=140, maxiter=2e4, 
-                                 save_dir='./results/fnnjst'):
+                                 save_dir='./results/fnnjst', target_buffer=None, refresh_shards=1,
+                                 kmeans_init='full', kmeans_sample_size=100000, kmeans_n_jobs=None, compiled=False,
+                                 checkpoint_interval=None, keep_checkpoints=3, resume_from=None):
         """
         dataset: CachedBERTDataset instance containing texts and labels
+        checkpoint_interval: Every this many iterations, snapshot the full training state (weights,
+            optimizer variables, p, y_pred_last, shard statistics, iteration and NumPy RNG state)
+            and write it to save_dir/checkpoints from a background thread
+        keep_checkpoints: Number of newest checkpoints kept
+        resume_from: Checkpoint file, or the checkpoint directory for its newest file, to continue
+            an interrupted run from instead of starting from k-means
+        compiled: Train from a tf.data pipeline with a tf.function that runs every step up to the
+            next target update (or checkpoint) in one call, instead of one train_on_batch call per
+            step; p is refreshed through a compiled forward pass as well. See training_report for
+            steps/sec of both modes
+        kmeans_init: How the cluster centers are initialized: 'full' (k-means on all rows),
+            'sample' (k-means++ seeded k-means on a sentiment-stratified sample of
+            kmeans_sample_size rows) or 'minibatch' (k-means++ seed on that sample, refined by
+            mini-batch k-means over streamed encoder batches); see kmeans_init_report
+        kmeans_n_jobs: Processes used for the k-means restarts
+        target_buffer: Where p is kept between updates: None, a preallocated (n, n_clusters) float32
+            array, or a file path for a memory-mapped buffer (see compute_target)
+        refresh_shards: With n > 1, p is computed over all rows once and then every update_interval
+            only one of n rotating row shards is refreshed, with a running estimate of the cluster
+            frequency; the stop criterion uses the label changes of the last n refreshed shards and
+            is only checked once every shard has been refreshed (see LabelChanges)
         """
         print('Update interval', update_interval)
+        self._weights_changed()
         
-        # Convert PyTorch dataset to NumPy arrays for Keras
-        embeddings = []
-        sentiment_labels = []
+        x, sentiment_labels = self._dataset_to_numpy(dataset, upcast=False)
         
-        # Extract embeddings and labels from dataset
-        for i in range(len(dataset)):
-            item = dataset[i]
-            if isinstance(item, tuple):  # If dataset returns (embedding, label)
-                embedding, label = item
-                embeddings.append(embedding.cpu().numpy())
-                sentiment_labels.append(label.cpu().numpy())
-            else:  # If dataset returns only embedding
-                embeddings.append(item.cpu().numpy())
-                
-        x = np.array(embeddings)
-        
-        if sentiment_labels:
+        if sentiment_labels is not None:
             y_sentiment = np.array(sentiment_labels)
             # One-hot encoding for categorical crossentropy
             from keras.utils import to_categorical
@@ -360,39 +953,120 @@ class FNN(object):
         save_interval = x.shape[0] / self.batch_size * 5  # 5 epochs
         print('Save interval', save_interval)
 
-        # Initialize cluster centers using k-means
-        print('Initializing cluster centers with k-means.')
-        kmeans = KMeans(n_clusters=self.n_clusters, n_init=20)
-        y_pred = kmeans.fit_predict(self.encoder.predict(x))
-        y_pred_last = y_pred
-        self.model.get_layer(name='clustering').set_weights([kmeans.cluster_centers_])
+        checkpoint = None
+        if resume_from is not None:
+            checkpoint_path = resolve_checkpoint(resume_from)
+            checkpoint = load_checkpoint(checkpoint_path)
+            print(f"Resuming from {checkpoint_path} at iteration {checkpoint['step']}")
+            self.model.set_weights(checkpoint['weights'])
+            self._restore_optimizer(checkpoint['optimizer'])
+            y_pred_last = np.copy(checkpoint['y_pred_last'])
+            y_pred = np.copy(y_pred_last)
+        else:
+            # Initialize cluster centers using k-means
+            print(f'Initializing cluster centers with k-means ({kmeans_init}).')
+            batches, features_at = self._kmeans_inputs(x)
+            strata = y_sentiment.argmax(1) if y_sentiment is not None else None
+            cluster_centers, y_pred = init_centers(self.n_clusters, batches, features_at, x.shape[0], method=kmeans_init,
+                                                   strata=strata, sample_size=kmeans_sample_size, n_jobs=kmeans_n_jobs)
+            y_pred_last = y_pred
+            self.model.get_layer(name='clustering').set_weights([cluster_centers])
 
-        # Logging file
+        # Logging file; a resumed run appends to it
         import csv, os
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
-        logfile = open(save_dir + '/idec_sentiment_log.csv', 'w')
+        logfile = open(save_dir + '/idec_sentiment_log.csv', 'a' if checkpoint is not None else 'w')
         fieldnames = ['iter', 'acc_cluster', 'nmi', 'ari', 'acc_sentiment', 'L', 'Lc', 'Ls']
         logwriter = csv.DictWriter(logfile, fieldnames=fieldnames)
-        logwriter.writeheader()
+        if checkpoint is None:
+            logwriter.writeheader()
 
         loss = [0, 0, 0]  # Total loss, clustering loss, sentiment loss
-        index = 0
+        p = target_buffer
+        s_pred = None
+        
+        # Rotating-shard refresh: per-shard q.sum(0) and label changes of the last full rotation
+        shard_bounds = np.linspace(0, x.shape[0], refresh_shards + 1).astype(np.int64)
+        shard_frequency = None
+        label_changes = LabelChanges(refresh_shards)
+        refreshes = 0
+        
+        maxiter = int(maxiter)
+        ite = 0
+        if checkpoint is not None:
+            # Restore the state of the interrupted run after its last checkpointed iteration
+            ite = checkpoint['step']
+            p = allocate_target_buffer(target_buffer, (x.shape[0], self.n_clusters))
+            p[:] = checkpoint['p']
+            shard_frequency = checkpoint['shard_frequency']
+            label_changes.history.extend(checkpoint['recent_changes'])
+            refreshes = checkpoint['refreshes']
+            np.random.set_state(checkpoint['numpy_rng_state'])
+            del checkpoint['p'], checkpoint['weights'], checkpoint['optimizer']
+        
+        # Batches are taken in order and wrap after the last row, so the position follows from ite
+        n_batches = (x.shape[0] + self.batch_size - 1) // self.batch_size
+        index = ite % n_batches
         
-        for ite in range(int(maxiter)):
+        if y_sentiment is not None:
+            # Class weight of every row, sliced per batch
+            sample_weights = self._sample_weights(y_sentiment, sentiment_class_weights)
+            if compiled:
+                train_steps = self._compiled_train_function()
+                train_iterator = iter(self._train_dataset(x, y_sentiment, sample_weights, skip=index))
+                p_device = tf.Variable(tf.zeros((x.shape[0], self.n_clusters)), trainable=False)
+                if checkpoint is not None:
+                    p_device.assign(p)
+        
+        def snapshot(step):
+            # Copies only, so the background writer never sees arrays that training keeps updating
+            return {
+                'step': step,
+                'weights': self.model.get_weights(),
+                'optimizer': [np.array(variable) for variable in self._optimizer_variables()],
+                'p': np.array(p),
+                'y_pred_last': np.copy(y_pred_last),
+                'shard_frequency': np.copy(shard_frequency) if shard_frequency is not None else None,
+                'recent_changes': list(label_changes.history),
+                'refreshes': refreshes,
+                'numpy_rng_state': np.random.get_state(),
+            }
+        
+        writer = None
+        if checkpoint_interval:
+            writer = CheckpointWriter(os.path.join(save_dir, 'checkpoints'), keep_checkpoints)
+        
+        while ite < maxiter:
             if ite % update_interval == 0:
-                q, s_pred = self.model.predict(x, verbose=0)
-                p = self.target_distribution(q)  # Update auxiliary target distribution
-                
-                # Evaluate clustering performance
-                y_pred = q.argmax(1)
-                delta_label = np.sum(y_pred != y_pred_last).astype(np.float32) / y_pred.shape[0]
-                y_pred_last = y_pred
+                if shard_frequency is None:
+                    # Update auxiliary target distribution over all rows in two passes, reusing the buffer
+                    q, s_pred = self._soft_labels(x, out=p, compiled=compiled)
+                    y_pred = q.argmax(1)
+                    if refresh_shards > 1:
+                        shard_frequency = np.stack([q[start:stop].sum(0, dtype=np.float64)
+                                                    for start, stop in zip(shard_bounds[:-1], shard_bounds[1:])])
+                    p = target_distribution_inplace(q)
+                    rows = slice(None)
+                    delta_label = label_changes.add(np.sum(y_pred != y_pred_last), y_pred.shape[0], full=True)
+                    y_pred_last = y_pred
+                else:
+                    # Refresh p for one rotating shard only
+                    shard = refreshes % refresh_shards
+                    rows = slice(shard_bounds[shard], shard_bounds[shard + 1])
+                    y_pred, s_pred = self._refresh_target_shard(x, p, rows.start, rows.stop, shard_frequency, shard,
+                                                                compiled=compiled)
+                    delta_label = label_changes.add(np.sum(y_pred != y_pred_last[rows]), y_pred.shape[0])
+                    y_pred_last[rows] = y_pred
+                    refreshes += 1
+                if compiled and y_sentiment is not None:
+                    p_device[rows].assign(p[rows])
                 
                 # Compute sentiment prediction accuracy if labels available
                 if y_sentiment is not None:
                     s_pred_label = s_pred.argmax(1)
                     sentiment_true_label = y_sentiment.argmax(1) if len(y_sentiment.shape) > 1 else y_sentiment
+                    sentiment_true_label = sentiment_true_label[rows]
                     acc_sentiment = np.sum(s_pred_label == sentiment_true_label).astype(np.float32) / s_pred_label.shape[0]
                     
                     # Compute per-class accuracy to monitor imbalance effects
@@ -416,73 +1090,59 @@ class FNN(object):
         
 
                 # Check stop criterion based on cluster stability
-                if ite > 0 and delta_label < tol:
+                if ite > 0 and label_changes.converged(tol):
                     print('delta_label ', delta_label, '< tol ', tol)
                     print('Reached tolerance threshold. Stopping training.')
                     logfile.close()
                     break
             
-            # Train on batch with class weights for sentiment
+            # Steps run before returning to Python: one per train_on_batch call, or when compiled
+            # every step up to the next target update or checkpoint
+            n_steps = 1
+            if compiled:
+                while ((ite + n_steps) % update_interval and ite + n_steps < maxiter and (ite + n_steps - 1) % save_interval
+                       and not (checkpoint_interval and (ite + n_steps) % checkpoint_interval == 0)):
+                    n_steps += 1
+            
+            # Train with class weights for sentiment
             if y_sentiment is not None:
-                if (index + 1) * self.batch_size > x.shape[0]:
-                    batch_x = x[index * self.batch_size::]
-                    batch_p = p[index * self.batch_size::]
-                    batch_y_sentiment = y_sentiment[index * self.batch_size::]
-                    
-                    # Apply class weights manually to sentiment loss
-                    if sentiment_class_weights:
-                        # Get sample weights based on class labels
-                        sample_weights = np.ones(batch_y_sentiment.shape[0])
-                        for i, label in enumerate(np.argmax(batch_y_sentiment, axis=1)):
-                            sample_weights[i] = sentiment_class_weights[label]
-                            
-                        # Pass sample weights as a list - None for clustering, weights for sentiment
-                        loss = self.model.train_on_batch(
-                            x=batch_x,
-                            y=[batch_p, batch_y_sentiment],
-                            sample_weight=[None, sample_weights]
-                        )
-                    else:
-                        loss = self.model.train_on_batch(
-                            x=batch_x,
-                            y=[batch_p, batch_y_sentiment]
-                        )
-                    index = 0
+                if compiled:
+                    loss = train_steps(train_iterator, p_device, tf.constant(n_steps)).numpy()
                 else:
-                    batch_x = x[index * self.batch_size:(index + 1) * self.batch_size]
-                    batch_p = p[index * self.batch_size:(index + 1) * self.batch_size]
-                    batch_y_sentiment = y_sentiment[index * self.batch_size:(index + 1) * self.batch_size]
-                    
-                    # Apply class weights manually to sentiment loss
-                    if sentiment_class_weights:
-                        # Get sample weights based on class labels
-                        sample_weights = np.ones(batch_y_sentiment.shape[0])
-                        for i, label in enumerate(np.argmax(batch_y_sentiment, axis=1)):
-                            sample_weights[i] = sentiment_class_weights[label]
-                            
-                        # Pass sample weights as a list - None for clustering, weights for sentiment
-                        loss = self.model.train_on_batch(
-                            x=batch_x,
-                            y=[batch_p, batch_y_sentiment],
-                            sample_weight=[None, sample_weights]
-                        )
-                    else:
-                        loss = self.model.train_on_batch(
-                            x=batch_x,
-                            y=[batch_p, batch_y_sentiment]
-                        )
-                    index += 1
+                    start = index * self.batch_size
+                    stop = min(start + self.batch_size, x.shape[0])
+                    # Pass sample weights as a list - None for clustering, weights for sentiment
+                    weights = {'sample_weight': [None, sample_weights[start:stop]]} if sentiment_class_weights else {}
+                    loss = self.model.train_on_batch(
+                        x=self._rows(x, start, stop),
+                        y=[p[start:stop], y_sentiment[start:stop]],
+                        **weights
+                    )
+                    index = 0 if stop == x.shape[0] else index + 1
             
             # Save intermediate model
-            if ite % save_interval == 0:
-                print('saving model to:', save_dir + '/FNN_model_' + str(ite) + '.weights' + '.h5')
-                self.model.save_weights(save_dir + '/FNN_model_' + str(ite) + '.weights' + '.h5')
+            last = ite + n_steps - 1
+            if last % save_interval == 0:
+                print('saving model to:', save_dir + '/FNN_model_' + str(last) + '.weights' + '.h5')
+                self.model.save_weights(save_dir + '/FNN_model_' + str(last) + '.weights' + '.h5')
+            ite += n_steps
+            
+            # Resumable training state, written in the background
+            if writer is not None and ite % checkpoint_interval == 0:
+                writer.save(snapshot(ite), ite)
         
         # Save the trained model
+        if writer is not None:
+            writer.close()
         logfile.close()
         print('saving model to:', save_dir + '/FNN_model_final.weights.h5')
         self.model.save_weights(save_dir + '/FNN_model_final.weights.h5')
         
+        if refresh_shards > 1 or s_pred is None:
+            # The last refresh covered one shard only (or none since resuming); predict all rows once more
+            q, s_pred = self._soft_labels(x, out=p, compiled=compiled)
+            y_pred = q.argmax(1)
+        
         return y_pred, s_pred if y_sentiment is not None else y_pred
 
     def evaluate_sentiment_performance(self, x, y_true):
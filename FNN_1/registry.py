@@ -0,0 +1,178 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import AutoTokenizer, AutoModel
+
+
+def _default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _model_bytes(model):
+    """Approximate resident size of a model's parameters and buffers"""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class EncoderRegistry(object):
+    """
+    Thread-safe, process-wide cache of loaded BERT tokenizers and encoders.
+
+    Entries are keyed by (model name, device, quantized) and kept in least-recently-used order;
+    the oldest entries are evicted once more than `max_models` are loaded or their
+    parameters take more than `max_bytes`. Concurrent requests for the same model
+    wait for a single load instead of loading it twice.
+
+    Models are shared by all threads. Fast (Rust) tokenizers are not safe to use from several
+    threads at once, so every thread is handed its own copy of the tokenizer, as in
+    EncodingPipeline; the copies are made once per thread and model name.
+
+    Args:
+        max_models: Maximum number of loaded encoders, None for no limit
+        max_bytes: Maximum total parameter memory of loaded encoders, None for no limit
+    """
+    def __init__(self, max_models=4, max_bytes=None):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._entries = OrderedDict()
+        self._tokenizers = {}
+        self._local = threading.local()
+
+    def configure(self, max_models=None, max_bytes=None):
+        """Change the eviction limits and evict what no longer fits"""
+        with self._lock:
+            if max_models is not None:
+                self.max_models = max_models
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict_over_budget()
+        return self
+
+    @staticmethod
+    def _key(name, device, quantize=False):
+        return name, str(torch.device(device if device is not None else _default_device())), bool(quantize)
+
+    def _evict_over_budget(self):
+        # Never evict the most recently used entry, it is about to be handed out
+        while len(self._entries) > 1:
+            total_bytes = sum(entry[1] for entry in self._entries.values())
+            too_many = self.max_models is not None and len(self._entries) > self.max_models
+            too_big = self.max_bytes is not None and total_bytes > self.max_bytes
+            if not (too_many or too_big):
+                break
+            key, _ = self._entries.popitem(last=False)
+            print(f"Evicted BERT model from registry: {key[0]} ({key[1]}{', int8' if key[2] else ''})")
+
+    def get(self, name, device=None, quantize=False):
+        """
+        Return a (tokenizer, model) pair, loading the model on first use
+
+        Args:
+            name: Pre-trained model name or path
+            device: Device to place the model on, defaults to CUDA when available
+            quantize: Dynamically quantize the Linear layers to int8 (CPU only)
+
+        Returns:
+            tuple: (tokenizer owned by the calling thread, shared model in eval mode)
+        """
+        key = self._key(name, device, quantize)
+        if quantize and key[1] != "cpu":
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            else:
+                load_lock = self._load_locks.setdefault(key, threading.Lock())
+        if entry is not None:
+            return self.get_tokenizer(name), entry[0]
+
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+            if entry is not None:
+                return self.get_tokenizer(name), entry[0]
+
+            print(f"Loading BERT model: {name}")
+            model = AutoModel.from_pretrained(name).to(key[1])
+            model.eval()
+            if quantize:
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+            with self._lock:
+                self._entries[key] = (model, _model_bytes(model))
+                self._load_locks.pop(key, None)
+                self._evict_over_budget()
+        return self.get_tokenizer(name), model
+
+    def get_tokenizer(self, name):
+        """
+        Return the calling thread's tokenizer for a model name. The tokenizer is loaded once per
+        process and copied once per thread; tokenizers are small and never evicted.
+        """
+        copies = getattr(self._local, "tokenizers", None)
+        if copies is None:
+            copies = self._local.tokenizers = {}
+        tokenizer = copies.get(name)
+        if tokenizer is not None:
+            return tokenizer
+
+        with self._lock:
+            template = self._tokenizers.get(name)
+        if template is None:
+            template = AutoTokenizer.from_pretrained(name)
+            with self._lock:
+                template = self._tokenizers.setdefault(name, template)
+        # The template itself is never used to tokenize; copies are made under the lock
+        with self._lock:
+            tokenizer = copies[name] = copy.deepcopy(template)
+        return tokenizer
+
+    def warmup(self, name, device=None, sample_text="warmup", quantize=False):
+        """Load a model ahead of the first request and run one forward pass through it"""
+        tokenizer, model = self.get(name, device, quantize)
+        inputs = tokenizer([sample_text], return_tensors="pt")
+        inputs = {k: v.to(next(model.parameters()).device) for k, v in inputs.items()}
+        with torch.no_grad():
+            model(**inputs)
+        return tokenizer, model
+
+    def evict(self, name=None, device=None, quantize=False):
+        """Drop one model, or every loaded model when name is None"""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self._key(name, device, quantize), None)
+
+    def __contains__(self, name):
+        with self._lock:
+            return any(key[0] == name for key in self._entries)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+encoder_registry = EncoderRegistry()
+
+
+def get_encoder(name, device=None, quantize=False):
+    """Return the process-wide (tokenizer, model) pair for a model name and device"""
+    return encoder_registry.get(name, device, quantize)
+
+
+def get_tokenizer(name):
+    """Return the process-wide tokenizer for a model name"""
+    return encoder_registry.get_tokenizer(name)
+
+
+def warmup_encoder(name, device=None, quantize=False):
+    """Load and warm up a model in the process-wide registry"""
+    return encoder_registry.warmup(name, device, quantize=quantize)
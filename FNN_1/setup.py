@@ -12,6 +12,10 @@ setup(
         "tensorflow",
         "numpy",
         "scikit-learn",
+        "scipy",
+        "pandas",
+        "joblib",
+        "tqdm",
         "transformers"
     ],
 )
\ No newline at end of file
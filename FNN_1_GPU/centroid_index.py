@@ -0,0 +1,101 @@
+import numpy as np
+from sklearn.cluster import KMeans
+
+
+def _nearest(features, centers, centers_sq=None):
+    """Exact nearest center per row via one matrix multiply (||x||^2 is constant per row and dropped)"""
+    if centers_sq is None:
+        centers_sq = np.sum(np.square(centers), axis=1)
+    return (centers_sq - 2.0 * np.dot(features, centers.T)).argmin(1)
+
+
+class CentroidIndex(object):
+    """
+    Two-level coarse quantizer for approximate nearest-center assignment.
+
+    The cluster centers are grouped into `n_lists` coarse lists with k-means. A query is
+    compared with the coarse centroids first, and only the centers in the `n_probe`
+    closest lists are searched exactly, so one assignment costs about
+    n_lists + n_probe * k / n_lists distances instead of k. With n_lists ~ sqrt(k) that
+    is O(sqrt(k)) per row. The nearest center under euclidean distance is the argmax of
+    the Student's t soft assignment, so results are comparable with exact predictions.
+
+    Args:
+        centers: Cluster centers, array of shape (n_clusters, n_features)
+        n_lists: Number of coarse lists, defaults to sqrt(n_clusters)
+        n_probe: Number of lists searched per query
+        chunk_size: Rows per query block; bounds the (rows, candidates, n_features) gather
+        random_state: Seed for the coarse k-means
+    """
+    def __init__(self, centers, n_lists=None, n_probe=4, chunk_size=4096, random_state=0):
+        self.centers = np.ascontiguousarray(centers, dtype=np.float32)
+        n_clusters = len(self.centers)
+        self.n_lists = min(n_clusters, n_lists or max(1, int(round(np.sqrt(n_clusters)))))
+        self.n_probe = min(n_probe, self.n_lists)
+        self.chunk_size = chunk_size
+        self.centers_sq = np.sum(np.square(self.centers), axis=1)
+
+        coarse = KMeans(n_clusters=self.n_lists, n_init=4, random_state=random_state).fit(self.centers)
+        self.coarse_centers = coarse.cluster_centers_.astype(np.float32)
+        list_of_center = coarse.labels_
+
+        # Lists padded with -1 to one (n_lists, max_list_size) array so a query block is one gather
+        sizes = np.bincount(list_of_center, minlength=self.n_lists)
+        self.members = np.full((self.n_lists, sizes.max()), -1, dtype=np.int64)
+        order = np.argsort(list_of_center, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        for list_id in range(self.n_lists):
+            self.members[list_id, :sizes[list_id]] = order[offsets[list_id]:offsets[list_id] + sizes[list_id]]
+
+    def __len__(self):
+        return len(self.centers)
+
+    def query(self, features, n_probe=None):
+        """
+        Approximate nearest center for each row of features
+
+        Args:
+            features: Array of shape (n_samples, n_features)
+            n_probe: Overrides the number of lists searched
+
+        Returns:
+            int64 numpy array of cluster ids
+        """
+        features = np.asarray(features, dtype=np.float32)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        labels = np.empty(len(features), dtype=np.int64)
+        for start in range(0, len(features), self.chunk_size):
+            block = features[start:start + self.chunk_size]
+            coarse_distances = np.sum(np.square(self.coarse_centers), axis=1) - 2.0 * np.dot(block, self.coarse_centers.T)
+            if n_probe < self.n_lists:
+                probes = np.argpartition(coarse_distances, n_probe - 1, axis=1)[:, :n_probe]
+            else:
+                probes = np.broadcast_to(np.arange(self.n_lists), (len(block), self.n_lists))
+            candidates = self.members[probes].reshape(len(block), -1)
+            valid = candidates >= 0
+            safe = np.where(valid, candidates, 0)
+            distances = self.centers_sq[safe] - 2.0 * np.einsum('nd,nmd->nm', block, self.centers[safe])
+            distances[~valid] = np.inf
+            labels[start:start + len(block)] = np.take_along_axis(safe, distances.argmin(1)[:, None], 1)[:, 0]
+        return labels
+
+    def exact(self, features):
+        """Exact nearest center for each row of features"""
+        features = np.asarray(features, dtype=np.float32)
+        return np.concatenate([_nearest(features[start:start + self.chunk_size], self.centers, self.centers_sq)
+                               for start in range(0, len(features), self.chunk_size)])
+
+    def recall(self, features, n_probe=None):
+        """Fraction of rows whose approximate assignment equals the exact nearest center"""
+        return float(np.mean(self.query(features, n_probe) == self.exact(features)))
+
+    def recall_curve(self, features, n_probes=None):
+        """
+        Recall against exact assignment for several n_probe values
+
+        Returns:
+            Dict mapping n_probe to recall
+        """
+        n_probes = n_probes or sorted({1, 2, 4, 8, 16, self.n_lists} & set(range(1, self.n_lists + 1)))
+        exact = self.exact(features)
+        return {n_probe: float(np.mean(self.query(features, n_probe) == exact)) for n_probe in n_probes}
@@ -0,0 +1,109 @@
+import glob
+import os
+import queue
+import threading
+
+import torch
+
+
+def save_checkpoint(state, path):
+    """Write a checkpoint atomically: to a temporary file first, then renamed over `path`"""
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """Load a checkpoint written by save_checkpoint or CheckpointWriter onto the CPU"""
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:  # torch < 1.13 has no weights_only
+        return torch.load(path, map_location='cpu')
+
+
+def list_checkpoints(directory, prefix='checkpoint'):
+    """Checkpoint files of `prefix` in directory, oldest first"""
+    return sorted(glob.glob(os.path.join(directory, f'{prefix}_*.pt')))
+
+
+def latest_checkpoint(directory, prefix='checkpoint'):
+    """Path of the newest checkpoint of `prefix` in directory, or None"""
+    checkpoints = list_checkpoints(directory, prefix)
+    return checkpoints[-1] if checkpoints else None
+
+
+def resolve_checkpoint(resume_from, prefix='checkpoint'):
+    """Map a resume_from argument (checkpoint file or directory) to a checkpoint path"""
+    if os.path.isdir(resume_from):
+        path = latest_checkpoint(resume_from, prefix)
+        if path is None:
+            raise FileNotFoundError(f"No '{prefix}' checkpoints in {resume_from}")
+        return path
+    if not os.path.exists(resume_from):
+        raise FileNotFoundError(f"Checkpoint {resume_from} does not exist")
+    return resume_from
+
+
+class CheckpointWriter(object):
+    """
+    Writes training-state checkpoints from a background thread.
+
+    `save(state, step)` hands over a snapshot and returns at once; the thread writes it to
+    `<directory>/<prefix>_<step>.pt` and then deletes all but the newest `keep` checkpoints.
+    The snapshot must not share memory with live training state (copy weights, buffers and
+    optimizer state before calling save). At most one snapshot waits while another is
+    written; a further save blocks until the writer catches up. An error raised while
+    writing is re-raised by the next save() or by close().
+
+    Args:
+        directory: Directory for the checkpoint files, created if missing
+        keep: Number of newest checkpoints kept, None to keep all
+        prefix: File name prefix
+    """
+    def __init__(self, directory, keep=3, prefix='checkpoint'):
+        self.directory = directory
+        self.keep = keep
+        self.prefix = prefix
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                state, step = item
+                save_checkpoint(state, os.path.join(self.directory, f'{self.prefix}_{step:09d}.pt'))
+                if self.keep is not None:
+                    for path in list_checkpoints(self.directory, self.prefix)[:-self.keep]:
+                        os.remove(path)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Writing a checkpoint failed: {error}") from error
+
+    def save(self, state, step):
+        """Queue a snapshot of the training state taken after `step` iterations"""
+        self._raise_error()
+        self._queue.put((state, step))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Write the queued checkpoints and stop the thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
@@ -0,0 +1,193 @@
+from time import time
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans, kmeans_plusplus
+
+KMEANS_INIT_METHODS = ("full", "sample", "minibatch")
+
+
+def stratified_sample(n_rows, sample_size, strata=None, random_state=None):
+    """
+    Sorted row indices of a random sample of up to sample_size rows
+
+    Args:
+        n_rows: Number of rows to sample from
+        sample_size: Number of rows to draw
+        strata: Optional 1-D array of group ids (e.g. sentiment labels); every group is sampled
+            in proportion to its size, with at least one row per group
+        random_state: Seed for the sampling
+
+    Returns:
+        int64 numpy array of row indices
+    """
+    if sample_size >= n_rows:
+        return np.arange(n_rows)
+    rng = np.random.RandomState(random_state)
+    if strata is None:
+        return np.sort(rng.choice(n_rows, sample_size, replace=False))
+    _, groups, counts = np.unique(np.asarray(strata), return_inverse=True, return_counts=True)
+    quotas = np.minimum(counts, np.maximum(1, np.round(counts * sample_size / n_rows).astype(np.int64)))
+    rows = [rng.choice(np.flatnonzero(groups == group), quota, replace=False)
+            for group, quota in enumerate(quotas)]
+    return np.sort(np.concatenate(rows))
+
+
+def _kmeans_run(features, n_clusters, seed, max_iter):
+    kmeans = KMeans(n_clusters=n_clusters, init='k-means++', n_init=1, max_iter=max_iter, random_state=seed)
+    kmeans.fit(features)
+    return kmeans.cluster_centers_, kmeans.inertia_
+
+
+def kmeans_restarts(features, n_clusters, n_init=20, n_jobs=None, random_state=None, max_iter=300):
+    """
+    k-means++ seeded k-means with n_init independent restarts, spread across n_jobs processes
+
+    Args:
+        features: Array of shape (n_samples, n_features)
+        n_clusters: Number of centers
+        n_init: Number of restarts; the run with the lowest inertia is kept
+        n_jobs: Worker processes for the restarts (joblib), None or 1 to run them in turn
+        random_state: Seed from which the per-restart seeds are drawn
+        max_iter: Lloyd iterations per restart
+
+    Returns:
+        (centers, inertia) of the best restart
+    """
+    seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=n_init)
+    if n_jobs in (None, 1):
+        runs = [_kmeans_run(features, n_clusters, seed, max_iter) for seed in seeds]
+    else:
+        from joblib import Parallel, delayed
+        runs = Parallel(n_jobs=n_jobs)(delayed(_kmeans_run)(features, n_clusters, seed, max_iter) for seed in seeds)
+    return min(runs, key=lambda run: run[1])
+
+
+def _blocks(batches, min_rows):
+    """Regroup an iterable of feature arrays into blocks of at least min_rows rows"""
+    pending, size = [], 0
+    for batch in batches:
+        pending.append(np.asarray(batch, dtype=np.float32))
+        size += len(pending[-1])
+        if size >= min_rows:
+            yield np.concatenate(pending)
+            pending, size = [], 0
+    if pending:
+        yield np.concatenate(pending)
+
+
+def minibatch_kmeans(batches, init, n_epochs=1, batch_size=4096, random_state=None):
+    """
+    Refine initial centers with mini-batch k-means over streamed feature batches
+
+    Args:
+        batches: Callable returning a fresh iterable of feature arrays (one pass over the data)
+        init: Initial centers, array of shape (n_clusters, n_features)
+        n_epochs: Number of passes over the batches
+        batch_size: Minimum rows per partial_fit step; small batches are merged
+        random_state: Seed for MiniBatchKMeans
+
+    Returns:
+        Centers, array of shape (n_clusters, n_features)
+    """
+    kmeans = MiniBatchKMeans(n_clusters=len(init), init=init, n_init=1, random_state=random_state)
+    min_rows = max(batch_size, len(init))
+    for _ in range(n_epochs):
+        for block in _blocks(batches(), min_rows):
+            if len(block) >= len(init):
+                kmeans.partial_fit(block)
+    return kmeans.cluster_centers_
+
+
+def assign_centers(batches, centers):
+    """
+    Nearest center and total squared distance (inertia) over a stream of feature batches
+
+    Returns:
+        (labels, inertia): int64 numpy array of cluster ids and a float
+    """
+    centers = np.asarray(centers, dtype=np.float32)
+    centers_sq = np.sum(np.square(centers), axis=1)
+    labels, inertia = [], 0.0
+    for batch in batches:
+        batch = np.asarray(batch, dtype=np.float32)
+        distances = centers_sq - 2.0 * np.dot(batch, centers.T)
+        nearest = distances.argmin(1)
+        labels.append(nearest)
+        inertia += float(np.sum(np.take_along_axis(distances, nearest[:, None], 1)) +
+                         np.sum(np.square(batch), dtype=np.float64))
+    return np.concatenate(labels).astype(np.int64), max(inertia, 0.0)
+
+
+def init_centers(n_clusters, batches, features_at, n_rows, method="full", strata=None, sample_size=100000,
+                 n_init=20, n_jobs=None, n_epochs=1, batch_size=4096, random_state=None):
+    """
+    Initial cluster centers for DEC/IDEC training
+
+    Args:
+        n_clusters: Number of centers
+        batches: Callable returning a fresh iterable of encoder feature batches, in row order
+        features_at: Callable mapping sorted row indices to their encoder features
+        n_rows: Number of rows
+        method: 'full' (k-means on every row, the original behavior), 'sample' (k-means with
+            k-means++ seeding on a stratified sample of sample_size rows) or 'minibatch'
+            (k-means++ seed on the sample, refined by mini-batch k-means over all batches)
+        strata: Optional per-row group ids used to stratify the sample
+        sample_size: Rows in the sample for 'sample' and 'minibatch'
+        n_init: Number of k-means restarts for 'full' and 'sample'
+        n_jobs: Worker processes for the restarts, None to run them in one process
+        n_epochs: Passes over the batches for 'minibatch'
+        batch_size: Minimum rows per mini-batch step
+        random_state: Seed
+
+    Returns:
+        (centers, labels): centers of shape (n_clusters, n_features) and the nearest center of every row
+    """
+    if method not in KMEANS_INIT_METHODS:
+        raise ValueError(f"kmeans init method must be one of {KMEANS_INIT_METHODS}")
+
+    if method == "full":
+        features = np.concatenate(list(batches()))
+        if n_jobs in (None, 1):
+            kmeans = KMeans(n_clusters=n_clusters, n_init=n_init, random_state=random_state)
+            labels = kmeans.fit_predict(features)
+            return kmeans.cluster_centers_, labels
+        centers, _ = kmeans_restarts(features, n_clusters, n_init, n_jobs, random_state)
+        return centers, assign_centers([features], centers)[0]
+
+    sample = np.asarray(features_at(stratified_sample(n_rows, sample_size, strata, random_state)))
+    if method == "sample":
+        centers, _ = kmeans_restarts(sample, n_clusters, n_init, n_jobs, random_state)
+    else:
+        seed, _ = kmeans_plusplus(sample, n_clusters, random_state=random_state)
+        centers = minibatch_kmeans(batches, seed, n_epochs, batch_size, random_state)
+    return centers, assign_centers(batches(), centers)[0]
+
+
+def init_report(n_clusters, batches, features_at, n_rows, methods=KMEANS_INIT_METHODS, **kwargs):
+    """
+    Time each initialization method and compare its inertia over all rows with full k-means
+
+    Args:
+        n_clusters, batches, features_at, n_rows: As for init_centers
+        methods: Methods to compare; 'full' is the reference for the inertia gap when included
+        **kwargs: Passed to init_centers
+
+    Returns:
+        pandas DataFrame with one row per method
+    """
+    import pandas as pd
+
+    rows = []
+    for method in methods:
+        start = time()
+        centers, _ = init_centers(n_clusters, batches, features_at, n_rows, method=method, **kwargs)
+        seconds = time() - start
+        rows.append({'method': method, 'seconds': seconds, 'inertia': assign_centers(batches(), centers)[1]})
+
+    df_report = pd.DataFrame(rows)
+    reference = df_report.loc[df_report['method'] == 'full', 'inertia']
+    if len(reference):
+        df_report['inertia_gap'] = df_report['inertia'] / reference.iloc[0] - 1.0
+    print("\n============ K-MEANS INITIALIZATION ============")
+    print(df_report)
+    return df_report
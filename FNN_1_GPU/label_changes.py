@@ -0,0 +1,40 @@
+from collections import deque
+
+import numpy as np
+
+
+class LabelChanges(object):
+    """
+    Label changes behind delta_label, the stop criterion of DEC/IDEC training.
+
+    With n_shards=1 every refresh of p covers all rows and delta_label is the fraction of rows
+    whose cluster changed since the previous refresh. With n_shards > 1 all rows are scored
+    once and then one rotating shard per refresh; delta_label is then the fraction of changed
+    rows over the last n_shards shard refreshes. The first full pass only compares against
+    the initial k-means labels, so it is kept out of that window, and training may only stop
+    once a full rotation of shards has been refreshed.
+
+    Args:
+        n_shards: Number of rotating shards (refresh_shards of the trainers)
+        history: (changed, n_rows) pairs of earlier shard refreshes, e.g. from a checkpoint
+    """
+    def __init__(self, n_shards=1, history=()):
+        self.n_shards = n_shards
+        self.history = deque(history, maxlen=n_shards)
+
+    def add(self, changed, n_rows, full=False):
+        """Record the changed labels of one refresh of n_rows rows and return delta_label"""
+        if full and self.n_shards > 1:
+            self.history.clear()
+            return np.float32(changed) / n_rows
+        self.history.append((changed, n_rows))
+        return self.delta_label()
+
+    def delta_label(self):
+        """Fraction of changed labels over the recorded refreshes"""
+        n_rows = sum(n for _, n in self.history)
+        return np.float32(sum(c for c, _ in self.history)) / n_rows if n_rows else np.float32(1.0)
+
+    def converged(self, tol):
+        """True once a full rotation has been refreshed and delta_label is below tol"""
+        return len(self.history) == self.n_shards and self.delta_label() < tol
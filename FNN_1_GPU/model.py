@@ -2,21 +2,40 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 import os
+import contextlib
+import socket
+import time
 import csv
+import copy
 from sklearn.cluster import KMeans
 from sklearn.metrics import precision_recall_fscore_support, confusion_matrix
-from transformers import AutoTokenizer, AutoModel
 from collections import Counter
+from itertools import islice
 import pandas as pd
 import torch.nn.functional as F
 from scipy.optimize import linear_sum_assignment as linear_assignment
 
+from .centroid_index import CentroidIndex
+from .checkpoints import CheckpointWriter, load_checkpoint, resolve_checkpoint
+from .embedding_cache import STORAGE_DTYPES, QuantizedEmbeddings, storage_report, take_rows, text_hash
+from .encoding import encode_texts, quantization_report
+from .kmeans_init import KMEANS_INIT_METHODS, init_centers, init_report
+from .label_changes import LabelChanges
+from .predictions import (PredictionCache, concat_columns, encoder_name, format_predictions, prediction_columns,
+                          weights_fingerprint)
+from .registry import get_encoder, get_tokenizer
+
 # Set device for computation
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Compute dtypes for FNNGPU.set_autocast; 'float32' disables autocast
+AUTOCAST_DTYPES = ("float32", "bfloat16", "float16")
+
 def cluster_acc(y_true, y_pred):
     """
     Calculate clustering accuracy. Require scikit-learn installed
@@ -43,10 +62,12 @@ class ClusteringLayer(nn.Module):
     Clustering layer converts input sample (feature) to soft label, i.e. a vector that represents the probability of the
     sample belonging to each cluster. The probability is calculated with student's t-distribution.
     """
-    def __init__(self, n_clusters, input_dim, alpha=1.0):
+    def __init__(self, n_clusters, input_dim, alpha=1.0, chunk_size=65536):
         super(ClusteringLayer, self).__init__()
         self.n_clusters = n_clusters
         self.alpha = alpha
+        # Rows per distance GEMM; bounds the (rows, n_clusters) temporaries for bulk inference
+        self.chunk_size = chunk_size
         # Initialize cluster centers as parameters
         self.clusters = nn.Parameter(torch.Tensor(n_clusters, input_dim))
         self._init_weights()
@@ -55,6 +76,31 @@ class ClusteringLayer(nn.Module):
         # Xavier initialization for cluster centers
         nn.init.xavier_uniform_(self.clusters)
 
+    def squared_distances(self, x):
+        """
+        Squared euclidean distance of each sample to each cluster center, shape=(n_samples, n_clusters).
+        Expanded as ||x||^2 - 2 x.c^T + ||c||^2 so the work is one matrix multiply per chunk of rows
+        instead of an (n_samples, n_clusters, n_features) difference tensor.
+        """
+        if len(x) > self.chunk_size:
+            return torch.cat([self.squared_distances(x[start:start + self.chunk_size])
+                              for start in range(0, len(x), self.chunk_size)], dim=0)
+        # The expansion cancels badly in reduced precision, so it always runs in float32 under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            x_sq = torch.sum(torch.square(x), dim=1, keepdim=True)
+            clusters_sq = torch.sum(torch.square(self.clusters), dim=1)
+            distances = torch.addmm(x_sq + clusters_sq, x, self.clusters.t(), alpha=-2.0)
+        # Cancellation can leave tiny negative values for points on top of a center
+        return torch.clamp(distances, min=0.0)
+
+    def nearest(self, x):
+        """
+        Hard cluster assignment without computing q: q_ij decreases with dist(x_i, u_j) and the
+        normalization keeps the order, so argmax_j q_ij is the nearest center.
+        """
+        return torch.argmin(self.squared_distances(x), dim=1)
+
     def forward(self, x):
         """
         student t-distribution, as same as used in t-SNE algorithm.
@@ -66,13 +112,89 @@ class ClusteringLayer(nn.Module):
         Return:
             q: student's t-distribution, or soft labels for each sample. shape=(n_samples, n_clusters)
         """
-        # Calculate squared distances
-        q = 1.0 / (1.0 + (torch.sum(torch.square(x.unsqueeze(1) - self.clusters.unsqueeze(0)), dim=2) / self.alpha))
+        q = 1.0 / (1.0 + (self.squared_distances(x) / self.alpha))
         q = q ** ((self.alpha + 1.0) / 2.0)
         # Normalize to make sum = 1
         q = q / torch.sum(q, dim=1, keepdim=True)
         return q
 
+
+def cluster_frequency(q, batch_size=65536):
+    """q.sum(0) accumulated in float64 over row blocks of q"""
+    frequency = torch.zeros(q.shape[1], dtype=torch.float64)
+    for start in range(0, len(q), batch_size):
+        frequency += q[start:start + batch_size].sum(0, dtype=torch.float64)
+    return frequency
+
+
+def target_distribution_inplace(q, batch_size=65536, frequency=None):
+    """
+    Turn soft labels q (a CPU tensor, possibly memory-mapped) into p in place in two passes over
+    row blocks: the first accumulates q.sum(0), the second rewrites each block.
+    Pass `frequency` when q holds only part of the rows (e.g. the global sum across workers).
+    """
+    if frequency is None:
+        frequency = cluster_frequency(q, batch_size)
+    frequency = frequency.to(q.dtype)
+    for start in range(0, len(q), batch_size):
+        weight = q[start:start + batch_size] ** 2 / frequency
+        q[start:start + batch_size] = weight / weight.sum(1, keepdim=True)
+    return q
+
+
+def allocate_target_buffer(out, shape):
+    """
+    Return a float32 tensor of the given shape for the target distribution: a new CPU tensor
+    for None, a memory-mapped file for a path, or `out` itself after checking its shape.
+    """
+    if out is None:
+        return torch.empty(shape, dtype=torch.float32)
+    if isinstance(out, str):
+        return torch.from_numpy(np.memmap(out, dtype=np.float32, mode='w+', shape=shape))
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError(f"Target buffer has shape {tuple(out.shape)}, expected {tuple(shape)}")
+    return out
+
+
+class _SharedTensors(object):
+    """Embeddings (and labels) moved to shared memory, handed to data-parallel workers as the dataset"""
+    def __init__(self, embeddings, labels=None):
+        for tensor in ((embeddings.codes, embeddings.scales) if isinstance(embeddings, QuantizedEmbeddings)
+                       else (embeddings,)):
+            tensor.share_memory_()
+        self.embeddings = embeddings
+        self.labels = labels.share_memory_() if labels is not None else None
+
+    def as_tensor(self, upcast=True):
+        embeddings = self.embeddings.float() if upcast else self.embeddings
+        return embeddings if self.labels is None else (embeddings, self.labels)
+
+
+def _data_parallel_worker(rank, world_size, init_method, threads, model, data, kwargs, results):
+    """One process of FNNGPU.clustering_with_sentiment_parallel"""
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        with contextlib.ExitStack() as stack:
+            if rank != 0:
+                # Rank 0 reports progress for all workers
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+            output = model.clustering_with_sentiment(data, **kwargs)
+        if rank == 0:
+            results.put(({name: value.cpu().numpy() for name, value in model.state_dict().items()}, output))
+    finally:
+        dist.destroy_process_group()
+
+
+def _default_init_method():
+    """Rendezvous address for the workers: MASTER_ADDR/MASTER_PORT if set, else a free local port"""
+    if 'MASTER_PORT' in os.environ:
+        return f"tcp://{os.environ.get('MASTER_ADDR', '127.0.0.1')}:{os.environ['MASTER_PORT']}"
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'tcp://127.0.0.1:{sock.getsockname()[1]}'
+
+
 class Autoencoder(nn.Module):
     """
     Fully connected auto-encoder model, symmetric.
@@ -163,7 +285,7 @@ class Autoencoder(nn.Module):
         return h, self.decode(h)
 
 class FNNGPU(nn.Module):
-    def __init__(self, dims, n_clusters=10, alpha=1.0, batch_size=256):
+    def __init__(self, dims, n_clusters=10, alpha=1.0, batch_size=256, autocast=None):
         super(FNNGPU, self).__init__()
         
         self.dims = dims
@@ -201,6 +323,11 @@ class FNNGPU(nn.Module):
         # Class labels
         self.class_labels = {0: 'negative', 1: 'positive'}
         self.stop_words = set()
+        self.prediction_cache = None
+        self._fingerprint = None
+        self.assignment_index = None
+        self.autocast_dtype = None
+        self.set_autocast(autocast)
         
         # Initialize weights
         self._init_weights()
@@ -220,10 +347,29 @@ class FNNGPU(nn.Module):
         # Get clustering assignments
         cluster_output = self.clustering(encoded)
         
-        # Get sentiment prediction
-        sentiment_output = torch.softmax(self.sentiment_classifier(encoded), dim=1)
+        # Get sentiment prediction; softmax in float32 under autocast
+        sentiment_output = torch.softmax(self.sentiment_classifier(encoded).float(), dim=1)
         
         return cluster_output, sentiment_output
+
+    def set_autocast(self, dtype='bfloat16'):
+        """
+        Run the linear layers of training and prediction under torch.autocast with the given
+        compute dtype ('bfloat16' uses the bf16 matrix units of recent CPUs); None or 'float32'
+        turns it off. Weights, optimizer state, ClusteringLayer distances, soft assignments and
+        the losses stay in float32. See autocast_report for the effect on speed and predictions.
+        """
+        dtype = None if dtype in (None, 'float32') else dtype
+        if dtype is not None and dtype not in AUTOCAST_DTYPES:
+            raise ValueError(f"autocast dtype must be one of {AUTOCAST_DTYPES}")
+        self.autocast_dtype = dtype
+        # Cached predictions were made in the previous precision
+        self._weights_changed()
+
+    def _autocast(self):
+        """Autocast context for forward passes, disabled unless set_autocast() chose a dtype"""
+        return torch.autocast(device_type=device.type, dtype=getattr(torch, self.autocast_dtype or 'bfloat16'),
+                              enabled=self.autocast_dtype is not None)
     
     def extract_feature(self, x):
         """Extract bottleneck features from the autoencoder"""
@@ -237,6 +383,7 @@ class FNNGPU(nn.Module):
         """Load model weights from .pth file"""
         checkpoint = torch.load(weights_path, map_location=device)
         self.load_state_dict(checkpoint['model_state_dict'])
+        self._weights_changed()
         print(f"Loaded weights from {weights_path}")
         
     def save_weights(self, weights_path):
@@ -246,24 +393,255 @@ class FNNGPU(nn.Module):
         }, weights_path)
         print(f"Saved weights to {weights_path}")
     
-    # Fix for your model.pretrain_autoencoder method
-    def pretrain_autoencoder(self, dataset, batch_size=256, epochs=200, learning_rate=0.001):
-        """Pretrain the autoencoder using the provided PyTorch dataset"""
-        print('Pretraining autoencoder...')
-        
-        # Extract embeddings from dataset
+    def _dataset_to_tensors(self, dataset, upcast=True):
+        """
+        Read all embeddings (and labels) of a dataset as CPU tensors, returns (embeddings, labels or None).
+        With upcast=False reduced-precision embedding storage is kept as is and upcast per batch by the caller.
+        """
+        if hasattr(dataset, 'as_tensor'):
+            # Filled in batches and returned as views of the contiguous cache
+            data = dataset.as_tensor(upcast=upcast)
+            return data if isinstance(data, tuple) else (data, None)
+
         embeddings = []
+        labels = []
         for i in range(len(dataset)):
             item = dataset[i]
-            if isinstance(item, tuple):  # If dataset returns (embedding, label)
-                embedding, _ = item
-                # Make sure embeddings are on CPU for stacking
+            if isinstance(item, tuple) and len(item) == 2:  # If dataset returns (embedding, label)
+                embedding, label = item
                 embeddings.append(embedding.cpu())
-            else:  # If dataset returns only embedding
-                embeddings.append(item.cpu())
+                labels.append(label.cpu())
+            else:
+                # If only embeddings are returned
+                embeddings.append(item.cpu() if isinstance(item, torch.Tensor) else torch.tensor(item, dtype=torch.float32))
+        return torch.stack(embeddings), (torch.stack(labels) if labels else None)
+
+    def _forward_in_batches(self, x, fn, desc=None):
+        """
+        Apply fn to row batches of x and concatenate each output.
+        Reduced-precision embedding storage is upcast to float32 one batch at a time.
+        """
+        outputs = []
+        starts = range(0, len(x), self.batch_size)
+        with torch.no_grad():
+            for start in (tqdm(starts, desc=desc) if desc else starts):
+                with self._autocast():
+                    result = fn(x[start:start + self.batch_size].to(device).float())
+                result = result if isinstance(result, tuple) else (result,)
+                outputs.append(tuple(part.float() if part.is_floating_point() else part for part in result))
+        return tuple(torch.cat(parts, dim=0) for parts in zip(*outputs))
+
+    def storage_report(self, x, dtypes=STORAGE_DTYPES, sample_size=10000):
+        """
+        Compare reconstruction loss and cluster/sentiment predictions across embedding storage dtypes
+        """
+        if hasattr(x, 'as_tensor'):
+            x = x.as_tensor()
+            x = x[0] if isinstance(x, tuple) else x
+        self.to(device)
+
+        def predict_fn(batch):
+            return self.predict_heads(batch)
+
+        def reconstruct_fn(batch):
+            return self._forward_in_batches(batch, lambda b: self.autoencoder(b)[1])[0].cpu()
+
+        self.eval()
+        return storage_report(x, predict_fn, reconstruct_fn, dtypes=dtypes, sample_size=sample_size)
+
+    def _kmeans_inputs(self, x):
+        """Bottleneck feature batches over x and a gather of the features of selected rows, for kmeans_init"""
+        def batches():
+            with torch.no_grad():
+                for start in range(0, len(x), self.batch_size):
+                    yield self.extract_feature(x[start:start + self.batch_size].to(device).float()).cpu().numpy()
+
+        def features_at(rows):
+            selected = x[torch.from_numpy(rows).to(x.device)]
+            return self._forward_in_batches(selected, self.extract_feature)[0].cpu().numpy()
+
+        return batches, features_at
+
+    def kmeans_init_report(self, dataset, methods=KMEANS_INIT_METHODS, **kwargs):
+        """
+        Compare cluster center initialization methods (time, inertia and gap to full k-means)
+        on the current bottleneck features; kwargs are passed to kmeans_init.init_centers
+        """
+        x, _ = self._dataset_to_tensors(dataset, upcast=False)
+        self.to(device)
+        self.eval()
+        batches, features_at = self._kmeans_inputs(x)
+        return init_report(self.n_clusters, batches, features_at, len(x), methods=methods, **kwargs)
+
+    def autocast_report(self, x, dtypes=("float32", "bfloat16"), sample_size=10000, train_steps=100):
+        """
+        Benchmark autocast compute dtypes against float32 on a sample of embeddings.
+        For each dtype a copy of the model is trained for train_steps clustering steps from the
+        current weights, on the same batches and float32 targets, and then predicts the sample.
+        Reports training and prediction throughput and how often the copy's final cluster and
+        sentiment predictions agree with those of the first dtype (float32 by default).
+        """
+        if hasattr(x, 'as_tensor'):
+            x = x.as_tensor()
+            x = x[0] if isinstance(x, tuple) else x
+        x = torch.as_tensor(x).float()
+        if len(x) > sample_size:
+            x = x[torch.randperm(len(x))[:sample_size]]
+        x = x.to(device)
+        self.to(device)
+
+        # Shared float32 targets and batch order
+        autocast_dtype, self.autocast_dtype = self.autocast_dtype, None
+        p, _, _ = self.compute_target(x)
+        self.autocast_dtype = autocast_dtype
+        p = p.to(device)
+        order = torch.randperm(len(x), generator=torch.Generator().manual_seed(0)).to(device)
+        kld_loss = nn.KLDivLoss(reduction='batchmean')
+
+        def synchronize():
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        rows = []
+        reference = None
+        for dtype in dtypes:
+            model = copy.deepcopy(self)
+            model.set_autocast(dtype)
+            optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+            model.train()
+            synchronize()
+            start = time.time()
+            for step in range(train_steps):
+                batch = order[torch.arange(step * self.batch_size, (step + 1) * self.batch_size, device=device) % len(x)]
+                with model._autocast():
+                    q_batch, _ = model(x[batch])
+                loss = kld_loss(torch.log(q_batch), p[batch])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            synchronize()
+            train_seconds = time.time() - start
+
+            model.eval()
+            model.predict_heads(x[:self.batch_size])  # warm-up
+            synchronize()
+            start = time.time()
+            clusters, sentiment = model.predict_heads(x)
+            predict_seconds = time.time() - start
+            if reference is None:
+                reference = clusters, sentiment
+
+            rows.append({
+                'dtype': dtype,
+                'train_rows_per_sec': train_steps * self.batch_size / train_seconds if train_seconds > 0 else float('nan'),
+                'predict_rows_per_sec': len(x) / predict_seconds if predict_seconds > 0 else float('nan'),
+                'cluster_agreement': float(np.mean(clusters == reference[0])),
+                'sentiment_agreement': float(np.mean(sentiment == reference[1])),
+            })
+
+        df_report = pd.DataFrame(rows)
+        for column in ('train_rows_per_sec', 'predict_rows_per_sec'):
+            df_report[column.replace('rows_per_sec', 'speedup')] = df_report[column] / df_report[column].iloc[0]
+        print("\n============ AUTOCAST DTYPES ============")
+        print(df_report)
+        return df_report
+
+    def training_report(self, dataset, train_steps=200, batch_size=None):
+        """
+        Benchmark the training loop of clustering_with_sentiment against the loop it replaced.
+        'per_epoch_loader' is the previous loop: a shuffling DataLoader over a TensorDataset of
+        (x, p, labels), rebuilt per target update, with per-batch device copies and .item() syncs.
+        'batch_step' is the current loop: batches sliced from a permutation of tensors on the
+        device, losses accumulated on the device. Each mode trains a copy of the model from the
+        current weights for train_steps batches of batch_size rows (default: the model's) on the
+        same float32 targets; this model is left unchanged. Reports steps/sec and the speedup.
+        """
+        x, labels = self._dataset_to_tensors(dataset)
+        x = x.float().to(device)
+        self.to(device)
+        if labels is not None:
+            labels = (torch.argmax(labels, dim=1) if labels.dim() > 1 and labels.shape[1] > 1 else labels).long()
+            labels = labels.to(device)
+        batch_size = batch_size or self.batch_size
+        p, _, _ = self.compute_target(x)
+        p = p.to(device)
+        kld_loss = nn.KLDivLoss(reduction='batchmean')
+        sentiment_loss = nn.CrossEntropyLoss()
+
+        def synchronize():
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        def per_epoch_loader(model, optimizer):
+            tensors = (x, p, labels) if labels is not None else (x, p)
+            train_loader = DataLoader(TensorDataset(*tensors), batch_size=batch_size, shuffle=True)
+            total_loss = cluster_loss = sent_loss = 0
+            steps = 0
+            while steps < train_steps:
+                for batch in tqdm(train_loader, desc="Training (per-epoch loop)", leave=False):
+                    x_batch, p_batch = batch[0].to(device), batch[1].to(device)
+                    y_batch = batch[2].to(device) if len(batch) == 3 else None
+                    q_batch, s_batch = model(x_batch)
+                    c_loss = kld_loss(torch.log(q_batch), p_batch)
+                    s_loss = torch.tensor(0.0).to(device)
+                    if y_batch is not None:
+                        s_loss = sentiment_loss(s_batch, y_batch.long())
+                    loss = c_loss + s_loss
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                    total_loss += loss.item()
+                    cluster_loss += c_loss.item()
+                    sent_loss += s_loss.item() if y_batch is not None else 0
+                    steps += 1
+                    if steps == train_steps:
+                        break
+
+        def batch_step(model, optimizer):
+            total_loss = torch.zeros((), device=device)
+            order = torch.randperm(len(x), device=device)
+            position = 0
+            for _ in range(train_steps):
+                if position >= len(x):
+                    order = torch.randperm(len(x), device=device)
+                    position = 0
+                batch = order[position:position + batch_size]
+                position += batch_size
+                q_batch, s_batch = model(x[batch])
+                loss = kld_loss(torch.log(q_batch), p[batch])
+                if labels is not None:
+                    loss = loss + sentiment_loss(s_batch, labels[batch])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                total_loss += loss.detach()
+            float(total_loss)
+
+        rows = []
+        for mode, train in (('per_epoch_loader', per_epoch_loader), ('batch_step', batch_step)):
+            model = copy.deepcopy(self).train()
+            optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+            synchronize()
+            start = time.time()
+            train(model, optimizer)
+            synchronize()
+            seconds = time.time() - start
+            rows.append({'mode': mode, 'steps': train_steps, 'batch_size': batch_size,
+                         'steps_per_sec': train_steps / seconds if seconds > 0 else float('nan')})
+
+        df_report = pd.DataFrame(rows)
+        df_report['speedup'] = df_report['steps_per_sec'] / df_report['steps_per_sec'].iloc[0]
+        print("\n============ TRAINING LOOP ============")
+        print(df_report)
+        return df_report
+
+    # Fix for your model.pretrain_autoencoder method
+    def pretrain_autoencoder(self, dataset, batch_size=256, epochs=200, learning_rate=0.001):
+        """Pretrain the autoencoder using the provided PyTorch dataset"""
+        print('Pretraining autoencoder...')
+        self._weights_changed()
         
-        # Create tensor dataset of just embeddings
-        embeddings_tensor = torch.stack(embeddings)
+        embeddings_tensor, _ = self._dataset_to_tensors(dataset, upcast=False)
         # Move the combined tensor to the target device after stacking
         embeddings_tensor = embeddings_tensor.to(device)
         embeddings_dataset = TensorDataset(embeddings_tensor)
@@ -288,15 +666,16 @@ class FNNGPU(nn.Module):
             total_loss = 0
             with tqdm(data_loader, desc=f"Epoch {epoch+1}/{epochs}") as pbar:
                 for data in pbar:
-                    # Get inputs (first element of the tuple from DataLoader)
-                    inputs = data[0].to(device)
+                    # Get inputs (first element of the tuple from DataLoader), upcast from the storage dtype
+                    inputs = data[0].to(device).float()
                     
                     # Zero the parameter gradients
                     optimizer.zero_grad()
                     
-                    # Forward + backward + optimize
-                    _, reconstructed = self.autoencoder(inputs)
-                    loss = criterion(reconstructed, inputs)
+                    # Forward + backward + optimize; the loss is taken in float32
+                    with self._autocast():
+                        _, reconstructed = self.autoencoder(inputs)
+                    loss = criterion(reconstructed.float(), inputs)
                     loss.backward()
                     optimizer.step()
                     
@@ -309,12 +688,60 @@ class FNNGPU(nn.Module):
         print('Autoencoder pretrained and weights saved to pretrained_ae.weights.pth')
             
     @staticmethod
-    def target_distribution(q):
+    def target_distribution(q, frequency=None):
         """
-        Calculate auxiliary target distribution for clustering
+        Calculate auxiliary target distribution for clustering.
+        frequency is the cluster frequency q.sum(0) over all rows; pass it to compute p for a block of rows.
         """
-        weight = q ** 2 / torch.sum(q, dim=0)
+        weight = q ** 2 / (torch.sum(q, dim=0) if frequency is None else frequency)
         return (weight.t() / torch.sum(weight, dim=1)).t()
+
+    def compute_target(self, x, out=None, desc=None):
+        """
+        Streaming two-pass target distribution over x (a tensor of embeddings).
+
+        Pass one runs the model batch by batch and writes q into `out`; pass two accumulates the
+        cluster frequency q.sum(0) and rewrites `out` block by block as p. Besides `out`, only
+        O(batch_size * n_clusters) memory is used on the device.
+
+        Args:
+            out: None (new CPU tensor), a preallocated (n, n_clusters) float32 tensor, or a file path
+                for a memory-mapped buffer
+        Returns:
+            (p, hard cluster assignments, sentiment predictions) with the predictions as int numpy arrays
+        """
+        q, y_pred, s_pred = self._soft_labels(x, out, desc)
+        return target_distribution_inplace(q, self.batch_size), y_pred, s_pred
+
+    def _soft_labels(self, x, out=None, desc=None):
+        """
+        First pass of compute_target: write q into `out` batch by batch.
+        Returns (q, hard cluster assignments, sentiment predictions).
+        """
+        out = allocate_target_buffer(out, (len(x), self.n_clusters))
+        y_pred = np.empty(len(x), dtype=np.int64)
+        s_pred = np.empty(len(x), dtype=np.int64)
+        starts = range(0, len(x), self.batch_size)
+        self.eval()
+        with torch.no_grad():
+            for start in (tqdm(starts, desc=desc) if desc else starts):
+                with self._autocast():
+                    q, s = self(x[start:start + self.batch_size].to(device).float())
+                out[start:start + len(q)] = q.cpu()
+                y_pred[start:start + len(q)] = torch.argmax(q, dim=1).cpu().numpy()
+                s_pred[start:start + len(q)] = torch.argmax(s, dim=1).cpu().numpy()
+        return out, y_pred, s_pred
+
+    def _refresh_target_shard(self, x, p, start, stop, shard_frequency, shard):
+        """
+        Recompute q for rows start:stop, replace that shard's share of the running cluster frequency
+        and rewrite its rows of p. Returns the shard's (hard cluster assignments, sentiment predictions).
+        """
+        self.eval()
+        q, s = self._forward_in_batches(x[start:stop], self)
+        shard_frequency[shard] = q.sum(0).double().cpu()
+        p[start:stop] = self.target_distribution(q, shard_frequency.sum(0).to(q)).cpu()
+        return torch.argmax(q, dim=1).cpu().numpy(), torch.argmax(s, dim=1).cpu().numpy()
     
     def compute_class_weights(self, y):
         """
@@ -347,174 +774,319 @@ class FNNGPU(nn.Module):
         print(f"Computed class weights: {class_weights}")
         return class_weights
     
+    def head_outputs(self, x, heads='both', probabilities=True):
+        """
+        Run only the requested heads ('cluster', 'sentiment' or 'both') on one shared encoder pass.
+        With probabilities=False argmax ids are returned and normalization is skipped: the cluster
+        head takes the nearest center and the sentiment head takes the argmax of the logits.
+        Returns a tuple with one tensor per requested head, in (cluster, sentiment) order.
+        """
+        if heads not in ('cluster', 'sentiment', 'both'):
+            raise ValueError("heads must be 'cluster', 'sentiment' or 'both'")
+        encoded = self.autoencoder.encode(x)
+        outputs = []
+        if heads in ('cluster', 'both'):
+            outputs.append(self.clustering(encoded) if probabilities else self.clustering.nearest(encoded))
+        if heads in ('sentiment', 'both'):
+            logits = self.sentiment_classifier(encoded)
+            outputs.append(torch.softmax(logits.float(), dim=1) if probabilities else torch.argmax(logits, dim=1))
+        return tuple(outputs)
+
+    def predict_heads(self, x, heads='both'):
+        """
+        Predict hard labels from the requested heads only, in batches.
+        Returns cluster ids, sentiment ids, or a (cluster ids, sentiment ids) tuple for heads='both'.
+        """
+        self.eval()
+        x = torch.as_tensor(x, dtype=torch.float32) if not isinstance(x, torch.Tensor) else x
+        assignment_index = self._assignment_index()
+        if assignment_index is not None and heads != 'sentiment':
+            # Bottleneck features (and sentiment) in one pass, clusters from the approximate index
+            def features_and_sentiment(batch):
+                encoded = self.autoencoder.encode(batch)
+                if heads == 'cluster':
+                    return encoded
+                return encoded, torch.argmax(self.sentiment_classifier(encoded), dim=1)
+
+            outputs = self._forward_in_batches(x, features_and_sentiment)
+            clusters = assignment_index.query(outputs[0].cpu().numpy())
+            return clusters if heads == 'cluster' else (clusters, outputs[1].cpu().numpy())
+        outputs = self._forward_in_batches(x, lambda batch: self.head_outputs(batch, heads, probabilities=False))
+        outputs = tuple(output.cpu().numpy() for output in outputs)
+        return outputs if heads == 'both' else outputs[0]
+
+    def build_assignment_index(self, n_lists=None, n_probe=4, x=None):
+        """
+        Build an approximate nearest-center index (two-level coarse quantizer) over the cluster
+        centers. Once built, predict_clusters, get_cluster_assignments and predict_heads answer
+        cluster assignments from it; it is dropped whenever the weights change.
+        If sample inputs x are given, recall against exact assignment is reported.
+        """
+        centers = self.clustering.clusters.detach().cpu().numpy()
+        self.assignment_index = CentroidIndex(centers, n_lists=n_lists, n_probe=n_probe)
+        print(f"Built assignment index: {len(centers)} clusters in {self.assignment_index.n_lists} lists, "
+              f"n_probe={self.assignment_index.n_probe}")
+        if x is not None:
+            x = torch.as_tensor(x, dtype=torch.float32) if not isinstance(x, torch.Tensor) else x
+            features = self._forward_in_batches(x, self.autoencoder.encode)[0].cpu().numpy()
+            recall = self.assignment_index.recall(features)
+            print(f"Assignment index recall vs exact assignment: {recall:.4f}")
+        return self.assignment_index
+
+    def drop_assignment_index(self):
+        self.assignment_index = None
+
+    def _assignment_index(self):
+        """The assignment index, dropped first if the cluster centers changed since it was built"""
+        if self.assignment_index is not None and not np.array_equal(
+                self.assignment_index.centers, self.clustering.clusters.detach().cpu().numpy()):
+            self.assignment_index = None
+        return self.assignment_index
+
     def predict_clusters(self, x):
         """
         Predict cluster assignments for input data
         """
-        self.eval()
-        with torch.no_grad():
-            x = torch.tensor(x, dtype=torch.float32).to(device) if not isinstance(x, torch.Tensor) else x.to(device)
-            cluster_output, _ = self(x)
-            return torch.argmax(cluster_output, dim=1).cpu().numpy()
+        return self.predict_heads(x, 'cluster')
     
     def predict_sentiment(self, x):
         """
         Predict sentiment for input data
         """
-        self.eval()
-        with torch.no_grad():
-            x = torch.tensor(x, dtype=torch.float32).to(device) if not isinstance(x, torch.Tensor) else x.to(device)
-            _, sentiment_output = self(x)
-            return torch.argmax(sentiment_output, dim=1).cpu().numpy()
+        return self.predict_heads(x, 'sentiment')
     
-    def predict(self, inputs, bert_model=None):
+    def _text_encoder(self, bert_model=None, quantize=False):
+        """
+        Resolve (tokenizer, encoder) for text inputs through the process-wide registry
+        """
+        if callable(bert_model):
+            # A loaded encoder was passed in, only the tokenizer comes from the registry
+            return get_tokenizer("indolem/indobert-base-uncased"), bert_model
+        # Loaded once per process and shared across calls
+        return get_encoder(bert_model if isinstance(bert_model, str) else "indolem/indobert-base-uncased",
+                           "cpu" if quantize else device, quantize=quantize)
+
+    def _predict_outputs(self, embeddings, return_features=False):
+        """
+        Run the model on a block of embeddings, returns NumPy (cluster_probs, sentiment_probs, features or None)
+        """
+        with torch.no_grad(), self._autocast():
+            encoded = self.autoencoder.encode(embeddings)
+            cluster_output = self.clustering(encoded)
+            sentiment_output = torch.softmax(self.sentiment_classifier(encoded).float(), dim=1)
+        return (cluster_output.cpu().numpy(), sentiment_output.cpu().numpy(),
+                encoded.float().cpu().numpy() if return_features else None)
+
+    def _predict_columns(self, embeddings, return_probs=False, top_k=0, return_features=False):
+        """
+        Run the model on a block of embeddings and return column arrays (see prediction_columns)
+        """
+        cluster_output, sentiment_output, features = self._predict_outputs(embeddings, return_features)
+        return prediction_columns(cluster_output, sentiment_output, self.class_labels,
+                                  return_probs=return_probs, top_k=top_k, features=features)
+
+    def enable_prediction_cache(self, max_entries=100000, max_bytes=None):
+        """
+        Cache text predictions in a size-bounded LRU keyed by normalized text and model fingerprint.
+        The cache is cleared whenever the weights change (load_weights, training).
+        Returns the PredictionCache, which exposes hits, misses, evictions and stats().
+        """
+        self.prediction_cache = PredictionCache(max_entries, max_bytes)
+        return self.prediction_cache
+
+    def disable_prediction_cache(self):
+        self.prediction_cache = None
+
+    def _weights_changed(self):
+        """
+        Invalidate the model fingerprint, everything cached under it and the assignment index
+        """
+        self._fingerprint = None
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear()
+        self.assignment_index = None
+
+    def _model_fingerprint(self):
+        """
+        Digest of the current weights, recomputed only when a parameter or buffer changed: in-place
+        updates (optimizer steps, load_state_dict) bump the tensor's version counter and replacing
+        .data changes its storage, so changes made by the caller are noticed as well
+        """
+        state = self.state_dict(keep_vars=True).values()
+        version = tuple((t.data_ptr(), t._version) for t in state)
+        if self._fingerprint is None or self._fingerprint[0] != version:
+            if self._fingerprint is not None and self.prediction_cache is not None:
+                # Entries of the previous weights can no longer be hit
+                self.prediction_cache.clear()
+            self._fingerprint = (version, weights_fingerprint(t.detach().cpu().numpy() for t in state))
+        return self._fingerprint[1]
+
+    def _cached_columns(self, texts, tokenizer, encoder, quantize, max_length, return_probs, top_k, return_features):
+        """
+        Predict one chunk, running BERT and the model only on texts missing from the prediction cache
+        """
+        prefix = (self._model_fingerprint(),) + encoder_name(encoder, quantize, max_length)
+        keys = [prefix + (text_hash(text),) for text in texts]
+        entries = self.prediction_cache.lookup(keys, features=return_features)
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if missing:
+            embeddings = encode_texts([texts[i] for i in missing], tokenizer, encoder, max_length=max_length,
+                                      deduplicate=True).to(device)
+            outputs = self._predict_outputs(embeddings, return_features)
+            self.prediction_cache.add([keys[i] for i in missing], *outputs)
+            for j, i in enumerate(missing):
+                entries[i] = tuple(output[j] if output is not None else None for output in outputs)
+        return prediction_columns(np.stack([entry[0] for entry in entries]), np.stack([entry[1] for entry in entries]),
+                                  self.class_labels, return_probs=return_probs, top_k=top_k,
+                                  features=np.stack([entry[2] for entry in entries]) if return_features else None)
+
+    def _iter_prediction_columns(self, texts, bert_model=None, quantize=False, chunk_size=1024, max_length=512,
+                                 return_probs=False, top_k=0, return_features=False):
+        """
+        Encode and predict `chunk_size` texts at a time, yielding one column dict per chunk
+        """
+        self.eval()
+        tokenizer, encoder = self._text_encoder(bert_model, quantize)
+        texts = iter(texts)
+        while True:
+            chunk = list(islice(texts, chunk_size))
+            if not chunk:
+                break
+            if self.prediction_cache is not None:
+                yield self._cached_columns(chunk, tokenizer, encoder, quantize, max_length,
+                                           return_probs, top_k, return_features)
+                continue
+            # Repeated texts are encoded once; length-bucketed, dynamically padded, returned in input order
+            embeddings = encode_texts(chunk, tokenizer, encoder, max_length=max_length, deduplicate=True).to(device)
+            yield self._predict_columns(embeddings, return_probs, top_k, return_features)
+
+    def predict_iter(self, texts, bert_model=None, quantize=False, chunk_size=1024, max_length=512, output='records',
+                     return_probs=False, top_k=0, return_features=False):
+        """
+        Predict clusters and sentiment for any iterable of texts as each chunk completes.
+        Only `chunk_size` texts are tokenized, encoded and held at a time, so peak memory
+        depends on the chunk size, not on the input size. With output='records' one dict is
+        yielded per text; 'numpy', 'pandas' and 'arrow' yield one table per chunk.
+        """
+        column_options = dict(return_probs=return_probs, top_k=top_k, return_features=return_features)
+        for columns in self._iter_prediction_columns(texts, bert_model, quantize, chunk_size, max_length,
+                                                     **column_options):
+            if output == 'records':
+                yield from format_predictions(columns, output)
+            else:
+                yield format_predictions(columns, output, self.class_labels)
+
+    def predict_batched(self, texts, bert_model=None, quantize=False, chunk_size=1024, max_length=512,
+                        output='records', return_probs=False, top_k=0, return_features=False):
+        """
+        Chunked predict over any iterable of texts, collected into one list or table
+        """
+        column_options = dict(return_probs=return_probs, top_k=top_k, return_features=return_features)
+        if output == 'records':
+            return list(self.predict_iter(texts, bert_model, quantize, chunk_size, max_length, **column_options))
+        parts = list(self._iter_prediction_columns(texts, bert_model, quantize, chunk_size, max_length,
+                                                   **column_options))
+        if not parts:
+            raise ValueError("No texts to predict")
+        return format_predictions(concat_columns(parts), output, self.class_labels)
+
+    def predict(self, inputs, bert_model=None, quantize=False, chunk_size=1024, output='records',
+                return_probs=False, top_k=0, return_features=False):
         """
-        Predict clusters and sentiment for text inputs or embeddings
+        Predict clusters and sentiment for text inputs or embeddings.
+        With quantize=True texts are encoded on CPU by a dynamically int8-quantized encoder.
+        Texts are encoded `chunk_size` at a time (see predict_iter).
+
+        output='records' returns a list of {'sentiment', 'cluster'} dicts; 'numpy', 'pandas' and
+        'arrow' return columns cluster, sentiment_id and sentiment, plus sentiment_prob
+        (return_probs), cluster_topk / cluster_topk_prob (top_k > 0) and features (return_features).
         """
+        column_options = dict(return_probs=return_probs, top_k=top_k, return_features=return_features)
         self.eval()
         if isinstance(inputs, str):
             inputs = [inputs]
 
         if isinstance(inputs, list) and isinstance(inputs[0], str):
-            # Process text inputs using BERT
-            tokenizer = AutoTokenizer.from_pretrained(bert_model if isinstance(bert_model, str) else "indolem/indobert-base-uncased")
-            tokens = tokenizer(
-                inputs,
-                padding=True,
-                truncation=True,
-                return_tensors="pt",
-                max_length=512
-            ).to(device)
-
-            with torch.no_grad():
-                if not callable(bert_model):
-                    bert_model = AutoModel.from_pretrained(bert_model if isinstance(bert_model, str) else "indolem/indobert-base-uncased")
-                    bert_model.to(device)
-                
-                outputs = bert_model(**tokens)
-            
-            embeddings = outputs.last_hidden_state[:, 0, :]
+            return self.predict_batched(inputs, bert_model, quantize=quantize, chunk_size=chunk_size, output=output,
+                                        **column_options)
 
         elif isinstance(inputs, torch.Tensor):
-            embeddings = inputs
+            embeddings = inputs.to(device)
         else:
             embeddings = torch.tensor(inputs, dtype=torch.float32).to(device)
         
-        # Get predictions
-        with torch.no_grad():
-            cluster_output, sentiment_output = self(embeddings)
-        
-        # Get the predicted clusters and sentiments
-        cluster_preds = torch.argmax(cluster_output, dim=1).cpu().numpy()
-        sentiment_preds = torch.argmax(sentiment_output, dim=1).cpu().numpy()
-        
-        # Prepare results
-        results = []
-        for i in range(len(sentiment_preds)):
-            sentiment_label = self.class_labels[sentiment_preds[i]]
-            result = {
-                'sentiment': sentiment_label,
-                'cluster': int(cluster_preds[i])
-            }
-            results.append(result)
-        
-        return results
+        return format_predictions(self._predict_columns(embeddings, **column_options), output, self.class_labels)
     
     def clustering_with_sentiment(self, dataset, gamma=0.7, eta=1,
-                        tol=1e-3, update_interval=140, batch_size=128, maxiter=2e4, 
-                        save_dir='./results/fnnjst'):
+                        tol=1e-3, update_interval=140, batch_size=None, maxiter=2e4, 
+                        save_dir='./results/fnnjst', target_buffer=None, refresh_shards=1,
+                        kmeans_init='full', kmeans_sample_size=100000, kmeans_n_jobs=None,
+                        checkpoint_interval=None, keep_checkpoints=3, resume_from=None):
         """
-        Train the model with joint clustering and sentiment tasks
+        Train the model with joint clustering and sentiment tasks.
+        One iteration is one batch step of batch_size rows (default: the model's batch_size;
+        maxiter counts batches, as in the Keras FNN). Batches are sliced from a per-epoch
+        permutation of tensors kept on the device, and throughput is logged as steps/sec at each
+        target update. This replaced a loop that ran one DataLoader epoch per iteration; see
+        training_report for steps/sec of both loops on the same data.
+        target_buffer holds p between updates: None (CPU tensor), a preallocated (n, n_clusters)
+        float32 tensor, or a file path for a memory-mapped buffer (see compute_target).
+        With refresh_shards=n > 1, p is computed over all rows once and then each update_interval
+        refreshes only one of n rotating row shards, using a running estimate of the cluster
+        frequency; the stop criterion uses the label changes of the last n refreshed shards and
+        is only checked once every shard has been refreshed (see LabelChanges).
+        kmeans_init selects the center initialization: 'full' (k-means on all rows), 'sample'
+        (k-means++ seeded k-means on a sentiment-stratified sample of kmeans_sample_size rows,
+        restarts spread over kmeans_n_jobs processes) or 'minibatch' (the sample seed refined by
+        mini-batch k-means over streamed feature batches); see kmeans_init_report.
+        Inside an initialized process group (see clustering_with_sentiment_parallel) every worker
+        trains on its own contiguous block of rows with a batch of batch_size / world_size,
+        gradients are all-reduced, and q.sum(0), the label changes and the accuracy are summed
+        across workers so p and the stop criterion are the same as in a single process.
+        Every checkpoint_interval iterations the full training state (weights, optimizer, p,
+        y_pred_last, shard statistics, batch order and RNG state) is snapshotted and written to
+        save_dir/checkpoints by a background thread, keeping the newest keep_checkpoints files.
+        resume_from (a checkpoint file or that directory) continues such a run where it stopped
+        instead of starting from k-means; with data-parallel workers each rank keeps its own files.
         """
         print('Update interval', update_interval)
+        self._weights_changed()
+
+        distributed = dist.is_available() and dist.is_initialized()
+        rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+        is_main = rank == 0
+        if distributed:
+            if refresh_shards > 1:
+                raise ValueError("refresh_shards > 1 is not supported in data-parallel training")
+            if target_buffer is not None and not isinstance(target_buffer, str):
+                raise ValueError("In data-parallel training target_buffer must be None or a file path")
+            if isinstance(target_buffer, str):
+                target_buffer = f'{target_buffer}.rank{rank}'
 
         # Create directories for saving
         os.makedirs(save_dir, exist_ok=True)
-        # Collect all embeddings and labels
-        embeddings = []
-        labels = []
-
-        # Iterate through the dataset and collect data
-        for i in range(len(dataset)):
-            item = dataset[i]
-            if isinstance(item, tuple) and len(item) == 2:  # If dataset returns (embedding, label)
-                embedding, label = item
-                # Store tensors on CPU initially
-                embeddings.append(embedding.cpu())
-                labels.append(label.cpu())
-            else: 
-                # If only embeddings are returned
-                embeddings.append(item.cpu() if isinstance(item, torch.Tensor) else torch.tensor(item, dtype=torch.float32))
-
-        # Check if embeddings have consistent shapes
-        shapes = [emb.shape for emb in embeddings]
-        if len(set(shapes)) > 1:
-            print(f"Warning: Inconsistent embedding shapes detected: {set(shapes)}")
-            print("Attempting to handle this case...")
-
-        # Stack embeddings
-        embeddings_tensor = torch.stack(embeddings)
+        embeddings_tensor, labels_tensor = self._dataset_to_tensors(dataset, upcast=False)
         # Move model to device first to ensure it's on the right device
         self.to(device)
         # Move data to the same device as the model
         embeddings_tensor = embeddings_tensor.to(device)
 
-        # Create the final dataset
-        if labels:
-            # Convert labels to tensor if they exist
-            labels_tensor = torch.stack(labels).to(device)
-            combined_dataset = TensorDataset(embeddings_tensor, labels_tensor)
-            print(f"Created dataset with {len(combined_dataset)} samples, embedding shape: {embeddings_tensor.shape}, label shape: {labels_tensor.shape}")
+        # Use the stacked tensors directly instead of copying them batch by batch
+        all_embeddings = embeddings_tensor
+        if labels_tensor is not None:
+            all_labels = labels_tensor.to(device)
+            has_labels = True
+            print(f"Created dataset with {len(all_embeddings)} samples, embedding shape: {all_embeddings.shape}, label shape: {all_labels.shape}")
         else:
-            combined_dataset = TensorDataset(embeddings_tensor)
-            print(f"Created dataset with {len(combined_dataset)} samples, embedding shape: {embeddings_tensor.shape}")
-
-        data_loader = DataLoader(combined_dataset, batch_size=batch_size, shuffle=False)
-
-        all_embeddings = []
-        all_labels = []
+            all_labels = None
+            has_labels = False
+            print(f"Created dataset with {len(all_embeddings)} samples, embedding shape: {all_embeddings.shape}")
 
-        with torch.no_grad():
-            for batch in tqdm(data_loader, desc="Extracting features"):
-                if len(batch) > 1:  # If the batch contains both embeddings and labels
-                    embeddings, labels = batch
-                    # Ensure embeddings are on the correct device
-                    embeddings = embeddings.to(device)
-                    if not isinstance(embeddings, torch.Tensor):
-                        embeddings = torch.tensor(embeddings, dtype=torch.float32, device=device)
-                    all_embeddings.append(embeddings)
-                    # Ensure labels are on the correct device
-                    labels = labels.to(device)
-                    all_labels.append(labels)
-                else:  # If the batch contains only embeddings
-                    embeddings = batch[0]  # Get the first (and only) item from the tuple
-                    # Ensure embeddings are on the correct device
-                    embeddings = embeddings.to(device)
-                    try:
-                        if not isinstance(embeddings, torch.Tensor):
-                            embeddings = torch.tensor(embeddings, dtype=torch.float32, device=device)
-                    except Exception as e:
-                        print(f"Error converting to tensor: {e}")
-                        continue
-                    all_embeddings.append(embeddings)
-
-            
-            if all_embeddings:
-                all_embeddings = torch.cat(all_embeddings, dim=0).to(device)
-            else:
-                raise ValueError("No embeddings were extracted from the dataset")
-                
-            if all_labels:
-                # Create a tensor from all_labels if there are items in the list
-                all_labels = torch.cat(all_labels, dim=0).to(device)
-                has_labels = True
-            else:
-                all_labels = None
-                has_labels = False
-        
-        # Create a tensor dataset for batch training
+        # Sentiment labels as class indices on the device, sliced per step
         if has_labels and isinstance(all_labels, torch.Tensor) and all_labels.numel() > 0:
-            x_dataset = TensorDataset(all_embeddings, all_labels)
+            if all_labels.dim() > 1 and all_labels.shape[1] > 1:
+                all_labels = torch.argmax(all_labels, dim=1)
+            all_labels = all_labels.long()
             y_sentiment = all_labels.cpu().numpy()
             
             # Compute class weights for handling imbalanced classes
@@ -522,14 +1094,10 @@ class FNNGPU(nn.Module):
             class_weight_tensor = torch.tensor([sentiment_class_weights[i] for i in range(len(self.class_labels))], 
                                             dtype=torch.float32).to(device)
         else:
-            x_dataset = TensorDataset(all_embeddings)
             y_sentiment = None
             sentiment_class_weights = None
             class_weight_tensor = None
         
-        # Create data loader for batch training
-        train_loader = DataLoader(x_dataset, batch_size=self.batch_size, shuffle=True)
-        
         # Set up optimizers
         optimizer = optim.SGD(self.parameters(), lr=0.001, momentum=0.9)
         
@@ -540,80 +1108,194 @@ class FNNGPU(nn.Module):
         else:
             sentiment_loss = nn.CrossEntropyLoss()
         
-        # Initialize cluster centers using k-means
-        print('Initializing cluster centers with k-means.')
-        # Ensure model is in eval mode and using the proper device
-        self.eval()
-        features = self.extract_feature(all_embeddings).cpu().numpy()
-        kmeans = KMeans(n_clusters=self.n_clusters, n_init=20)
-        y_pred = kmeans.fit_predict(features)
-        y_pred_last = np.copy(y_pred)
-        
-        # Set cluster centers as initial weights - ensure on correct device
-        cluster_centers = torch.tensor(kmeans.cluster_centers_, dtype=torch.float32).to(device)
-        self.clustering.clusters.data = cluster_centers
-        
-        # Logging file
-        logfile = open(os.path.join(save_dir, 'idec_sentiment_log.csv'), 'w', newline='')
+        checkpoint_prefix = f'checkpoint_rank{rank}' if distributed else 'checkpoint'
+        checkpoint = None
+        if resume_from is not None:
+            checkpoint_path = resolve_checkpoint(resume_from, checkpoint_prefix)
+            checkpoint = load_checkpoint(checkpoint_path)
+            print(f"Resuming from {checkpoint_path} at iteration {checkpoint['step']}")
+        
+        y_pred = None
+        if checkpoint is None:
+            # Initialize cluster centers using k-means
+            print(f'Initializing cluster centers with k-means ({kmeans_init}).')
+            # Ensure model is in eval mode and using the proper device
+            self.eval()
+            initial = [None, None]
+            if is_main:
+                batches, features_at = self._kmeans_inputs(all_embeddings)
+                initial = list(init_centers(self.n_clusters, batches, features_at, len(all_embeddings),
+                                            method=kmeans_init, strata=y_sentiment,
+                                            sample_size=kmeans_sample_size, n_jobs=kmeans_n_jobs))
+            if distributed:
+                # Every worker starts from the centers found by rank 0
+                dist.broadcast_object_list(initial, src=0)
+            cluster_centers, y_pred = initial
+        
+        if distributed:
+            # Keep this worker's block of rows; class weights above were computed on all labels
+            block = slice(len(all_embeddings) * rank // world_size, len(all_embeddings) * (rank + 1) // world_size)
+            all_embeddings = take_rows(all_embeddings, block)
+            y_pred = y_pred[block] if y_pred is not None else None
+            if y_sentiment is not None:
+                all_labels = all_labels[block]
+                y_sentiment = y_sentiment[block]
+        
+        if checkpoint is None:
+            y_pred_last = np.copy(y_pred)
+            
+            # Set cluster centers as initial weights - ensure on correct device
+            cluster_centers = torch.tensor(cluster_centers, dtype=torch.float32).to(device)
+            self.clustering.clusters.data = cluster_centers
+        else:
+            self.load_state_dict(checkpoint['model_state_dict'])
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            y_pred_last = np.copy(checkpoint['y_pred_last'])
+            y_pred = np.copy(y_pred_last)
+        
+        # Logging file, written by rank 0 only; a resumed run appends to it
+        logfile = open(os.path.join(save_dir, 'idec_sentiment_log.csv') if is_main else os.devnull,
+                       'a' if checkpoint is not None else 'w', newline='')
         fieldnames = ['iter', 'acc_cluster', 'nmi', 'ari', 'acc_sentiment', 'L', 'Lc', 'Ls']
         logwriter = csv.DictWriter(logfile, fieldnames=fieldnames)
-        logwriter.writeheader()
-        
-        save_interval = len(train_loader) * 5  # 5 epochs
+        if checkpoint is None:
+            logwriter.writeheader()
+        
+        n_rows = len(all_embeddings)
+        # Each worker takes its share of the batch, so one step still covers batch_size rows
+        batch_size = batch_size or self.batch_size
+        step_size = max(1, batch_size // world_size)
+        steps_per_epoch = (n_rows + step_size - 1) // step_size
+        save_interval = steps_per_epoch * 5  # 5 epochs
         print('Save interval', save_interval)
         
-        # Training loop
+        # Gradients are averaged across workers in backward(); the decoder takes no part in this loss
+        model = nn.parallel.DistributedDataParallel(self, find_unused_parameters=True) if distributed else self
+        
+        # Training loop: one iteration is one batch step, as in the Keras FNN
         self.train()
         iter_count = 0
-        total_loss = cluster_loss = sent_loss = 0
+        # Losses are accumulated on the device and read back only when logged
+        total_loss, cluster_loss, sent_loss = (torch.zeros((), device=device) for _ in range(3))
+        zero_loss = torch.zeros((), device=device)
+        # Batches are drawn by slicing a per-epoch permutation of row indices
+        order = torch.randperm(n_rows, device=device)
+        position = 0
+        steps_since_log = 0
+        log_time = time.time()
         
         gamma = gamma  # Weight for clustering loss
         eta = eta    # Weight for sentiment loss
         
-        for ite in range(int(maxiter)):
+        p = target_buffer
+        # With the default buffer p is mirrored on the device so batches are sliced without host copies
+        p_on_device = target_buffer is None
+        
+        # Rotating-shard refresh: per-shard q.sum(0) and label changes of the last full rotation
+        shard_bounds = np.linspace(0, n_rows, refresh_shards + 1).astype(np.int64)
+        shard_frequency = None
+        label_changes = LabelChanges(refresh_shards)
+        refreshes = 0
+        
+        start_ite = 0
+        if checkpoint is not None:
+            # Restore the state of the interrupted run after its last checkpointed iteration
+            start_ite = checkpoint['step']
+            p = allocate_target_buffer(target_buffer, (n_rows, self.n_clusters))
+            p[:] = checkpoint['p']
+            if p_on_device:
+                p_device = p.to(device)
+            shard_frequency = checkpoint['shard_frequency']
+            label_changes.history.extend(checkpoint['recent_changes'])
+            refreshes = checkpoint['refreshes']
+            order = checkpoint['order'].to(device)
+            position = checkpoint['position']
+            torch.set_rng_state(checkpoint['rng_state']['torch'])
+            if checkpoint['rng_state']['cuda'] is not None and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all(checkpoint['rng_state']['cuda'])
+            np.random.set_state(checkpoint['rng_state']['numpy'])
+            del checkpoint['p'], checkpoint['model_state_dict'], checkpoint['optimizer_state_dict']
+        
+        def snapshot(step):
+            # Copies only, so the background writer never sees tensors that training keeps updating
+            return {
+                'step': step,
+                'model_state_dict': {name: value.detach().cpu().clone() for name, value in self.state_dict().items()},
+                'optimizer_state_dict': copy.deepcopy(optimizer.state_dict()),
+                'p': p.clone(),
+                'y_pred_last': np.copy(y_pred_last),
+                'shard_frequency': shard_frequency.clone() if shard_frequency is not None else None,
+                'recent_changes': list(label_changes.history),
+                'refreshes': refreshes,
+                'order': order.cpu(),
+                'position': position,
+                'rng_state': {
+                    'torch': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                    'numpy': np.random.get_state(),
+                },
+            }
+        
+        writer = None
+        if checkpoint_interval:
+            writer = CheckpointWriter(os.path.join(save_dir, 'checkpoints'), keep_checkpoints, checkpoint_prefix)
+        
+        for ite in range(start_ite, int(maxiter)):
             # Update target distribution periodically
             if ite % update_interval == 0:
                 self.eval()
                 with torch.no_grad():
-                    # Get current predictions
-                    q_batch = []
-                    s_pred_batch = []
-                    
-                    for batch in tqdm(DataLoader(all_embeddings, batch_size=self.batch_size), 
-                                    desc=f"Updating distribution (iter {ite})"):
-                        # Explicitly ensure batch is on the correct device
-                        batch = batch.to(device)
-                        q, s = self(batch)  # This should now work with all tensors on same device
-                        q_batch.append(q)
-                        s_pred_batch.append(s)
-                    
-                    q = torch.cat(q_batch, dim=0)
-                    s_pred = torch.cat(s_pred_batch, dim=0)
-                    
-                    # Update auxiliary target distribution
-                    p = self.target_distribution(q)
-                    
-                    # Evaluate clustering performance
-                    y_pred = torch.argmax(q, dim=1).cpu().numpy()
-                    delta_label = np.sum(y_pred != y_pred_last).astype(np.float32) / y_pred.shape[0]
-                    y_pred_last = np.copy(y_pred)
+                    if shard_frequency is None:
+                        # Two passes over all rows: predictions, then p written into the buffer
+                        q, y_pred, s_pred_label = self._soft_labels(all_embeddings, out=p,
+                                                                    desc=f"Updating distribution (iter {ite})" if is_main else None)
+                        if refresh_shards > 1:
+                            shard_frequency = torch.stack([q[start:stop].sum(0, dtype=torch.float64)
+                                                           for start, stop in zip(shard_bounds[:-1], shard_bounds[1:])])
+                        frequency = cluster_frequency(q, self.batch_size)
+                        changes = torch.tensor([np.sum(y_pred != y_pred_last), n_rows], dtype=torch.float64)
+                        if distributed:
+                            # p needs the global cluster frequency
+                            dist.all_reduce(frequency)
+                            dist.all_reduce(changes)
+                        p = target_distribution_inplace(q, self.batch_size, frequency)
+                        rows = slice(None)
+                        delta_label = label_changes.add(changes[0].item(), changes[1].item(), full=True)
+                        y_pred_last = np.copy(y_pred)
+                    else:
+                        # Refresh p for one rotating shard only
+                        shard = refreshes % refresh_shards
+                        rows = slice(int(shard_bounds[shard]), int(shard_bounds[shard + 1]))
+                        y_pred, s_pred_label = self._refresh_target_shard(all_embeddings, p, rows.start, rows.stop,
+                                                                          shard_frequency, shard)
+                        delta_label = label_changes.add(np.sum(y_pred != y_pred_last[rows]), len(y_pred))
+                        y_pred_last[rows] = y_pred
+                        refreshes += 1
                     
                     # Compute sentiment prediction accuracy if labels available
                     if y_sentiment is not None:
-                        s_pred_label = torch.argmax(s_pred, dim=1).cpu().numpy()
-                        
                         if len(y_sentiment.shape) > 1:
                             sentiment_true_label = np.argmax(y_sentiment, axis=1)
                         else:
                             sentiment_true_label = y_sentiment
-                            
-                        acc_sentiment = np.sum(s_pred_label == sentiment_true_label).astype(np.float32) / s_pred_label.shape[0]
+                        sentiment_true_label = sentiment_true_label[rows]
+                        
+                        # Rows and correct predictions per class, summed across workers
+                        n_classes = len(self.class_labels)
+                        counts = torch.tensor(np.stack([
+                            np.bincount(sentiment_true_label, minlength=n_classes),
+                            np.bincount(sentiment_true_label[s_pred_label == sentiment_true_label], minlength=n_classes),
+                        ]), dtype=torch.float64)
+                        if distributed:
+                            dist.all_reduce(counts)
+                        counts = counts.numpy()
+                        acc_sentiment = np.float32(counts[1].sum() / counts[0].sum())
                         
                         # Compute per-class accuracy to monitor imbalance effects
-                        if len(np.unique(sentiment_true_label)) > 1:
-                            for cls in np.unique(sentiment_true_label):
-                                cls_mask = sentiment_true_label == cls
-                                cls_acc = np.sum((s_pred_label == sentiment_true_label) & cls_mask).astype(np.float32) / np.sum(cls_mask)
+                        present = np.flatnonzero(counts[0])
+                        if len(present) > 1:
+                            for cls in present:
+                                cls_acc = np.float32(counts[1, cls] / counts[0, cls])
                                 print(f"Class {self.class_labels[cls]} accuracy: {np.round(cls_acc, 5)}")
                     else:
                         acc_sentiment = 0
@@ -624,9 +1306,11 @@ class FNNGPU(nn.Module):
                     ari = 0
                 
                 # Log results
-                avg_loss = total_loss / update_interval if iter_count > 0 else 0
-                avg_cluster_loss = cluster_loss / update_interval if iter_count > 0 else 0
-                avg_sent_loss = sent_loss / update_interval if iter_count > 0 else 0
+                avg_loss = float(total_loss) / update_interval if iter_count > 0 else 0
+                avg_cluster_loss = float(cluster_loss) / update_interval if iter_count > 0 else 0
+                avg_sent_loss = float(sent_loss) / update_interval if iter_count > 0 else 0
+                elapsed = time.time() - log_time
+                steps_per_sec = steps_since_log / elapsed if steps_since_log > 0 and elapsed > 0 else 0
                 
                 logdict = {
                     'iter': ite, 
@@ -639,107 +1323,347 @@ class FNNGPU(nn.Module):
                     'Ls': np.round(avg_sent_loss, 5)
                 }
                 logwriter.writerow(logdict)
-                print(f'Iter {ite}: Cluster Loss {avg_cluster_loss:.5f}, Sentiment Loss {avg_sent_loss:.5f}, Acc_sentiment {acc_sentiment:.5f}; loss={avg_loss:.5f}')
+                print(f'Iter {ite}: Cluster Loss {avg_cluster_loss:.5f}, Sentiment Loss {avg_sent_loss:.5f}, Acc_sentiment {acc_sentiment:.5f}; loss={avg_loss:.5f}; {steps_per_sec:.1f} steps/sec')
                 
                 # Reset counters
-                total_loss = cluster_loss = sent_loss = 0
+                total_loss, cluster_loss, sent_loss = (torch.zeros((), device=device) for _ in range(3))
+                steps_since_log = 0
                 
                 # Check stop criterion based on cluster stability
-                if ite > 0 and delta_label < tol:
+                if ite > 0 and label_changes.converged(tol):
                     print(f'delta_label {delta_label} < tol {tol}')
                     print('Reached tolerance threshold. Stopping training.')
                     logfile.close()
                     break
                 
-                # Update dataset with new target distribution - ensure all on same device
-                if has_labels and isinstance(all_labels, torch.Tensor) and all_labels.numel() > 0:
-                    train_loader = DataLoader(TensorDataset(all_embeddings, p, all_labels), 
-                                        batch_size=self.batch_size, shuffle=True)
-                else:
-                    train_loader = DataLoader(TensorDataset(all_embeddings, p), 
-                                        batch_size=self.batch_size, shuffle=True)
-            
-            # Train on batch
-            self.train()
-            for batch in tqdm(train_loader, desc=f"Training iter {ite}", leave=False):
-                if y_sentiment is not None:
-                    if len(batch) == 3:  # With labels
-                        x_batch, p_batch, y_batch = batch
+                # Mirror the refreshed rows of p on the device
+                if p_on_device:
+                    if rows == slice(None):
+                        p_device = p.to(device)
                     else:
-                        x_batch, p_batch = batch
-                        y_batch = None
-                else:
-                    x_batch, p_batch = batch
-                    y_batch = None
-                
-                # Explicitly ensure all batch elements are on the correct device
-                x_batch = x_batch.to(device)
-                p_batch = p_batch.to(device)
-                if y_batch is not None:
-                    y_batch = y_batch.to(device)
-                
-                # Forward pass
-                q_batch, s_batch = self(x_batch)
-                
-                # Compute loss
-                c_loss = kld_loss(torch.log(q_batch), p_batch)
-                s_loss = torch.tensor(0.0).to(device)
-                
-                if y_batch is not None:
-                    if y_batch.dim() > 1 and y_batch.shape[1] > 1: 
-                        y_batch = torch.argmax(y_batch, dim=1)
-                    y_batch = y_batch.long() 
-                    s_loss = sentiment_loss(s_batch, y_batch)
-                
-                # Combined loss
-                loss = gamma * c_loss + eta * s_loss
-                
-                # Backward and optimize
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                
-                # Update statistics
-                total_loss += loss.item()
-                cluster_loss += c_loss.item()
-                sent_loss += s_loss.item() if y_batch is not None else 0
-                
-                iter_count += 1
+                        p_device[rows] = p[rows].to(device)
+                self.train()
+                log_time = time.time()
+            
+            # Train on one batch
+            if position >= n_rows:
+                order = torch.randperm(n_rows, device=device)
+                position = 0
+            batch_indices = order[position:position + step_size]
+            position += step_size
+            
+            # Upcast from the storage dtype; with a host buffer only this batch of p is copied
+            x_batch = all_embeddings[batch_indices].float()
+            p_batch = p_device[batch_indices] if p_on_device else p[batch_indices.cpu()].to(device)
+            y_batch = all_labels[batch_indices] if y_sentiment is not None else None
+            
+            # Forward pass; q and the sentiment probabilities come out in float32 under autocast
+            with self._autocast():
+                q_batch, s_batch = model(x_batch)
+            
+            # Compute loss
+            c_loss = kld_loss(torch.log(q_batch), p_batch)
+            s_loss = sentiment_loss(s_batch, y_batch) if y_batch is not None else zero_loss
+            
+            # Combined loss
+            loss = gamma * c_loss + eta * s_loss
+            
+            # Backward and optimize
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            
+            # Update statistics
+            total_loss += loss.detach()
+            cluster_loss += c_loss.detach()
+            sent_loss += s_loss.detach()
+            
+            iter_count += 1
+            steps_since_log += 1
             
             # Save intermediate model
-            if ite % save_interval == 0 and ite > 0:
+            if ite % save_interval == 0 and ite > 0 and is_main:
                 model_path = os.path.join(save_dir, f'FNN_model_{ite}.weights.pth')
                 self.save_weights(model_path)
+            
+            # Resumable training state, written in the background
+            if writer is not None and (ite + 1) % checkpoint_interval == 0:
+                writer.save(snapshot(ite + 1), ite + 1)
         
         # Save the trained model
+        if writer is not None:
+            writer.close()
         logfile.close()
-        model_path = os.path.join(save_dir, 'FNN_model_final.weights.pth')
-        self.save_weights(model_path)
+        if is_main:
+            model_path = os.path.join(save_dir, 'FNN_model_final.weights.pth')
+            self.save_weights(model_path)
         
         # Return final predictions
         self.eval()
         with torch.no_grad():
-            q, s_pred = self(all_embeddings)
-            y_pred = torch.argmax(q, dim=1).cpu().numpy()
+            # Hard labels only, so q is never held for all rows
+            def labels_and_sentiment(batch):
+                q, s = self(batch)
+                return torch.argmax(q, dim=1), s
+
+            y_pred, s_pred = self._forward_in_batches(all_embeddings, labels_and_sentiment)
+            y_pred = y_pred.cpu().numpy()
+            s_pred = s_pred.cpu().numpy()
+            if distributed:
+                # Blocks of rows are in rank order
+                parts = [None] * world_size
+                dist.all_gather_object(parts, (y_pred, s_pred))
+                y_pred = np.concatenate([part[0] for part in parts])
+                s_pred = np.concatenate([part[1] for part in parts])
             if y_sentiment is not None and has_labels:
-                s_pred = s_pred.cpu().numpy()
                 return y_pred, s_pred
             else:
                 return y_pred
 
-    def get_cluster_assignments(self, x):
+    def clustering_with_sentiment_parallel(self, dataset, world_size=None, threads_per_worker=None,
+                                           init_method=None, **kwargs):
         """
-        Get cluster assignments for a batch of inputs
+        Data-parallel clustering_with_sentiment on CPU cores: world_size worker processes (torch
+        distributed, gloo backend) each train a replica on one block of rows and all-reduce the
+        gradients; q.sum(0) for p and the stop criterion are summed across workers. The embeddings
+        are put in shared memory once instead of being copied to every worker.
+        world_size defaults to one worker per 8 cores and threads_per_worker to the cores divided
+        among the workers. init_method is the torch.distributed rendezvous URL; by default it is
+        built from MASTER_ADDR/MASTER_PORT when set, else from a free local port, so concurrent
+        jobs on one host do not collide. kwargs are passed to clustering_with_sentiment; the
+        trained weights are loaded into this model and its predictions for all rows are returned.
         """
-        self.eval()
+        world_size = world_size or max(1, (os.cpu_count() or 1) // 8)
+        init_method = init_method or _default_init_method()
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // world_size)
+        print(f'Data-parallel training with {world_size} workers x {threads} threads')
+
+        embeddings, labels = self._dataset_to_tensors(dataset, upcast=False)
+        data = _SharedTensors(embeddings, labels)
+        # The cache holds a lock and cannot be sent to the workers
+        prediction_cache, self.prediction_cache = self.prediction_cache, None
+        self.cpu()
+        results = mp.get_context('spawn').SimpleQueue()
+        try:
+            context = mp.spawn(_data_parallel_worker,
+                               args=(world_size, init_method, threads, self, data, kwargs, results),
+                               nprocs=world_size, join=False)
+            # Read the result while rank 0 is still alive; join raises if a worker failed
+            while results.empty():
+                if context.join(timeout=1):
+                    break
+            if results.empty():
+                raise RuntimeError("Data-parallel training finished without a result from rank 0")
+            state_dict, output = results.get()
+            while not context.join():
+                pass
+        finally:
+            self.prediction_cache = prediction_cache
+        self.load_state_dict({name: torch.from_numpy(value) for name, value in state_dict.items()})
+        self.to(device)
+        self._weights_changed()
+        return output
+
+    def _stream_statistics(self, dataset, target_model=None):
+        """
+        One pass over a streaming dataset with a frozen model
+
+        Returns:
+            tuple: (cluster frequency q.sum(0) as a tensor, hard cluster assignments,
+                sentiment predictions, label counts or None)
+        """
+        target_model = target_model if target_model is not None else self
+        target_model.eval()
+        cluster_frequency = torch.zeros(self.n_clusters, device=device)
+        y_pred = []
+        s_pred = []
+        label_counts = None
         with torch.no_grad():
-            if isinstance(x, torch.Tensor):
-                x = x.to(device)
+            for batch in tqdm(dataset, desc="Streaming target statistics", leave=False):
+                x_batch = batch[0] if isinstance(batch, (tuple, list)) else batch
+                q, s = target_model(x_batch.to(device))
+                cluster_frequency += q.sum(0)
+                y_pred.append(torch.argmax(q, dim=1).to(torch.int32).cpu().numpy())
+                s_pred.append(torch.argmax(s, dim=1).to(torch.int8).cpu().numpy())
+                if isinstance(batch, (tuple, list)):
+                    counts = np.bincount(batch[1].cpu().numpy(), minlength=len(self.class_labels))
+                    label_counts = counts if label_counts is None else label_counts + counts
+        return cluster_frequency, np.concatenate(y_pred), np.concatenate(s_pred), label_counts
+
+    def pretrain_autoencoder_stream(self, dataset, epochs=200, learning_rate=0.001):
+        """
+        Pretrain the autoencoder on a StreamingBERTDataset with memory bounded by one chunk
+        """
+        print('Pretraining autoencoder on streamed embeddings...')
+        self._weights_changed()
+        optimizer = optim.Adam(self.autoencoder.parameters(), lr=learning_rate)
+        criterion = nn.MSELoss()
+        self.autoencoder.to(device)
+
+        self.autoencoder.train()
+        for epoch in range(epochs):
+            total_loss = 0
+            n_batches = 0
+            with tqdm(dataset, desc=f"Epoch {epoch+1}/{epochs}") as pbar:
+                for batch in pbar:
+                    inputs = (batch[0] if isinstance(batch, (tuple, list)) else batch).to(device)
+
+                    optimizer.zero_grad()
+                    _, reconstructed = self.autoencoder(inputs)
+                    loss = criterion(reconstructed, inputs)
+                    loss.backward()
+                    optimizer.step()
+
+                    total_loss += loss.item()
+                    n_batches += 1
+                    pbar.set_postfix({'loss': total_loss / n_batches})
+
+        self.save_weights('pretrained_ae.weights.pth')
+        print('Autoencoder pretrained and weights saved to pretrained_ae.weights.pth')
+
+    def clustering_with_sentiment_stream(self, dataset, gamma=0.7, eta=1, tol=1e-3, update_interval=140,
+                                         maxiter=2e4, kmeans_samples=100000, save_dir='./results/fnnjst'):
+        """
+        Train joint clustering and sentiment on a StreamingBERTDataset with bounded memory
+
+        Instead of holding p for every row, a frozen copy of the model is taken at each target
+        update together with the global cluster frequency q.sum(0) from one streaming pass;
+        p is then recomputed per batch from the frozen copy, which gives the same targets as
+        the in-memory trainer. Only one int per row is kept (for the stop criterion).
+        Use a `cache_dir` on the dataset so BERT runs only on the first pass.
+
+        Args:
+            dataset: StreamingBERTDataset, optionally with a label column
+            kmeans_samples: Number of leading rows used to initialize the cluster centers
+            maxiter: Number of training batches
+
+        Returns:
+            y_pred (and sentiment predictions if the dataset has labels) as int numpy arrays
+        """
+        print('Update interval', update_interval)
+        self._weights_changed()
+        os.makedirs(save_dir, exist_ok=True)
+        self.to(device)
+
+        # Initialize cluster centers using k-means on a leading sample
+        print(f'Initializing cluster centers with k-means on up to {kmeans_samples} rows.')
+        self.eval()
+        features = []
+        n_features = 0
+        for batch in dataset:
+            x_batch = batch[0] if isinstance(batch, (tuple, list)) else batch
+            features.append(self.extract_feature(x_batch).cpu().numpy())
+            n_features += len(x_batch)
+            if n_features >= kmeans_samples:
+                break
+        kmeans = KMeans(n_clusters=self.n_clusters, n_init=20)
+        kmeans.fit(np.concatenate(features)[:kmeans_samples])
+        self.clustering.clusters.data = torch.tensor(kmeans.cluster_centers_, dtype=torch.float32).to(device)
+        del features
+
+        optimizer = optim.SGD(self.parameters(), lr=0.001, momentum=0.9)
+        kld_loss = nn.KLDivLoss(reduction='batchmean')
+        sentiment_loss = nn.CrossEntropyLoss()
+
+        logfile = open(os.path.join(save_dir, 'idec_sentiment_log.csv'), 'w', newline='')
+        fieldnames = ['iter', 'acc_cluster', 'nmi', 'ari', 'acc_sentiment', 'L', 'Lc', 'Ls']
+        logwriter = csv.DictWriter(logfile, fieldnames=fieldnames)
+        logwriter.writeheader()
+
+        def cycle_batches():
+            while True:
+                yield from dataset
+
+        batches = cycle_batches()
+        y_pred_last = None
+        save_interval = None
+        total_loss = cluster_loss = sent_loss = 0
+
+        for ite in range(int(maxiter)):
+            if ite % update_interval == 0:
+                target_model = copy.deepcopy(self).eval()
+                cluster_frequency, y_pred, s_pred, label_counts = self._stream_statistics(dataset, target_model)
+
+                if ite == 0:
+                    # Batches come from the dataset, whose batch size need not match the model's
+                    batch_size = getattr(dataset, 'batch_size', None) or self.batch_size
+                    save_interval = max(1, int(len(y_pred) / batch_size * 5))  # 5 epochs
+                    print('Save interval', save_interval)
+                    if label_counts is not None:
+                        # Balanced class weights, as in compute_class_weights
+                        present = label_counts > 0
+                        weights = np.zeros(len(label_counts), dtype=np.float32)
+                        weights[present] = label_counts.sum() / (present.sum() * label_counts[present])
+                        print(f"Class distribution: {dict(enumerate(label_counts.tolist()))}")
+                        sentiment_loss = nn.CrossEntropyLoss(weight=torch.tensor(weights).to(device))
+
+                delta_label = 1.0 if y_pred_last is None else np.sum(y_pred != y_pred_last).astype(np.float32) / y_pred.shape[0]
+                y_pred_last = y_pred
+
+                avg_loss = total_loss / update_interval if ite > 0 else 0
+                avg_cluster_loss = cluster_loss / update_interval if ite > 0 else 0
+                avg_sent_loss = sent_loss / update_interval if ite > 0 else 0
+                logwriter.writerow({'iter': ite, 'acc_cluster': 0, 'nmi': 0, 'ari': 0, 'acc_sentiment': 0,
+                                    'L': np.round(avg_loss, 5), 'Lc': np.round(avg_cluster_loss, 5),
+                                    'Ls': np.round(avg_sent_loss, 5)})
+                print(f'Iter {ite}: Cluster Loss {avg_cluster_loss:.5f}, Sentiment Loss {avg_sent_loss:.5f}; loss={avg_loss:.5f}')
+                total_loss = cluster_loss = sent_loss = 0
+
+                if ite > 0 and delta_label < tol:
+                    print(f'delta_label {delta_label} < tol {tol}')
+                    print('Reached tolerance threshold. Stopping training.')
+                    break
+
+            batch = next(batches)
+            if isinstance(batch, (tuple, list)):
+                x_batch, y_batch = batch[0].to(device), batch[1].to(device)
             else:
-                x = torch.tensor(x, dtype=torch.float32).to(device)
-            
-            cluster_output, _ = self(x)
-            return torch.argmax(cluster_output, dim=1).cpu().numpy()
+                x_batch, y_batch = batch.to(device), None
+
+            # Target distribution from the frozen model and the global cluster frequency
+            with torch.no_grad():
+                q_target, _ = target_model(x_batch)
+                p_batch = self.target_distribution(q_target, cluster_frequency)
+
+            self.train()
+            q_batch, s_batch = self(x_batch)
+            c_loss = kld_loss(torch.log(q_batch), p_batch)
+            s_loss = sentiment_loss(s_batch, y_batch) if y_batch is not None else torch.tensor(0.0).to(device)
+            loss = gamma * c_loss + eta * s_loss
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            total_loss += loss.item()
+            cluster_loss += c_loss.item()
+            sent_loss += s_loss.item()
+
+            if ite % save_interval == 0 and ite > 0:
+                self.save_weights(os.path.join(save_dir, f'FNN_model_{ite}.weights.pth'))
+
+        logfile.close()
+        self.save_weights(os.path.join(save_dir, 'FNN_model_final.weights.pth'))
+
+        _, y_pred, s_pred, label_counts = self._stream_statistics(dataset)
+        if label_counts is not None:
+            return y_pred, s_pred
+        return y_pred
+
+    def check_quantization(self, texts, bert_model="indolem/indobert-base-uncased", max_length=128):
+        """
+        Report how far an int8-quantized encoder drifts from fp32 on a sample of texts
+        """
+        def predict_fn(x):
+            return self.predict_heads(x)
+
+        return quantization_report(texts, bert_model, max_length=max_length, predict_fn=predict_fn)
+
+    def get_cluster_assignments(self, x):
+        """
+        Get cluster assignments for a batch of inputs
+        """
+        return self.predict_heads(x, 'cluster')
     
     def set_stop_words(self, stop_words):
         """
@@ -0,0 +1,220 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+PREDICT_OUTPUTS = ("records", "numpy", "pandas", "arrow")
+
+
+def prediction_columns(cluster_probs, sentiment_probs, class_labels, return_probs=False, top_k=0, features=None):
+    """
+    Turn model outputs for a block of rows into column arrays
+
+    Args:
+        cluster_probs: Soft cluster assignment q, shape (n, n_clusters)
+        sentiment_probs: Sentiment class probabilities, shape (n, n_classes)
+        class_labels: Dict mapping sentiment id to label
+        return_probs: Add the probability of the predicted sentiment
+        top_k: If > 0, add the k most likely clusters and their probabilities
+        features: Optional bottleneck features, shape (n, hidden_size)
+
+    Returns:
+        Dict of column name to NumPy array; 'cluster_topk', 'cluster_topk_prob' and
+        'features' are 2-D, every other column is 1-D
+    """
+    cluster_probs = np.asarray(cluster_probs)
+    sentiment_probs = np.asarray(sentiment_probs)
+    sentiment_ids = sentiment_probs.argmax(1)
+    labels = np.array([class_labels[i] for i in range(len(class_labels))], dtype=object)
+
+    columns = {
+        'cluster': cluster_probs.argmax(1).astype(np.int64),
+        'sentiment_id': sentiment_ids.astype(np.int64),
+        'sentiment': labels[sentiment_ids],
+    }
+    if return_probs:
+        columns['sentiment_prob'] = np.take_along_axis(sentiment_probs, sentiment_ids[:, None], 1)[:, 0].astype(np.float32)
+    if top_k:
+        k = min(top_k, cluster_probs.shape[1])
+        top = np.argpartition(-cluster_probs, k - 1, axis=1)[:, :k]
+        top_probs = np.take_along_axis(cluster_probs, top, 1)
+        order = np.argsort(-top_probs, axis=1)
+        columns['cluster_topk'] = np.take_along_axis(top, order, 1).astype(np.int64)
+        columns['cluster_topk_prob'] = np.take_along_axis(top_probs, order, 1).astype(np.float32)
+    if features is not None:
+        columns['features'] = np.asarray(features, dtype=np.float32)
+    return columns
+
+
+def concat_columns(parts):
+    """Concatenate column dicts produced for consecutive blocks of rows"""
+    return {name: np.concatenate([part[name] for part in parts], axis=0) for name in parts[0]}
+
+
+def format_predictions(columns, output="records", class_labels=None):
+    """
+    Convert prediction columns into the requested output
+
+    Args:
+        columns: Dict of column arrays from prediction_columns()
+        output: 'records' (list of dicts), 'numpy' (dict of arrays), 'pandas' (DataFrame)
+            or 'arrow' (pyarrow Table)
+        class_labels: Dict mapping sentiment id to label; used for a categorical label column
+
+    Returns:
+        Predictions in the requested format. In 'pandas' output 2-D columns are split into
+        numbered columns (cluster_top0, feature_0, ...); in 'arrow' output they are fixed-size lists
+    """
+    if output not in PREDICT_OUTPUTS:
+        raise ValueError(f"output must be one of {PREDICT_OUTPUTS}")
+
+    if output == "numpy":
+        return columns
+
+    if output == "records":
+        extra = [name for name in columns if name not in ('cluster', 'sentiment_id', 'sentiment')]
+        results = []
+        for i in range(len(columns['cluster'])):
+            result = {'sentiment': columns['sentiment'][i], 'cluster': int(columns['cluster'][i])}
+            for name in extra:
+                value = columns[name][i]
+                result[name] = value.tolist() if isinstance(value, np.ndarray) else value.item()
+            results.append(result)
+        return results
+
+    categories = [class_labels[i] for i in range(len(class_labels))] if class_labels else None
+
+    if output == "pandas":
+        import pandas as pd
+
+        data = {}
+        for name, values in columns.items():
+            if name == 'sentiment' and categories is not None:
+                data[name] = pd.Categorical.from_codes(columns['sentiment_id'], categories=categories)
+            elif values.ndim == 2:
+                pattern = {'cluster_topk': 'cluster_top{}', 'cluster_topk_prob': 'cluster_top{}_prob',
+                           'features': 'feature_{}'}[name]
+                for j in range(values.shape[1]):
+                    data[pattern.format(j)] = values[:, j]
+            else:
+                data[name] = values
+        return pd.DataFrame(data)
+
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("Arrow output requires pyarrow: pip install pyarrow")
+    arrays = {}
+    for name, values in columns.items():
+        if name == 'sentiment' and categories is not None:
+            arrays[name] = pa.DictionaryArray.from_arrays(pa.array(columns['sentiment_id'].astype(np.int32)),
+                                                          pa.array(categories))
+        elif values.ndim == 2:
+            arrays[name] = pa.FixedSizeListArray.from_arrays(pa.array(values.reshape(-1)), values.shape[1])
+        else:
+            arrays[name] = pa.array(values)
+    return pa.table(arrays)
+
+
+class PredictionCache(object):
+    """
+    Thread-safe LRU cache of per-text model outputs.
+
+    Keys are (model fingerprint, normalized text hash), values the soft cluster assignment,
+    sentiment probabilities and, when requested once, the bottleneck features of one text,
+    so every output mode can be served from the cache. The least recently used entries are
+    evicted once more than `max_entries` are stored or they take more than `max_bytes`.
+
+    Args:
+        max_entries: Maximum number of cached texts, None for no limit
+        max_bytes: Maximum total size of the cached arrays, None for no limit
+    """
+    def __init__(self, max_entries=100000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __deepcopy__(self, memo):
+        # A copied model starts with an empty cache of the same size: the lock cannot be copied and
+        # the copy's weights, and so its fingerprint, move on independently
+        return PredictionCache(self.max_entries, self.max_bytes)
+
+    @staticmethod
+    def _entry_bytes(entry):
+        return sum(value.nbytes for value in entry if value is not None)
+
+    def lookup(self, keys, features=False):
+        """
+        Return the cached (cluster_probs, sentiment_probs, features) per key, None for a miss.
+        With features=True an entry cached without features counts as a miss.
+        """
+        results = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None or (features and entry[2] is None):
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    results.append(entry)
+        return results
+
+    def add(self, keys, cluster_probs, sentiment_probs, features=None):
+        """Store one row of model outputs per key"""
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = (np.array(cluster_probs[i]), np.array(sentiment_probs[i]),
+                         np.array(features[i]) if features is not None else None)
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self.nbytes -= self._entry_bytes(previous)
+                self._entries[key] = entry
+                self.nbytes += self._entry_bytes(entry)
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                                     (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                _, entry = self._entries.popitem(last=False)
+                self.nbytes -= self._entry_bytes(entry)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry; counters are kept"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Hit/miss/eviction counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries), 'bytes': self.nbytes}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def weights_fingerprint(arrays):
+    """16 byte digest of a sequence of weight arrays"""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype, array.shape)).encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.digest()
+
+
+def encoder_name(bert_model, quantize=False, max_length=512):
+    """Identify the text encoder part of a prediction cache key"""
+    if not isinstance(bert_model, str):
+        bert_model = getattr(getattr(bert_model, 'config', None), '_name_or_path', None) or str(id(bert_model))
+    return bert_model, bool(quantize), int(max_length)
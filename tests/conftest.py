@@ -0,0 +1,18 @@
+import importlib
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(package, name):
+    """
+    Import one module of FNN_1 / FNN_1_GPU without running the package __init__, which pulls in
+    Keras (FNN_1) or the whole model; the helper modules only need NumPy/torch
+    """
+    if package not in sys.modules:
+        stub = types.ModuleType(package)
+        stub.__path__ = [os.path.join(ROOT, package)]
+        sys.modules[package] = stub
+    return importlib.import_module(f"{package}.{name}")
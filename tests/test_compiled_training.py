@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+torch = pytest.importorskip("torch")
+for module in ("sklearn", "pandas", "scipy", "transformers"):
+    pytest.importorskip(module)
+
+from conftest import load_module
+
+
+class ArrayDataset(torch.utils.data.Dataset):
+    def __init__(self, x, labels):
+        self.x = torch.from_numpy(x)
+        self.labels = torch.from_numpy(labels)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i):
+        return self.x[i], self.labels[i]
+
+
+@pytest.fixture
+def fnn(tmp_path):
+    model_module = load_module("FNN_1", "model")
+    model = model_module.FNN(dims=[16, 8, 4], n_clusters=3, batch_size=32)
+    ae_weights = str(tmp_path / "ae.weights.h5")
+    model.autoencoder.save_weights(ae_weights)
+    model.initialize_model(ae_weights=ae_weights)
+    return model
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.RandomState(0)
+    return ArrayDataset(rng.normal(size=(100, 16)).astype(np.float32), rng.randint(2, size=100))
+
+
+def test_compiled_training_runs(fnn, dataset, tmp_path):
+    y_pred, s_pred = fnn.clustering_with_sentiment(dataset, tol=0.0, update_interval=4, maxiter=10,
+                                                   save_dir=str(tmp_path / "run"), compiled=True)
+    assert y_pred.shape == (100,)
+    assert s_pred.shape == (100, 2)
+    assert np.isfinite(s_pred).all()
+
+
+def optimizer_state(fnn):
+    return [np.array(variable) for variable in fnn._optimizer_variables()]
+
+
+@pytest.mark.parametrize("trained_before", [False, True])
+def test_training_report_restores_model(fnn, dataset, tmp_path, trained_before):
+    if trained_before:
+        fnn.clustering_with_sentiment(dataset, tol=0.0, update_interval=4, maxiter=6,
+                                      save_dir=str(tmp_path / "run"), compiled=True)
+    weights = fnn.model.get_weights()
+    state = optimizer_state(fnn)
+    df_report = fnn.training_report(dataset, train_steps=6, steps_per_call=3)
+    assert list(df_report['mode']) == ['train_on_batch', 'compiled']
+    assert (df_report['steps_per_sec'] > 0).all()
+
+    # The benchmark leaves weights, momentum and the iteration count as it found them
+    for before, after in zip(weights, fnn.model.get_weights()):
+        np.testing.assert_array_equal(before, after)
+    if trained_before:
+        for before, after in zip(state, optimizer_state(fnn), strict=True):
+            np.testing.assert_array_equal(before, after)
+    else:
+        # Built by the benchmark, but still untouched: zero momentum, zero iterations
+        for value in optimizer_state(fnn):
+            if value.shape != ():
+                np.testing.assert_array_equal(value, 0)
+        assert int(np.array(fnn.model.optimizer.iterations)) == 0
@@ -0,0 +1,69 @@
+import copy
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+for module in ("sklearn", "pandas", "scipy", "tqdm", "transformers"):
+    pytest.importorskip(module)
+if not torch.distributed.is_available():
+    pytest.skip("torch.distributed is not available", allow_module_level=True)
+
+from sklearn.metrics import adjusted_rand_score
+
+from conftest import load_module
+
+
+class ArrayDataset(torch.utils.data.Dataset):
+    def __init__(self, x, labels):
+        self.x = torch.from_numpy(x)
+        self.labels = torch.from_numpy(labels)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i):
+        return self.x[i], self.labels[i]
+
+
+def blobs(n_per_cluster=80, n_features=16, seed=0):
+    """Three well separated blobs, so k-means finds the same centers in every run"""
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(scale=6.0, size=(3, n_features))
+    x = np.concatenate([center + rng.normal(size=(n_per_cluster, n_features)) for center in centers])
+    labels = np.repeat([0, 1, 0], n_per_cluster)
+    return x.astype(np.float32), labels.astype(np.int64)
+
+
+def test_data_parallel_matches_single_process(tmp_path):
+    model_module = load_module("FNN_1_GPU", "model")
+    torch.manual_seed(0)
+    initial = model_module.FNNGPU(dims=[16, 8, 3], n_clusters=3, batch_size=32)
+    x, labels = blobs()
+    dataset = ArrayDataset(x, labels)
+
+    runs = {}
+    for world_size in (1, 2):
+        model = copy.deepcopy(initial)
+        y_pred, _ = model.clustering_with_sentiment_parallel(
+            dataset, world_size=world_size, threads_per_worker=1, update_interval=10, maxiter=60, tol=0.0,
+            save_dir=str(tmp_path / f"world{world_size}"))
+        with torch.no_grad():
+            p, _, _ = model.compute_target(torch.from_numpy(x))
+        runs[world_size] = y_pred, p.numpy()
+
+    (labels_1, p_1), (labels_2, p_2) = runs[1], runs[2]
+    assert adjusted_rand_score(labels_1, labels_2) > 0.99
+    # Cluster ids may be permuted between runs; align them through the labels before comparing p
+    permutation = [np.bincount(labels_2[labels_1 == cluster], minlength=3).argmax() for cluster in range(3)]
+    np.testing.assert_allclose(p_1, p_2[:, permutation], atol=0.05)
+
+
+def test_default_init_method_uses_master_port(monkeypatch):
+    model_module = load_module("FNN_1_GPU", "model")
+    monkeypatch.setenv("MASTER_ADDR", "10.0.0.1")
+    monkeypatch.setenv("MASTER_PORT", "1234")
+    assert model_module._default_init_method() == "tcp://10.0.0.1:1234"
+    monkeypatch.delenv("MASTER_PORT")
+    first, second = model_module._default_init_method(), model_module._default_init_method()
+    assert first.startswith("tcp://127.0.0.1:") and second.startswith("tcp://127.0.0.1:")
@@ -0,0 +1,60 @@
+import multiprocessing
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+
+from conftest import load_module
+
+PACKAGES = ["FNN_1", "FNN_1_GPU"]
+
+
+def _add_rows(package, cache_dir, worker, n_batches, batch_size):
+    embedding_cache = load_module(package, "embedding_cache")
+    cache = embedding_cache.DiskEmbeddingCache(cache_dir, "bert", 32)
+    for batch in range(n_batches):
+        texts = [f"worker {worker} text {batch * batch_size + i}" for i in range(batch_size)]
+        embeddings = np.array([[hash(text) % 1000, worker, batch, i] for i, text in enumerate(texts)], dtype=np.float32)
+        cache.add([embedding_cache.text_hash(text) for text in texts], embeddings)
+
+
+@pytest.mark.parametrize("package", PACKAGES)
+def test_add_and_reopen(tmp_path, package):
+    embedding_cache = load_module(package, "embedding_cache")
+    cache = embedding_cache.DiskEmbeddingCache(str(tmp_path), "bert", 32)
+    keys = [embedding_cache.text_hash(text) for text in ["a", "b", "a "]]
+    cache.add(keys, np.arange(12, dtype=np.float32).reshape(3, 4))
+    # "a " normalizes to "a", so only two rows are stored
+    assert len(cache) == 2
+
+    reopened = embedding_cache.DiskEmbeddingCache(str(tmp_path), "bert", 32)
+    rows = reopened.lookup(keys)
+    np.testing.assert_array_equal(reopened.get(rows[:2]), np.arange(8, dtype=np.float32).reshape(2, 4))
+    assert rows[2] == rows[0]
+
+
+@pytest.mark.parametrize("package", PACKAGES)
+def test_concurrent_writers_get_distinct_rows(tmp_path, package):
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("needs the fork start method")
+    context = multiprocessing.get_context("fork")
+    n_workers, n_batches, batch_size = 4, 20, 8
+    workers = [context.Process(target=_add_rows, args=(package, str(tmp_path), worker, n_batches, batch_size))
+               for worker in range(n_workers)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+
+    embedding_cache = load_module(package, "embedding_cache")
+    cache = embedding_cache.DiskEmbeddingCache(str(tmp_path), "bert", 32)
+    assert len(cache) == n_workers * n_batches * batch_size
+    for worker in range(n_workers):
+        texts = [f"worker {worker} text {i}" for i in range(n_batches * batch_size)]
+        rows = cache.lookup([embedding_cache.text_hash(text) for text in texts])
+        assert (rows >= 0).all()
+        # Every key reads back the embedding written for it, not another worker's row
+        np.testing.assert_array_equal(cache.get(rows)[:, 1], worker)
+        np.testing.assert_array_equal(cache.get(rows)[:, 0], [hash(text) % 1000 for text in texts])
@@ -0,0 +1,70 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from conftest import load_module
+
+
+def stop_iteration(package, n_shards, drift, n_rows=3000, update_interval=20, maxiter=400, tol=0.002, seed=0):
+    """
+    Iteration at which the trainers' stop criterion fires when cluster labels drift by drift(ite)
+    of the rows per update interval, or None; refreshes follow clustering_with_sentiment
+    """
+    label_changes_module = load_module(package, "label_changes")
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(10, size=n_rows)
+    y_pred_last = labels.copy()  # k-means labels: the first full pass changes nothing
+    shard_bounds = np.linspace(0, n_rows, n_shards + 1).astype(np.int64)
+    label_changes = label_changes_module.LabelChanges(n_shards)
+    refreshes = 0
+    full_pass_done = False
+    for ite in range(0, maxiter, update_interval):
+        flip = rng.rand(n_rows) < drift(ite)
+        labels[flip] = (labels[flip] + 1) % 10
+        if n_shards == 1 or not full_pass_done:
+            label_changes.add(np.sum(labels != y_pred_last), n_rows, full=True)
+            y_pred_last = labels.copy()
+            full_pass_done = True
+        else:
+            shard = refreshes % n_shards
+            rows = slice(shard_bounds[shard], shard_bounds[shard + 1])
+            label_changes.add(np.sum(labels[rows] != y_pred_last[rows]), rows.stop - rows.start)
+            y_pred_last[rows] = labels[rows]
+            refreshes += 1
+        if ite > 0 and label_changes.converged(tol):
+            return ite
+    return None
+
+
+@pytest.mark.parametrize("package", ["FNN_1", "FNN_1_GPU"])
+@pytest.mark.parametrize("n_shards", [2, 3, 5])
+def test_sharded_refresh_keeps_training_while_labels_move(package, n_shards):
+    def drift(ite):
+        return 0.01
+
+    assert stop_iteration(package, 1, drift) is None
+    assert stop_iteration(package, n_shards, drift) is None
+
+
+@pytest.mark.parametrize("package", ["FNN_1", "FNN_1_GPU"])
+@pytest.mark.parametrize("n_shards", [2, 3, 5])
+def test_sharded_refresh_stops_no_earlier_than_full_refresh(package, n_shards):
+    def drift(ite):
+        return 0.01 if ite < 200 else 0.0
+
+    full = stop_iteration(package, 1, drift)
+    sharded = stop_iteration(package, n_shards, drift)
+    assert full is not None and sharded is not None
+    assert sharded >= full
+
+
+@pytest.mark.parametrize("package", ["FNN_1", "FNN_1_GPU"])
+def test_label_changes_resume_from_history(package):
+    label_changes_module = load_module(package, "label_changes")
+    label_changes = label_changes_module.LabelChanges(3, history=[(1, 100), (0, 100), (0, 100)])
+    assert label_changes.delta_label() == np.float32(1 / 300)
+    assert label_changes.converged(0.01)
+    assert not label_changes.converged(0.001)
+    # The first full pass of a sharded run does not count towards a rotation
+    assert label_changes.add(0, 300, full=True) == 0
+    assert not label_changes.converged(0.01)
@@ -0,0 +1,34 @@
+import copy
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from conftest import load_module
+
+
+@pytest.mark.parametrize("package", ["FNN_1", "FNN_1_GPU"])
+def test_deepcopy_starts_empty(package):
+    predictions = load_module(package, "predictions")
+    cache = predictions.PredictionCache(max_entries=10, max_bytes=1000)
+    cache.add([("model", "text")], np.ones((1, 3)), np.ones((1, 2)))
+
+    copied = copy.deepcopy(cache)
+    assert (copied.max_entries, copied.max_bytes) == (10, 1000)
+    assert len(copied) == 0 and len(cache) == 1
+    copied.add([("model", "other")], np.ones((1, 3)), np.ones((1, 2)))
+    assert len(cache) == 1
+
+
+def test_model_with_prediction_cache_can_be_copied():
+    torch = pytest.importorskip("torch")
+    for module in ("sklearn", "pandas", "scipy", "tqdm", "transformers"):
+        pytest.importorskip(module)
+    model_module = load_module("FNN_1_GPU", "model")
+    model = model_module.FNNGPU(dims=[16, 8, 4], n_clusters=3, batch_size=32)
+    model.enable_prediction_cache()
+
+    copied = copy.deepcopy(model)
+    assert copied.prediction_cache is not model.prediction_cache
+    report = model.autocast_report(torch.randn(64, 16), dtypes=("float32",), train_steps=2)
+    assert len(report) == 1
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from conftest import load_module
+
+
+class FakeTokenizer(object):
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.mark.parametrize("package", ["FNN_1", "FNN_1_GPU"])
+def test_each_thread_gets_its_own_tokenizer(package, monkeypatch):
+    registry_module = load_module(package, "registry")
+    loads = []
+
+    def from_pretrained(name):
+        loads.append(name)
+        return FakeTokenizer(name)
+
+    monkeypatch.setattr(registry_module.AutoTokenizer, "from_pretrained", from_pretrained)
+    registry = registry_module.EncoderRegistry()
+
+    tokenizers = {}
+
+    def worker(index):
+        first = registry.get_tokenizer("bert")
+        assert registry.get_tokenizer("bert") is first
+        tokenizers[index] = first
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(tokenizer) for tokenizer in tokenizers.values()}) == 4
+    assert all(tokenizer.name == "bert" for tokenizer in tokenizers.values())
+    assert registry.get_tokenizer("bert") not in tokenizers.values()
+    assert loads == ["bert"]
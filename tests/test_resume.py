@@ -0,0 +1,120 @@
+import copy
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+for module in ("sklearn", "pandas", "scipy", "tqdm", "transformers"):
+    pytest.importorskip(module)
+
+from conftest import load_module
+
+TRAINING = dict(update_interval=4, refresh_shards=2, tol=0.0, checkpoint_interval=6, keep_checkpoints=None)
+INTERRUPT_AT = 6
+MAXITER = 18
+
+
+class ArrayDataset(torch.utils.data.Dataset):
+    def __init__(self, x, labels):
+        self.x = torch.from_numpy(x)
+        self.labels = torch.from_numpy(labels)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i):
+        return self.x[i], self.labels[i]
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.RandomState(0)
+    return ArrayDataset(rng.normal(size=(100, 16)).astype(np.float32), rng.randint(2, size=100))
+
+
+def final_checkpoint(package, save_dir):
+    checkpoints = load_module(package, "checkpoints")
+    path = checkpoints.latest_checkpoint(str(save_dir / "checkpoints"))
+    return checkpoints.load_checkpoint(path)
+
+
+def assert_same_state(uninterrupted, resumed):
+    assert resumed['step'] == uninterrupted['step'] == MAXITER
+    np.testing.assert_array_equal(resumed['y_pred_last'], uninterrupted['y_pred_last'])
+    assert [tuple(map(int, entry)) for entry in resumed['recent_changes']] == \
+        [tuple(map(int, entry)) for entry in uninterrupted['recent_changes']]
+    assert resumed['refreshes'] == uninterrupted['refreshes']
+    np.testing.assert_allclose(np.asarray(resumed['p']), np.asarray(uninterrupted['p']), rtol=1e-5, atol=1e-6)
+
+
+def test_fnngpu_resume_matches_uninterrupted_run(dataset, tmp_path):
+    model_module = load_module("FNN_1_GPU", "model")
+    torch.manual_seed(0)
+    initial = model_module.FNNGPU(dims=[16, 8, 4], n_clusters=3, batch_size=32)
+
+    def train(save_dir, maxiter, resume_from=None):
+        torch.manual_seed(1)
+        np.random.seed(1)
+        model = copy.deepcopy(initial)
+        model.clustering_with_sentiment(dataset, maxiter=maxiter, save_dir=str(save_dir), resume_from=resume_from,
+                                        **TRAINING)
+        return model
+
+    uninterrupted = train(tmp_path / "uninterrupted", MAXITER)
+    train(tmp_path / "interrupted", INTERRUPT_AT)
+    resumed = train(tmp_path / "interrupted", MAXITER, resume_from=str(tmp_path / "interrupted" / "checkpoints"))
+
+    for name, value in uninterrupted.state_dict().items():
+        torch.testing.assert_close(resumed.state_dict()[name], value)
+    torch.testing.assert_close(resumed.clustering.clusters, uninterrupted.clustering.clusters)
+
+    expected = final_checkpoint("FNN_1_GPU", tmp_path / "uninterrupted")
+    actual = final_checkpoint("FNN_1_GPU", tmp_path / "interrupted")
+    assert_same_state(expected, actual)
+    assert actual['position'] == expected['position']
+    torch.testing.assert_close(actual['order'], expected['order'])
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_keras_resume_matches_uninterrupted_run(dataset, tmp_path, compiled):
+    pytest.importorskip("tensorflow")
+    keras = pytest.importorskip("keras")
+    model_module = load_module("FNN_1", "model")
+    ae_weights = str(tmp_path / "ae.weights.h5")
+    model_module.FNN(dims=[16, 8, 4], n_clusters=3, batch_size=32).autoencoder.save_weights(ae_weights)
+    initial_weights = None
+
+    def train(save_dir, maxiter, resume_from=None):
+        nonlocal initial_weights
+        np.random.seed(1)
+        model = model_module.FNN(dims=[16, 8, 4], n_clusters=3, batch_size=32)
+        model.initialize_model(ae_weights=ae_weights,
+                               optimizer=keras.optimizers.SGD(learning_rate=0.001, momentum=0.9))
+        # Dropout draws from a generator the checkpoint does not cover; without it training is deterministic
+        for layer in model.model.layers:
+            if isinstance(layer, keras.layers.Dropout):
+                layer.rate = 0.0
+        if initial_weights is None:
+            initial_weights = model.model.get_weights()
+        model.model.set_weights(initial_weights)
+        model.clustering_with_sentiment(dataset, maxiter=maxiter, save_dir=str(save_dir), resume_from=resume_from,
+                                        compiled=compiled, **TRAINING)
+        return model
+
+    uninterrupted = train(tmp_path / "uninterrupted", MAXITER)
+    train(tmp_path / "interrupted", INTERRUPT_AT)
+    resumed = train(tmp_path / "interrupted", MAXITER, resume_from=str(tmp_path / "interrupted" / "checkpoints"))
+
+    for expected, actual in zip(uninterrupted.model.get_weights(), resumed.model.get_weights()):
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(resumed.model.get_layer('clustering').get_weights()[0],
+                               uninterrupted.model.get_layer('clustering').get_weights()[0], rtol=1e-5, atol=1e-6)
+
+    expected = final_checkpoint("FNN_1", tmp_path / "uninterrupted")
+    actual = final_checkpoint("FNN_1", tmp_path / "interrupted")
+    assert_same_state(expected, actual)
+    # Batches are taken in row order, so the batch position follows from the step
+    n_batches = (len(dataset) + 31) // 32
+    assert actual['step'] % n_batches == expected['step'] % n_batches
+    for expected_value, actual_value in zip(expected['optimizer'], actual['optimizer']):
+        np.testing.assert_allclose(actual_value, expected_value, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from conftest import load_module
+
+
+def broadcast_soft_assignment(x, clusters, alpha=1.0):
+    """q from the direct (n, k, d) difference tensor, the formula the layers used before the GEMM form"""
+    q = 1.0 / (1.0 + np.sum(np.square(x[:, None, :] - clusters[None, :, :]), axis=2) / alpha)
+    q **= (alpha + 1.0) / 2.0
+    return q / q.sum(axis=1, keepdims=True)
+
+
+def random_inputs(seed, n_samples=257, n_clusters=7, n_features=32):
+    rng = np.random.RandomState(seed)
+    clusters = rng.normal(size=(n_clusters, n_features)).astype(np.float32)
+    x = rng.normal(size=(n_samples, n_features)).astype(np.float32)
+    # Points on top of a center are where the expansion cancels
+    x[:n_clusters] = clusters
+    return x, clusters
+
+
+@pytest.mark.parametrize("alpha", [1.0, 0.5])
+@pytest.mark.parametrize("chunk_size", [65536, 50])
+def test_torch_layer_matches_broadcast_formula(alpha, chunk_size):
+    torch = pytest.importorskip("torch")
+    for module in ("pandas", "sklearn", "scipy", "tqdm", "transformers"):
+        pytest.importorskip(module)
+    model_module = load_module("FNN_1_GPU", "model")
+
+    x, clusters = random_inputs(0)
+    layer = model_module.ClusteringLayer(len(clusters), x.shape[1], alpha=alpha, chunk_size=chunk_size)
+    with torch.no_grad():
+        layer.clusters.copy_(torch.from_numpy(clusters))
+        q = layer(torch.from_numpy(x)).numpy()
+
+    np.testing.assert_allclose(q, broadcast_soft_assignment(x, clusters, alpha), atol=1e-5)
+    with torch.no_grad():
+        nearest = layer.nearest(torch.from_numpy(x)).numpy()
+    np.testing.assert_array_equal(nearest[:len(clusters)], np.arange(len(clusters)))
+
+
+@pytest.mark.parametrize("package", ["FNN_1", "FNN_1_GPU"])
+def test_keras_layer_matches_broadcast_formula(package):
+    pytest.importorskip("tensorflow")
+    for module in ("sklearn", "joblib"):
+        pytest.importorskip(module)
+    dec_module = load_module(package, "DEC")
+
+    x, clusters = random_inputs(1)
+    layer = dec_module.ClusteringLayer(len(clusters), weights=[clusters], input_dim=x.shape[1])
+    layer.build((None, x.shape[1]))
+    q = np.asarray(layer(x))
+
+    np.testing.assert_allclose(q, broadcast_soft_assignment(x, clusters), atol=1e-5)
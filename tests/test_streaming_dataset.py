@@ -0,0 +1,50 @@
+import hashlib
+import multiprocessing
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from conftest import load_module
+
+HIDDEN_SIZE = 8
+
+
+def fake_encode_texts(texts, *args, **kwargs):
+    """Deterministic stand-in for BERT: a fixed vector per normalized text"""
+    embedding_cache = load_module("FNN_1", "embedding_cache")
+    rows = [np.frombuffer(hashlib.blake2b(embedding_cache.normalize_text(text).encode("utf-8"),
+                                          digest_size=HIDDEN_SIZE).digest(), dtype=np.uint8) for text in texts]
+    return torch.from_numpy(np.stack(rows).astype(np.float32))
+
+
+@pytest.mark.parametrize("package", ["FNN_1", "FNN_1_GPU"])
+def test_dataloader_workers_share_disk_cache(tmp_path, monkeypatch, package):
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("needs the fork start method")
+    dataset_module = load_module(package, "dataset")
+    monkeypatch.setattr(dataset_module, "encode_texts", fake_encode_texts)
+
+    # Texts repeat across chunks, so several workers try to store the same keys
+    texts = [f"text {i % 150}" for i in range(1200)]
+    path = tmp_path / "texts.csv"
+    pd.DataFrame({"text": texts, "row": np.arange(len(texts))}).to_csv(path, index=False)
+    cache_dir = str(tmp_path / "cache")
+
+    for _ in range(2):  # second pass reads everything from the cache
+        dataset = dataset_module.StreamingBERTDataset(str(path), label_column="row", batch_size=32, chunk_size=100,
+                                                      cuda=False, cache_dir=cache_dir)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=4,
+                                             multiprocessing_context="fork")
+        seen = 0
+        for embeddings, rows in loader:
+            expected = fake_encode_texts([texts[row] for row in rows.tolist()])
+            torch.testing.assert_close(embeddings, expected)
+            seen += len(rows)
+        assert seen == len(texts)
+
+    cache = load_module(package, "embedding_cache").DiskEmbeddingCache(cache_dir, "bert-base-uncased", 128)
+    assert len(cache) == 150
@@ -0,0 +1,50 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+for module in ("sklearn", "pandas", "scipy", "tqdm", "transformers"):
+    pytest.importorskip(module)
+
+from conftest import load_module
+
+
+class ArrayDataset(torch.utils.data.Dataset):
+    def __init__(self, x, labels):
+        self.x = torch.from_numpy(x)
+        self.labels = torch.from_numpy(labels)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i):
+        return self.x[i], self.labels[i]
+
+
+@pytest.fixture
+def model():
+    model_module = load_module("FNN_1_GPU", "model")
+    torch.manual_seed(0)
+    return model_module.FNNGPU(dims=[16, 8, 4], n_clusters=3, batch_size=32)
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.RandomState(0)
+    return ArrayDataset(rng.normal(size=(100, 16)).astype(np.float32), rng.randint(2, size=100))
+
+
+def test_training_report(model, dataset):
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    df_report = model.training_report(dataset, train_steps=7, batch_size=16)
+    assert list(df_report['mode']) == ['per_epoch_loader', 'batch_step']
+    assert (df_report['steps_per_sec'] > 0).all()
+    for name, value in model.state_dict().items():
+        torch.testing.assert_close(value, state[name])
+
+
+def test_batch_size_sets_rows_per_step(model, dataset, tmp_path):
+    checkpoints = load_module("FNN_1_GPU", "checkpoints")
+    model.clustering_with_sentiment(dataset, update_interval=4, batch_size=16, maxiter=5, tol=0.0,
+                                    save_dir=str(tmp_path), checkpoint_interval=5)
+    checkpoint = checkpoints.load_checkpoint(checkpoints.latest_checkpoint(str(tmp_path / "checkpoints")))
+    assert checkpoint['position'] == 5 * 16
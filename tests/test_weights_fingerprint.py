@@ -0,0 +1,43 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+for module in ("sklearn", "pandas", "scipy", "tqdm", "transformers"):
+    pytest.importorskip(module)
+
+from conftest import load_module
+
+
+@pytest.fixture
+def model():
+    model_module = load_module("FNN_1_GPU", "model")
+    torch.manual_seed(0)
+    return model_module.FNNGPU(dims=[16, 8, 4], n_clusters=3, batch_size=32)
+
+
+def test_fingerprint_follows_weights_changed_by_the_caller(model):
+    fingerprint = model._model_fingerprint()
+    assert model._model_fingerprint() == fingerprint
+
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    with torch.no_grad():
+        next(model.parameters()).add_(1.0)
+    changed = model._model_fingerprint()
+    assert changed != fingerprint
+
+    model.load_state_dict(state)
+    assert model._model_fingerprint() == fingerprint
+
+    model.clustering.clusters.data = model.clustering.clusters.data + 1.0
+    assert model._model_fingerprint() not in (fingerprint, changed)
+
+
+def test_assignment_index_dropped_when_centers_change(model):
+    x = torch.randn(64, 16)
+    model.build_assignment_index()
+    assert model._assignment_index() is not None
+
+    model.load_state_dict({**model.state_dict(), 'clustering.clusters': torch.randn(3, 4)})
+    assert model._assignment_index() is None
+    clusters = model.predict_heads(x, 'cluster')
+    assert clusters.shape == (64,)